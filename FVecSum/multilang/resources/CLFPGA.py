@@ -1,5 +1,13 @@
+import os
+import math
+import mmap
+import time
+import hashlib
+import threading
+import numpy as np
 import pyopencl as cl
 from pyopencl import mem_flags as mf
+from pyopencl import map_flags as mapf
 from pyopencl import command_queue_properties as cqp
 from collections import deque
 from enum import Enum
@@ -57,82 +65,714 @@ class CLProfilingManager:
                 f.write(r.to_string())
 
 
-class CLXilinxDevice:
-
-    def __init__(self, xclbin_filepath):
+# Chooses the pipeline depth (degree) from the profiled events of the
+# completed launches. The depth that fully overlaps H2D, kernel and D2H is
+# ceil((h2d + kernel + d2h) / bottleneck); one more slot is added when the
+# transfers keep waiting for a free slot longer than the bottleneck stage.
+# Growing and shrinking use separate thresholds: the degree shrinks only
+# while nothing waits and the depth is at least `hysteresis` of a slot over
+# the base depth plus the extra slot (which removed the wait that asked for
+# it), so a steady workload settles instead of resizing the rings (i.e.,
+# draining the pipeline) at every evaluation. The degree moves one step at
+# a time towards the target, within bounds, once the same target is
+# observed on two consecutive evaluations.
+class FDepthController:
+
+    def __init__(self, degree, min_degree, max_degree,
+                 interval=256, alpha=0.05, hysteresis=0.5):
+        self.degree = degree
+        self.min_degree = min_degree
+        self.max_degree = max_degree
+        self.interval = interval
+        self.alpha = alpha
+        self.hysteresis = hysteresis
+        self.samples = 0
+        self.last_target = degree
+        self.wait_ns = 0.0
+        self.h2d_ns = 0.0
+        self.kernel_ns = 0.0
+        self.d2h_ns = 0.0
+
+    def ewma(self, old, new):
+        if self.samples == 0:
+            return new
+        return old + self.alpha * (new - old)
+
+    def update(self, write_events, kernel_event, read_events):
+        wait = max([e.profile.start - e.profile.queued for e in write_events],
+                   default=0)
+        h2d = max([e.profile.end - e.profile.start for e in write_events],
+                  default=0)
+        kernel = kernel_event.profile.end - kernel_event.profile.start
+        d2h = max([e.profile.end - e.profile.start for e in read_events],
+                  default=0)
+
+        self.wait_ns = self.ewma(self.wait_ns, wait)
+        self.h2d_ns = self.ewma(self.h2d_ns, h2d)
+        self.kernel_ns = self.ewma(self.kernel_ns, kernel)
+        self.d2h_ns = self.ewma(self.d2h_ns, d2h)
+        self.samples += 1
+
+        if self.samples % self.interval == 0:
+            target = self.target()
+            if target != self.degree and target == self.last_target:
+                self.degree += 1 if target > self.degree else -1
+            self.last_target = target
+
+    def target(self):
+        stages = [self.h2d_ns, self.kernel_ns, self.d2h_ns]
+        bottleneck = max(stages)
+        if bottleneck <= 0:
+            return self.degree
+        ratio = sum(stages) / bottleneck
+        waiting = self.wait_ns > bottleneck
+        grow = math.ceil(ratio) + (1 if waiting else 0)
+        shrink = math.ceil(ratio + self.hysteresis) + 1
+        depth = self.degree
+        if self.degree < grow:
+            depth = grow
+        elif self.degree > shrink and not waiting:
+            depth = shrink
+        return min(max(depth, self.min_degree), self.max_degree)
+
+
+# Routes every launch to the device or to the host implementation of the
+# kernel by its input bytes. The time of each path is a linear model (fixed
+# ns + ns per byte) fitted on exponentially decayed samples: the launches
+# below the crossover run on the host. A fixed threshold disables the
+# models, otherwise one launch every explore_interval takes the other path
+# so that both stay current. Without a calibration (see
+# FBoltAsync.calibrate) the launches alternate between the paths until
+# both have min_samples live samples.
+class FRouter:
+    HOST = 0
+    DEVICE = 1
+    NAMES = ["host", "device"]
+
+    def __init__(self, threshold=None, max_bytes=None, interval=64,
+                 explore_interval=64, alpha=0.05, min_samples=8):
+        self.auto = threshold is None
+        self.threshold = threshold if threshold is not None else 0
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.explore_interval = explore_interval
+        self.alpha = alpha
+        self.min_samples = min_samples
+        self.calibrated = not self.auto
+        # decayed sums of weights, x, y, x*x and x*y of each path
+        self.sums = [[0.0] * 5 for _ in self.NAMES]
+        self.samples = [0, 0]
+        self.launches = [0, 0]
+        self.tuples = [0, 0]
+        self.nbytes = [0, 0]
+        self.busy_ns = [0, 0]
+        self.decisions = 0
+        self.last = None
+        self.cond = threading.Condition()
+
+    def route(self, nbytes):
+        path = self.DEVICE
+        if nbytes < self.threshold:
+            path = self.HOST
+        if self.auto:
+            self.decisions += 1
+            if not self.calibrated:
+                path = self.decisions % 2
+            elif self.decisions % self.explore_interval == 0:
+                path = 1 - path
+        return path
+
+    def record(self, path, nbytes, ns, tuples=1):
+        with self.cond:
+            s = self.sums[path]
+            for k, v in enumerate([1.0, nbytes, ns, nbytes * nbytes, nbytes * ns]):
+                s[k] = (1 - self.alpha) * s[k] + v
+            self.samples[path] += 1
+            # the calibration probes carry no tuples
+            if tuples:
+                self.launches[path] += 1
+                self.tuples[path] += tuples
+                self.nbytes[path] += nbytes
+                self.busy_ns[path] += ns
+            if (self.auto and not self.calibrated and tuples
+                    and min(self.samples) >= self.min_samples):
+                self.calibrated = True
+                self.threshold = self.crossover()
+            elif (self.auto and self.calibrated
+                    and sum(self.samples) % self.interval == 0):
+                self.threshold = self.crossover()
+            self.cond.notify_all()
+
+    # blocks until the path has at least n samples
+    def wait_samples(self, path, n):
+        with self.cond:
+            while self.samples[path] < n:
+                self.cond.wait()
+
+    # (fixed ns, ns per byte) of a path
+    def fit(self, path):
+        w, x, y, xx, xy = self.sums[path]
+        if w == 0:
+            return 0.0, 0.0
+        det = w * xx - x * x
+        if det <= 1e-9 * w * xx:
+            # a single size: all fixed cost
+            return y / w, 0.0
+        slope = max((w * xy - x * y) / det, 0.0)
+        return (y - slope * x) / w, slope
+
+    def crossover(self):
+        host_fixed, host_slope = self.fit(self.HOST)
+        device_fixed, device_slope = self.fit(self.DEVICE)
+        if host_slope <= device_slope:
+            # the host is never slower per byte
+            return self.max_bytes + 1 if host_fixed < device_fixed else 0
+        x = (device_fixed - host_fixed) / (host_slope - device_slope)
+        return int(min(max(x, 0), self.max_bytes + 1))
+
+    def calibrate(self):
+        with self.cond:
+            self.threshold = self.crossover()
+            self.calibrated = True
+
+    # counts since the start (a tuple split in chunks counts once per
+    # chunk), throughput since the last snapshot
+    def snapshot(self):
+        with self.cond:
+            now = time.perf_counter_ns()
+            report = {"threshold_bytes": self.threshold}
+            for path, name in enumerate(self.NAMES):
+                fixed, slope = self.fit(path)
+                report[name] = {"launches": self.launches[path],
+                                "tuples": self.tuples[path],
+                                "bytes": self.nbytes[path],
+                                "busy_ms": 1e-6 * self.busy_ns[path],
+                                "fixed_us": 1e-3 * fixed,
+                                "ns_per_byte": slope}
+            if self.last is not None:
+                then, tuples, nbytes = self.last
+                seconds = 1e-9 * (now - then)
+                for path, name in enumerate(self.NAMES):
+                    report[name]["tuples_per_s"] = (self.tuples[path] - tuples[path]) / seconds
+                    report[name]["mb_per_s"] = 1e-6 * (self.nbytes[path] - nbytes[path]) / seconds
+            self.last = (now, list(self.tuples), list(self.nbytes))
+            return report
+
+
+# Log-linear histogram of durations (ns) in the style of HdrHistogram:
+# every power of two is split in 2**sub_bits buckets, so the relative error
+# is below 2**-sub_bits and the memory does not grow with the samples.
+class FHistogram:
+
+    def __init__(self, sub_bits=5, max_bits=40):
+        self.sub_bits = sub_bits
+        self.sub_count = 1 << sub_bits
+        self.max_value = (1 << max_bits) - 1
+        self.counts = [0] * ((max_bits - sub_bits + 1) * self.sub_count)
+        self.total = 0
+
+    def index(self, value):
+        if value < self.sub_count:
+            return max(value, 0)
+        shift = value.bit_length() - self.sub_bits - 1
+        return (shift + 1) * self.sub_count + (value >> shift) - self.sub_count
+
+    # lowest value of the index-th bucket
+    def value_at(self, index):
+        b, s = divmod(index, self.sub_count)
+        if b == 0:
+            return s
+        return (s + self.sub_count) << (b - 1)
+
+    def record(self, value):
+        self.counts[self.index(min(int(value), self.max_value))] += 1
+        self.total += 1
+
+    # highest value equivalent to the q-quantile (0 < q <= 1)
+    def percentile(self, q):
+        if self.total == 0:
+            return 0
+        rank = max(math.ceil(q * self.total), 1)
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return self.value_at(i + 1) - 1
+        return self.max_value
+
+
+# One histogram per stage of the pipeline, swapped out at every report
+class FLatencyRecorder:
+
+    def __init__(self, stages, interval_s=10):
+        self.stages = stages
+        self.interval_s = interval_s
+        self.lock = threading.Lock()
+        self.histograms = {s: FHistogram() for s in self.stages}
+
+    def record(self, stage, value_ns):
+        with self.lock:
+            self.histograms[stage].record(value_ns)
+
+    # p50/p99/p99.9 in microseconds of the stages recorded since the
+    # previous snapshot
+    def snapshot(self):
+        with self.lock:
+            histograms = self.histograms
+            self.histograms = {s: FHistogram() for s in self.stages}
+        report = {}
+        for s, h in histograms.items():
+            if h.total > 0:
+                report[s] = {"count": h.total,
+                             "p50": 1e-3 * h.percentile(0.5),
+                             "p99": 1e-3 * h.percentile(0.99),
+                             "p999": 1e-3 * h.percentile(0.999)}
+        return report
+
+
+# Compiled programs on disk, keyed by the hash of everything that produced
+# them (source, options, device and driver), in FBOLT_CACHE_DIR or
+# ~/.cache/fbolt. A missing or unwritable directory only disables the cache.
+class FProgramCache:
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.environ.get("FBOLT_CACHE_DIR",
+                                       os.path.join(os.path.expanduser("~"),
+                                                    ".cache", "fbolt"))
+        self.directory = directory
+
+    def key(self, *parts):
+        h = hashlib.sha256()
+        for p in parts:
+            h.update(p if isinstance(p, bytes) else str(p).encode())
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".bin")
+
+    def load(self, key):
+        try:
+            return map_file(self.path(key))
+        except (OSError, ValueError):
+            return None
+
+    # written aside and renamed, so that concurrent workers never read a
+    # partial binary
+    def store(self, key, binary):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = "{}.{}".format(self.path(key), os.getpid())
+            with open(tmp, "wb") as f:
+                f.write(binary)
+            os.replace(tmp, self.path(key))
+        except OSError:
+            pass
+
+
+# read-only mapping of a whole file, e.g. a bitstream, without copying it
+def map_file(filepath):
+    with open(filepath, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# Contexts and programs already set up by this process: a bolt restarted in
+# the same worker, or another bolt of the same xclbin, reuses them
+DEVICE_REGISTRY = {}
+DEVICE_REGISTRY_LOCK = threading.Lock()
+
+
+# Compute backend interface used by FBoltAsync/FBoltSync and FBuffers.
+# Every backend exposes the same queue/buffer/kernel/event operations,
+# so the bolts keep the same pipelining semantics on any device.
+class CLDevice:
+
+    # names of the kernel instances that can run concurrently
+    def compute_units(self, kernel_name):
+        return [kernel_name]
+
+    # out-of-order queues fall back to in-order ones if the device does not
+    # support them: the commands carry their dependencies anyway
+    def create_queue(self, profile=False, out_of_order=False):
+        properties = 0
+        if profile:
+            properties |= cqp.PROFILING_ENABLE
+        if (out_of_order and self.device.queue_properties
+                & cqp.OUT_OF_ORDER_EXEC_MODE_ENABLE):
+            properties |= cqp.OUT_OF_ORDER_EXEC_MODE_ENABLE
+        return cl.CommandQueue(self.context, properties=properties)
+
+    def create_buffer(self, flags, size):
+        return cl.Buffer(self.context, flags, size)
+
+    def create_sub_buffer(self, buffer, origin, size):
+        return buffer.get_sub_region(origin, size)
+
+    # alignment (in bytes) required by the origin of a sub-buffer
+    def base_align(self):
+        return self.device.get_info(cl.device_info.MEM_BASE_ADDR_ALIGN) // 8
+
+    # Pinned (ALLOC_HOST_PTR) host memory, mapped once for the whole run.
+    # Copies from it to device buffers do not need a bounce buffer.
+    def create_host_buffer(self, queue, size):
+        buffer = cl.Buffer(self.context,
+                           mf.ALLOC_HOST_PTR | mf.READ_WRITE,
+                           size)
+        array, _ = cl.enqueue_map_buffer(queue, buffer,
+                                         mapf.READ | mapf.WRITE,
+                                         0, (size,), np.uint8,
+                                         is_blocking=True)
+        return array
+
+    def create_kernel(self, kernel_name, buffer_descriptors):
+        kernel = cl.Kernel(self.program, kernel_name)
+        scalar_dtypes = []
+        for bd in buffer_descriptors:
+            if bd.is_SCALAR():
+                scalar_dtypes.append(bd.dtype)
+            else:
+                scalar_dtypes.append(None)
+        kernel.set_scalar_arg_dtypes(scalar_dtypes)
+        return kernel
+
+    def enqueue_copy(self, queue, dest, src, wait_for=None,
+                     is_blocking=False):
+        return cl.enqueue_copy(queue, dest, src,
+                               wait_for=wait_for,
+                               is_blocking=is_blocking)
+
+    def enqueue_kernel(self, queue, kernel, gws, lws, wait_for=None):
+        return cl.enqueue_nd_range_kernel(queue, kernel, gws, lws,
+                                          wait_for=wait_for)
+
+    def wait_for_events(self, events):
+        cl.wait_for_events(events)
+
+
+class CLXilinxDevice(CLDevice):
+
+    def __init__(self, xclbin_filepath, index=0):
+        start = time.perf_counter()
+        st = os.stat(xclbin_filepath)
+        key = ("xilinx", os.path.realpath(xclbin_filepath),
+               st.st_mtime_ns, st.st_size, index)
+        with DEVICE_REGISTRY_LOCK:
+            shared = DEVICE_REGISTRY.get(key)
+            if shared is None:
+                # get the fpga device
+                devices = CLXilinxDevice.devices()
+                if len(devices) <= index:
+                    raise RuntimeError("Device not found!")
+                device = devices[index]
+
+                # create a context
+                context = cl.Context([device])
+                enumerated = time.perf_counter()
+
+                # load the bitstream, mapped instead of read in memory
+                binary = map_file(xclbin_filepath)
+                program = cl.Program(context, [device], [binary])
+                program.build()
+                binary.close()
+                shared = (device, context, program)
+                DEVICE_REGISTRY[key] = shared
+                self.startup = {"source": "xclbin",
+                                "enumerate_ms": 1e3 * (enumerated - start),
+                                "build_ms": 1e3 * (time.perf_counter() - enumerated)}
+            else:
+                self.startup = {"source": "registry"}
+
+        self.device, self.context, self.program = shared
+        self.platform = self.device.platform
+        self.startup["total_ms"] = 1e3 * (time.perf_counter() - start)
+
+    @staticmethod
+    def devices():
         # get the platform
-        platforms = cl.get_platforms()
-        found = False
-        for p in platforms:
-            platform_name = p.get_info(cl.platform_info.NAME)
-            if platform_name == "Xilinx":
-                self.platform = p
-                found = True
+        for p in cl.get_platforms():
+            if p.get_info(cl.platform_info.NAME) == "Xilinx":
+                return p.get_devices(cl.device_type.ACCELERATOR)
+        raise RuntimeError("`Xilinx` Platform not Found!")
+
+    # one CLXilinxDevice for every card of the host
+    @classmethod
+    def all(cls, xclbin_filepath):
+        return [cls(xclbin_filepath, i) for i in range(len(cls.devices()))]
+
+    # The compute units of a kernel are named <kernel>_1, <kernel>_2, ...
+    # and each one is addressed as "<kernel>:{<kernel>_<i>}"
+    def compute_units(self, kernel_name):
+        names = []
+        while True:
+            name = "{0}:{{{0}_{1}}}".format(kernel_name, len(names) + 1)
+            try:
+                cl.Kernel(self.program, name)
+            except cl.Error:
+                break
+            names.append(name)
+        if not names:
+            names.append(kernel_name)
+        return names
+
+
+# Generic OpenCL CPU device (e.g., POCL): the kernel is built from source
+class CLCPUDevice(CLDevice):
+
+    def __init__(self, kernel_filepath, platform_name=None, options=[],
+                 device=None, cache=None):
+        start = time.perf_counter()
+        # get the first platform exposing a CPU device
+        self.device = device
+        for p in cl.get_platforms():
+            if self.device is not None:
                 break
+            if platform_name and p.get_info(cl.platform_info.NAME) != platform_name:
+                continue
+            try:
+                devices = p.get_devices(cl.device_type.CPU)
+            except cl.Error:
+                continue
+            if len(devices) > 0:
+                self.device = devices[0]
+
+        if self.device is None:
+            raise RuntimeError("OpenCL CPU Device not found!")
+        self.platform = self.device.platform
 
-        if not found:
-            raise RuntimeError("`Xilinx` Platform not Found!")
+        # create a context
+        self.context = cl.Context([self.device])
+        enumerated = time.perf_counter()
+
+        # build the kernel source, or load the binary of a previous build
+        self.source = open(kernel_filepath, "r").read()
+        if cache is None:
+            cache = FProgramCache()
+        key = cache.key(self.source, " ".join(options),
+                        self.device.name, self.device.driver_version,
+                        self.platform.version)
+        binary = cache.load(key)
+        self.program = None
+        if binary is not None:
+            try:
+                self.program = cl.Program(self.context, [self.device], [binary])
+                self.program.build(options=options)
+            except cl.Error:
+                self.program = None
+            binary.close()
+        source = "cache"
+        if self.program is None:
+            source = "source"
+            self.program = cl.Program(self.context, self.source)
+            self.program.build(options=options)
+            cache.store(key, self.program.get_info(cl.program_info.BINARIES)[0])
+        self.startup = {"source": source,
+                        "enumerate_ms": 1e3 * (enumerated - start),
+                        "build_ms": 1e3 * (time.perf_counter() - enumerated),
+                        "total_ms": 1e3 * (time.perf_counter() - start)}
+
+    # Splits the CPU in n sub-devices with the same number of cores. When
+    # the CPU cannot be partitioned, n independent contexts are created.
+    @classmethod
+    def partition(cls, kernel_filepath, n, platform_name=None, options=[]):
+        root = cls(kernel_filepath, platform_name, options)
+        units = root.device.max_compute_units // n
+        if units == 0:
+            return [root] + [cls(kernel_filepath, platform_name, options, root.device)
+                             for i in range(n - 1)]
+        try:
+            devices = root.device.create_sub_devices(
+                [cl.device_partition_property.EQUALLY, units])
+        except cl.Error:
+            return [root] + [cls(kernel_filepath, platform_name, options, root.device)
+                             for i in range(n - 1)]
+        return [cls(kernel_filepath, platform_name, options, d)
+                for d in devices[0:n]]
+
+
+# A region of a slab and the sub-buffer that maps it
+class FSlabAllocation:
+
+    def __init__(self, offset, size, buffer):
+        self.offset = offset
+        self.size = size
+        self.buffer = buffer
+        self.released = False
 
-        # get the fpga device
-        devices = self.platform.get_devices(cl.device_type.ACCELERATOR)
-        if len(devices) == 0:
-            raise RuntimeError("Device not found!")
 
-        self.device = devices[0]
+# Ring allocator of sub-buffers over a single device buffer. Regions are
+# handed out in order and reclaimed once every older region has been
+# released, alloc blocks while the slab is full.
+class FSlab:
 
-        # create a context
-        self.context = cl.Context([self.device])
+    def __init__(self, device, flags, size):
+        self.device = device
+        self.size = size
+        self.align = device.base_align()
+        self.buffer = device.create_buffer(flags, size)
+        self.head = 0
+        self.allocations = deque()
+        self.cond = threading.Condition()
+
+    def fit(self, nbytes):
+        if not self.allocations:
+            self.head = 0
+            return 0 if nbytes <= self.size else None
+        tail = self.allocations[0].offset
+        if self.head > tail:
+            if self.head + nbytes <= self.size:
+                return self.head
+            if nbytes <= tail:
+                return 0
+        elif self.head < tail:
+            if self.head + nbytes <= tail:
+                return self.head
+        return None
 
-        # load the bitstream
-        self.binary = open(xclbin_filepath, "rb").read()
-        self.program = cl.Program(self.context, [self.device], [self.binary])
-        self.program.build()
+    def alloc(self, nbytes):
+        nbytes = max(self.align,
+                     (nbytes + self.align - 1) // self.align * self.align)
+        if nbytes > self.size:
+            raise RuntimeError("Allocation larger than the slab!")
+        with self.cond:
+            offset = self.fit(nbytes)
+            while offset is None:
+                self.cond.wait()
+                offset = self.fit(nbytes)
+            self.head = offset + nbytes
+            buffer = self.device.create_sub_buffer(self.buffer, offset, nbytes)
+            allocation = FSlabAllocation(offset, nbytes, buffer)
+            self.allocations.append(allocation)
+        return allocation
+
+    def free(self, allocation):
+        with self.cond:
+            allocation.released = True
+            while self.allocations and self.allocations[0].released:
+                self.allocations.popleft()
+            self.cond.notify_all()
+
+
+# Command queues used in turn by the commands of one direction (writes,
+# kernels or reads) of a lane. Out-of-order queues, or more than one queue,
+# let the commands run as soon as the events they wait for are completed,
+# e.g. a slow read does not delay the next reads.
+class FQueuePool:
+
+    def __init__(self, device, size=1, profile=False, out_of_order=False):
+        self.queues = [device.create_queue(profile, out_of_order)
+                       for i in range(size)]
+        self.idx = -1
+
+    def next(self):
+        self.idx = (self.idx + 1) % len(self.queues)
+        return self.queues[self.idx]
+
+    def finish(self):
+        for queue in self.queues:
+            queue.finish()
 
 
 class FBuffers:
 
-    def __init__(self, context, flags, size, degree, profile=False):
-        self.context = context
+    def __init__(self, device, flags, size, degree, profile=False,
+                 slab_size=None, queues=None):
+        self.device = device
         self.flags = flags
         self.size = size
         self.idx = -1
         self.degree = degree
 
-        if profile:
-            self.queue = cl.CommandQueue(self.context,
-                                         properties=cqp.PROFILING_ENABLE)
-        else:
-            self.queue = cl.CommandQueue(self.context)
+        # a private in-order queue, unless a pool is shared with others
+        self.queues = queues
+        if self.queues is None:
+            self.queues = FQueuePool(self.device, 1, profile)
+        self.queue = self.queues.queues[0]
 
         self.events = deque()
         self.buffers = []
-        for i in range(self.degree):
-            self.buffers.append(cl.Buffer(self.context, self.flags, size))
+        # slab mode: every launch gets a sub-buffer of its live size out of
+        # a slab of slab_size max-size buffers, instead of a ring slot
+        self.slab = None
+        self.allocation = None
+        if slab_size:
+            self.slab = FSlab(self.device, self.flags, slab_size * size)
+        else:
+            for i in range(self.degree):
+                self.buffers.append(self.device.create_buffer(self.flags,
+                                                              size))
 
     def current(self):
+        if self.slab is not None:
+            return self.allocation.buffer
         return self.buffers[self.idx % self.degree]
 
-    def next(self):
+    def next(self, nbytes=None):
         self.idx += 1
+        if self.slab is not None:
+            self.allocation = self.slab.alloc(nbytes or self.size)
         return self.current()
 
+    # gives back the sub-buffer of a completed launch (slab mode)
+    def release(self, allocation):
+        self.slab.free(allocation)
+
     def pop_oldest_event(self):
         if len(self.events) == self.degree:
             return self.events.popleft()
         return None
 
     def finish(self):
-        self.queue.finish()
+        self.queues.finish()
+
+    # Grows or shrinks the ring, the pending commands are drained first
+    def resize(self, degree):
+        self.finish()
+        while self.slab is None and len(self.buffers) < degree:
+            self.buffers.append(self.device.create_buffer(self.flags,
+                                                          self.size))
+        del self.buffers[degree:]
+        self.degree = degree
+        self.idx = -1
+        self.events.clear()
 
 
 class FWriteBuffers(FBuffers):
 
-    def __init__(self, context, size, degree, profile=False):
-        super().__init__(context,
+    def __init__(self, device, size, degree, profile=False, staging=False,
+                 slab_size=None, queues=None):
+        super().__init__(device,
                          mf.HOST_WRITE_ONLY | mf.READ_ONLY,
                          size,
                          degree,
-                         profile)
+                         profile,
+                         slab_size,
+                         queues)
+
+        # host-side staging arrays, one per buffer slot
+        self.staging = []
+        self.staged = None
+        if staging:
+            for i in range(self.degree):
+                self.staging.append(self.device.create_host_buffer(self.queue,
+                                                                   size))
+
+    # Returns a view of the staging array of the slot used by the next write.
+    # It waits for the previous copy out of that slot to be completed.
+    def next_staging(self, dtype, elem_nums):
+        if len(self.events) == self.degree:
+            self.events[0].wait()
+        slot = (self.idx + 1) % self.degree
+        self.staged = self.staging[slot].view(dtype)[0:elem_nums]
+        return self.staged
+
+    def resize(self, degree):
+        super().resize(degree)
+        if self.staging:
+            while len(self.staging) < degree:
+                self.staging.append(self.device.create_host_buffer(self.queue,
+                                                                   self.size))
+            del self.staging[degree:]
 
     def write(self, src, wait_for=None, is_blocking=False):
         wait_events = []
@@ -142,55 +782,189 @@ class FWriteBuffers(FBuffers):
         if wait_for:
             wait_events.append(wait_for)
 
-        event = cl.enqueue_copy(self.queue,
-                                self.current(),
-                                src,
-                                wait_for=wait_events,
-                                is_blocking=is_blocking)
+        event = self.device.enqueue_copy(self.queues.next(),
+                                         self.current(),
+                                         src,
+                                         wait_for=wait_events,
+                                         is_blocking=is_blocking)
         self.events.append(event)
         return event
 
 
 class FReadBuffers(FBuffers):
 
-    def __init__(self, context, size, degree, profile=False):
-        super().__init__(context,
+    def __init__(self, device, size, degree, profile=False, slab_size=None,
+                 queues=None):
+        super().__init__(device,
                          mf.HOST_READ_ONLY | mf.WRITE_ONLY,
                          size,
                          degree,
-                         profile)
+                         profile,
+                         slab_size,
+                         queues)
 
     def read(self, dest, wait_for=None, is_blocking=False):
-        event = cl.enqueue_copy(self.queue,
-                                dest,
-                                self.current(),
-                                wait_for=wait_for,
-                                is_blocking=is_blocking)
+        event = self.device.enqueue_copy(self.queues.next(),
+                                         dest,
+                                         self.current(),
+                                         wait_for=wait_for,
+                                         is_blocking=is_blocking)
         self.events.append(event)
         return event
 
 
+# A single device buffer that persists across the launches (FBufferType.STATE
+# and INOUT), zeroed at creation. Every command touching it waits for the
+# previous one, so the kernels see the updates in launch order.
+class FStateBuffer:
+
+    def __init__(self, device, size, profile=False):
+        self.device = device
+        self.size = size
+        self.queue = self.device.create_queue(profile)
+        self.buffer = self.device.create_buffer(mf.READ_WRITE, size)
+        self.last_event = None
+        self.write(np.zeros(size, dtype=np.uint8), is_blocking=True)
+
+    def current(self):
+        return self.buffer
+
+    # events the next command on the buffer must wait for
+    def depend(self):
+        if self.last_event is None:
+            return []
+        return [self.last_event]
+
+    # a kernel (on another queue) updated the buffer
+    def touched(self, event):
+        self.last_event = event
+
+    def read(self, dest, wait_for=None, is_blocking=False):
+        event = self.device.enqueue_copy(self.queue,
+                                         dest,
+                                         self.buffer,
+                                         wait_for=self.depend() + list(wait_for or []),
+                                         is_blocking=is_blocking)
+        self.last_event = event
+        return event
+
+    def write(self, src, is_blocking=False):
+        event = self.device.enqueue_copy(self.queue,
+                                         self.buffer,
+                                         src,
+                                         wait_for=self.depend(),
+                                         is_blocking=is_blocking)
+        self.last_event = event
+        return event
+
+    def finish(self):
+        self.queue.finish()
+
+
 class FBufferType(Enum):
     IN = 1
     OUT = 2
     SCALAR = 3
+    OFFSETS = 4
+    # a single buffer that persists across the launches: STATE stays on
+    # the device, INOUT is also read back with every launch (as an OUT)
+    STATE = 5
+    INOUT = 6
+
+
+def aligned_empty(elem_nums, dtype, align=4096):
+    nbytes = elem_nums * np.dtype(dtype).itemsize
+    raw = np.empty(nbytes + align, dtype=np.uint8)
+    offset = -raw.ctypes.data % align
+    return raw[offset:offset + nbytes].view(dtype)
+
 
+# Bounded pool of page-aligned host arrays of elem_nums elements.
+# Arrays are allocated on demand up to capacity, then acquire blocks until
+# an array is released (back-pressure).
+class FHostPool:
 
+    def __init__(self, dtype, elem_nums, capacity):
+        self.dtype = dtype
+        self.elem_nums = elem_nums
+        self.capacity = capacity
+        self.free = deque()
+        self.allocated = 0
+        self.in_use = 0
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.high_water = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while not self.free and self.allocated >= self.capacity:
+                self.waits += 1
+                self.cond.wait()
+            if self.free:
+                array = self.free.pop()
+                self.hits += 1
+            else:
+                array = aligned_empty(self.elem_nums, self.dtype)
+                self.allocated += 1
+                self.misses += 1
+            self.in_use += 1
+            self.high_water = max(self.high_water, self.in_use)
+        return array
+
+    def release(self, array):
+        with self.cond:
+            self.free.append(array)
+            self.in_use -= 1
+            self.cond.notify()
+
+    def stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "waits": self.waits,
+                "high_water": self.high_water}
+
+
+# elem_nums is the maximum number of elements of the buffer, size_from
+# gives the live elements of a launch: the name of a SCALAR (its value) or
+# IN (its length) argument, or a function of the kernel's arguments.
+# Transfers only move the live prefix.
 class FBufferDescriptor:
     def __init__(self,
                  btype,
                  dtype,
                  name,
-                 elem_nums):
+                 elem_nums,
+                 size_from=None,
+                 source=None,
+                 count=False):
         self.btype = btype
         self.dtype = dtype
         self.name = name
         self.elem_size = self.dtype(1).nbytes
         self.elem_nums = elem_nums
+        self.size_from = size_from
+        self.source = source
+        # a SCALAR holding the number of elements of the IN buffers: it is
+        # summed when tuples are batched and cut when they are chunked
+        self.count = count
 
     def size_in_bytes(self):
         return self.elem_size * self.elem_nums
 
+    def live_elems(self, kernel_args, buffer_descriptors):
+        if self.size_from is None:
+            return self.elem_nums
+        if callable(self.size_from):
+            return min(int(self.size_from(kernel_args)), self.elem_nums)
+        for bd, arg in zip(buffer_descriptors, kernel_args):
+            if bd.name == self.size_from:
+                if bd.is_SCALAR():
+                    return min(int(arg), self.elem_nums)
+                return min(len(arg), self.elem_nums)
+        raise RuntimeError("size_from `{}` is not a kernel argument!".format(self.size_from))
+
     def is_IN(self):
         return (self.btype is FBufferType.IN)
 
@@ -199,3 +973,24 @@ class FBufferDescriptor:
 
     def is_SCALAR(self):
         return (self.btype is FBufferType.SCALAR)
+
+    def is_count(self):
+        return (self.is_SCALAR() and self.count)
+
+    def is_OFFSETS(self):
+        return (self.btype is FBufferType.OFFSETS)
+
+    def is_STATE(self):
+        return (self.btype is FBufferType.STATE)
+
+    def is_INOUT(self):
+        return (self.btype is FBufferType.INOUT)
+
+    # STATE or INOUT: a single buffer that persists across the launches
+    def is_persistent(self):
+        return (self.is_STATE() or self.is_INOUT())
+
+    # an IN buffer fed on the device by the OUT buffer `source` of a
+    # previous kernel of the chain
+    def is_chained(self):
+        return (self.btype is FBufferType.IN and self.source is not None)
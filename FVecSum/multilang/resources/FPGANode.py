@@ -1,15 +1,322 @@
 import os
-# import time
+import time
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import storm
 from wurlitzer import pipes
-import pyopencl as cl
 from CLFPGA import *
 from pyopencl import command_execution_status as cs
 # Thread-Safe https://docs.python.org/3/library/collections.html#deque-objects
 from collections import deque
 
 
+# Tuples submitted by a single kernel launch and their pending results.
+# Launches are recycled: the read callbacks are built once per object.
+class FLaunch:
+
+    def __init__(self, callback, nreads):
+        self.nreads = nreads
+        self.lock = threading.Lock()
+        self.callbacks = [functools.partial(callback, self, i)
+                          for i in range(nreads)]
+
+    def reset(self, count, tups, offsets, lane, nbytes, arrivals=None,
+              chunk=None):
+        self.count = count
+        # (FChunkedTuple, index) when the launch is a chunk of a tuple
+        self.chunk = chunk
+        self.tups = tups
+        self.arrivals = arrivals
+        self.offsets = offsets
+        self.lane = lane
+        self.nbytes = nbytes
+        self.results = [None] * self.nreads
+        self.pending = self.nreads
+        self.write_events = []
+        self.kernel_event = None
+        self.read_events = []
+        # slab sub-buffers to give back once the launch is completed
+        self.allocations = []
+        # pooled host arrays backing the results
+        self.arrays = []
+        # host timestamps (ns) of the stages, set by the event callbacks
+        self.submit_ns = 0
+        self.written_ns = 0
+        self.computed_ns = 0
+        return self
+
+    def written(self, status):
+        now = time.perf_counter_ns()
+        with self.lock:
+            self.written_ns = max(self.written_ns, now)
+
+    def computed(self, status):
+        self.computed_ns = time.perf_counter_ns()
+
+    # returns True when the last result of the launch is available
+    def complete(self):
+        with self.lock:
+            self.pending -= 1
+            return self.pending == 0
+
+
+# Reads back the STATE/INOUT buffers (name -> FStateBuffer) of the given
+# descriptors after the commands enqueued so far, as name -> array
+def snapshot_states(device, states, buffer_descriptors):
+    arrays = {}
+    events = []
+    for bd in buffer_descriptors:
+        if bd.name not in arrays:
+            arrays[bd.name] = np.empty(bd.elem_nums, dtype=bd.dtype)
+            events.append(states[bd.name].read(arrays[bd.name]))
+    device.wait_for_events(events)
+    return arrays
+
+
+# Writes the arrays (name -> values) back into the STATE/INOUT buffers,
+# before any later kernel runs
+def restore_states(device, states, buffer_descriptors, arrays):
+    dtypes = {bd.name: bd.dtype for bd in buffer_descriptors}
+    events = []
+    for name, values in arrays.items():
+        if name not in states:
+            raise RuntimeError("`{}` is not a STATE/INOUT buffer!".format(name))
+        values = np.ascontiguousarray(values, dtype=dtypes[name])
+        if values.nbytes > states[name].size:
+            raise RuntimeError("`{}` does not fit its buffer!".format(name))
+        events.append(states[name].write(values))
+    device.wait_for_events(events)
+
+
+# Runs the user's hooks on a pool of threads (NumPy releases the GIL on
+# large arrays) and hands the futures to `consume` in submission order from
+# a single thread, so the tuples keep their order.
+class FOrderedPool:
+
+    def __init__(self, workers, consume):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.consume = consume
+        self.futures = deque()
+        self.pending = threading.Semaphore(0)
+        self.idle = threading.Condition()
+        self.outstanding = 0
+        t = threading.Thread(target=self.run, daemon=True)
+        t.start()
+
+    def submit(self, context, function, *args):
+        with self.idle:
+            self.outstanding += 1
+        self.futures.append((context, self.executor.submit(function, *args)))
+        self.pending.release()
+
+    def run(self):
+        while True:
+            self.pending.acquire()
+            context, future = self.futures.popleft()
+            self.consume(context, future)
+            with self.idle:
+                self.outstanding -= 1
+                if self.outstanding == 0:
+                    self.idle.notify_all()
+
+    # waits for every submitted function to be consumed
+    def drain(self):
+        with self.idle:
+            while self.outstanding > 0:
+                self.idle.wait()
+
+
+# A tuple longer than the buffers, split into chunks launched one after the
+# other: their results are reassembled here, OUTs back to back and INOUTs
+# as left by the last chunk. sizes[i][k] is the live length of the i-th
+# result in the k-th chunk.
+class FChunkedTuple:
+
+    def __init__(self, sizes, dtypes):
+        self.nchunks = len(sizes[0]) if sizes else 0
+        self.pending = self.nchunks
+        self.lock = threading.Lock()
+        self.offsets = [np.cumsum([0] + list(s)) for s in sizes]
+        self.results = [np.empty(o[-1], dtype=dtype)
+                        for o, dtype in zip(self.offsets, dtypes)]
+
+    # copies the results of the k-th chunk, True when it is the last one
+    def add(self, k, results, persistent):
+        for i, r in enumerate(results):
+            if persistent[i]:
+                if k == self.nchunks - 1:
+                    self.results[i] = r.copy()
+            else:
+                off = self.offsets[i][k]
+                self.results[i][off:off + len(r)] = r
+        with self.lock:
+            self.pending -= 1
+            return self.pending == 0
+
+
+# One kernel of a lane, with its own kernel queue and the buffer rings of
+# its arguments. An IN buffer with a source is the OUT buffer of an earlier
+# stage: it is bound to the kernel as it is, without leaving the device.
+class FStage:
+
+    def __init__(self, device, kernel_name, buffer_descriptors, degree,
+                 profile=False, staging=False, slab_size=None, outputs=None,
+                 last=True, queues=None, states=None):
+        # queues: the (write, kernel, read) FQueuePools of the lane, None
+        # for a private in-order queue per buffer ring and for the kernel
+        write_queues, kernel_queues, read_queues = queues or (None, None, None)
+        self.kernel = device.create_kernel(kernel_name, buffer_descriptors)
+        self.kernel_queues = kernel_queues
+        if self.kernel_queues is None:
+            self.kernel_queues = FQueuePool(device, 1, profile)
+        self.buffer_descriptors = buffer_descriptors
+
+        self.buffers = []
+        self.owned = []
+        self.read_buffers = []
+        self.chained_buffers = []
+        self.staging_buffers = []
+        for bd in buffer_descriptors:
+            if bd.is_persistent():
+                # shared by every lane of the device, INOUTs are read back
+                # as OUTs by the last stage
+                if bd.name not in states:
+                    states[bd.name] = FStateBuffer(device,
+                                                   bd.size_in_bytes(),
+                                                   profile)
+                b = states[bd.name]
+                if last and bd.is_INOUT():
+                    self.read_buffers.append((b, bd))
+                self.buffers.append(b)
+                continue
+            elif bd.is_chained():
+                if outputs is None or bd.source not in outputs:
+                    raise RuntimeError("`{}` is not an OUT buffer of a previous kernel!".format(bd.source))
+                self.buffers.append(outputs[bd.source])
+                continue
+            elif bd.is_IN():
+                b = FWriteBuffers(device,
+                                  bd.size_in_bytes(),
+                                  degree,
+                                  profile,
+                                  staging,
+                                  slab_size,
+                                  write_queues)
+                self.staging_buffers.append((b, bd))
+            elif bd.is_OFFSETS():
+                b = FWriteBuffers(device,
+                                  bd.size_in_bytes(),
+                                  degree,
+                                  profile,
+                                  queues=write_queues)
+            elif bd.is_OUT():
+                b = FReadBuffers(device,
+                                 bd.size_in_bytes(),
+                                 degree,
+                                 profile,
+                                 slab_size,
+                                 read_queues)
+                # only the outputs of the last stage are read back
+                if last:
+                    self.read_buffers.append((b, bd))
+                else:
+                    self.chained_buffers.append(b)
+                    outputs[bd.name] = b
+            else:
+                self.buffers.append(None)
+                continue
+            self.buffers.append(b)
+            self.owned.append(b)
+
+
+# A kernel instance (compute unit) of a device, or a chain of them, with
+# their buffer rings. FBoltAsync spreads the launches across its lanes.
+# With out_of_order or a number of queues, the writes, the kernels of each
+# stage and the reads of the lane share pools of command queues, and the
+# commands are ordered only by the events they wait for.
+class FLane:
+
+    def __init__(self, device, kernel_names, stage_descriptors, degree,
+                 profile=False, staging=False, slab_size=None, queues=None,
+                 out_of_order=False, states=None):
+        self.device = device
+        self.degree = degree
+        # events of the last kernel of the chain
+        self.kernel_events = deque()
+
+        write_queues = read_queues = None
+        if queues or out_of_order:
+            queues = queues or 1
+            write_queues = FQueuePool(device, queues, profile, out_of_order)
+            read_queues = FQueuePool(device, queues, profile, out_of_order)
+
+        # staging applies to the inputs of the first stage only
+        outputs = {}
+        self.stages = []
+        for k, (name, bds) in enumerate(zip(kernel_names, stage_descriptors)):
+            stage_queues = None
+            if write_queues is not None:
+                stage_queues = (write_queues,
+                                FQueuePool(device, queues, profile, out_of_order),
+                                read_queues)
+            self.stages.append(FStage(self.device,
+                                      name,
+                                      bds,
+                                      self.degree,
+                                      profile,
+                                      staging and k == 0,
+                                      slab_size,
+                                      outputs,
+                                      k == len(kernel_names) - 1,
+                                      stage_queues,
+                                      states))
+        self.buffers = self.stages[0].buffers
+        self.staging_buffers = self.stages[0].staging_buffers
+        self.read_buffers = self.stages[-1].read_buffers
+        self.owned = [b for stage in self.stages for b in stage.owned]
+
+        # input bytes launched and not yet read back
+        self.outstanding = 0
+        # when the last launch was read back
+        self.completed_ns = 0
+        self.lock = threading.Lock()
+
+    def pop_oldest_event(self):
+        if len(self.kernel_events) == self.degree:
+            return self.kernel_events.popleft()
+        return None
+
+    def add_outstanding(self, nbytes):
+        with self.lock:
+            self.outstanding += nbytes
+
+    # time spent by the lane on a launch: from its submission, or from the
+    # completion of the previous one if the launch was queued behind it
+    def service_ns(self, launch):
+        now = time.perf_counter_ns()
+        with self.lock:
+            start = max(launch.submit_ns, self.completed_ns)
+            self.completed_ns = now
+        return now - start
+
+    # drains the in-flight window and resizes every buffer ring
+    def resize(self, degree):
+        for b in self.owned:
+            b.resize(degree)
+        for stage in self.stages:
+            stage.kernel_queues.finish()
+        self.kernel_events.clear()
+        self.degree = degree
+
+    def finish(self):
+        for b, bd in self.read_buffers:
+            b.finish()
+        for stage in self.stages:
+            stage.kernel_queues.finish()
+
+
 class FBoltAsync(storm.Bolt):
 
     def __init__(self,
@@ -18,157 +325,908 @@ class FBoltAsync(storm.Bolt):
                  buffer_descriptors=None,
                  degree=1,
                  emulator=False,
-                 profile=False):
+                 profile=False,
+                 device=None,
+                 staging=False,
+                 batch_size=1,
+                 batch_bytes=None,
+                 batch_linger_us=None,
+                 writer_max_msgs=64,
+                 writer_max_delay_us=1000,
+                 min_degree=None,
+                 max_degree=None,
+                 adapt_interval=256,
+                 ordered=True,
+                 slab_size=None,
+                 pool_size=None,
+                 latency_interval_s=10,
+                 high_watermark=None,
+                 low_watermark=None,
+                 queues=None,
+                 out_of_order=False,
+                 workers=None,
+                 snapshot_interval_s=None,
+                 host_kernel=None,
+                 host_threshold=None):
 
+        start = time.perf_counter()
         self.emulator = emulator
         if self.emulator:
             os.environ['XCL_EMULATION_MODE'] = 'sw_emu'
 
+        # adaptive pipeline depth within [min_degree, max_degree],
+        # it measures the stages through the profiled events
+        self.controller = None
+        if min_degree is not None and max_degree is not None:
+            self.controller = FDepthController(degree,
+                                               min_degree,
+                                               max_degree,
+                                               adapt_interval)
+        profile_queues = profile or self.controller is not None
+
         with pipes() as (out, err):
-            self.xilinx = CLXilinxDevice(xclbin_filepath)
-            self.kernel = cl.Kernel(self.xilinx.program, kernel_name)
-            self.kernel_queue = cl.CommandQueue(self.xilinx.context)
+            # defaults to the Xilinx OpenCL backend, a list of devices
+            # spreads the tuples across all of them
+            if device is None:
+                device = CLXilinxDevice(xclbin_filepath)
+            self.devices = device if isinstance(device, list) else [device]
+            self.device = self.devices[0]
 
             self.degree = degree
-            self.kernel_events = deque()
 
-            self.tuples = deque()
-            self.buffer_descriptors = buffer_descriptors
-            self.buffers = []
-            self.read_buffers = {}
-            for bd in buffer_descriptors:
-                if bd.is_IN():
-                    b = FWriteBuffers(self.xilinx.context,
-                                      bd.size_in_bytes(),
-                                      self.degree,
-                                      profile)
-                    self.buffers.append(b)
-                elif bd.is_OUT():
-                    b = FReadBuffers(self.xilinx.context,
-                                     bd.size_in_bytes(),
-                                     self.degree,
-                                     profile)
-                    self.buffers.append(b)
-                    # contains references to not yet read buffers
-                    self.read_buffers[bd.name] = deque()
-                else:
-                    self.buffers.append(None)
+            # staging slots are refilled by the next tuple, so they cannot
+            # hold the tuples of a pending batch (nor of the workers)
+            self.staging = staging and batch_size == 1 and not workers
 
-            scalar_dtypes = []
-            for bd in self.buffer_descriptors:
-                if bd.is_SCALAR():
-                    scalar_dtypes.append(bd.dtype)
-                else:
-                    scalar_dtypes.append(None)
-            self.kernel.set_scalar_arg_dtypes(scalar_dtypes)
+            # a chain of kernels: kernel_name is a list of names and
+            # buffer_descriptors a list with the descriptors of each kernel,
+            # prepare_compute returns the list of arguments of each kernel
+            self.chained = isinstance(kernel_name, (list, tuple))
+            kernel_names = [kernel_name]
+            stage_descriptors = [buffer_descriptors]
+            if self.chained:
+                if batch_size > 1:
+                    raise RuntimeError("A chain of kernels cannot be batched!")
+                kernel_names = list(kernel_name)
+                stage_descriptors = list(buffer_descriptors)
+            self.buffer_descriptors = stage_descriptors[0]
+            self.out_descriptors = stage_descriptors[-1]
+
+            # STATE/INOUT buffers, by name, are shared by the lanes of a
+            # device: the state cannot be split across devices
+            self.persistent = [bd for bds in stage_descriptors for bd in bds
+                               if bd.is_persistent()]
+            if self.persistent and len(self.devices) > 1:
+                raise RuntimeError("STATE/INOUT buffers need a single device!")
+            self.states = {}
+            self.state_lock = threading.Lock()
+
+            # one lane per compute unit of every device, the i-th lane of a
+            # chain uses the i-th compute unit of each kernel
+            self.lanes = []
+            for d in self.devices:
+                units = [d.compute_units(name) for name in kernel_names]
+                for names in zip(*units):
+                    self.lanes.append(FLane(d,
+                                            list(names),
+                                            stage_descriptors,
+                                            self.degree,
+                                            profile_queues,
+                                            self.staging,
+                                            slab_size,
+                                            queues,
+                                            out_of_order,
+                                            self.states))
+            self.next_lane = None
+            self.rr = 0
+
+            # bounded pools of host arrays for the results, one per OUT
+            # buffer, and recycled launches
+            if pool_size is None:
+                pool_size = 2 * max(degree, max_degree or 0) * len(self.lanes)
+            self.pools = [FHostPool(bd.dtype, bd.elem_nums, pool_size)
+                          for bd in self.out_descriptors
+                          if bd.is_OUT() or bd.is_INOUT()]
+            self.pool_names = [bd.name for bd in self.out_descriptors
+                               if bd.is_OUT() or bd.is_INOUT()]
+            self.persistent_results = [bd.is_INOUT()
+                                       for bd in self.out_descriptors
+                                       if bd.is_OUT() or bd.is_INOUT()]
+            self.free_launches = deque()
+
+            # credit-based back-pressure: once high_watermark tuples are in
+            # flight, process() stops returning (so stdin is not read and
+            # the ShellBolt queue fills up) until they drop to low_watermark
+            if high_watermark is None:
+                high_watermark = pool_size * batch_size
+            if low_watermark is None:
+                low_watermark = high_watermark // 2
+            self.high_watermark = max(high_watermark, batch_size)
+            self.low_watermark = min(low_watermark, self.high_watermark - 1)
+            self.in_flight = 0
+            self.credit_cond = threading.Condition()
+            # saturation episodes and time blocked, since the last report
+            self.saturated = 0
+            self.blocked_ns = 0
+
+            # results are emitted in tuple order, or in completion order:
+            # launches are tracked by their sequence id (count), so they
+            # can complete in any order across lanes and queues
+            self.ordered = ordered
+            self.completed = {}
+            self.next_emit = 0
+            self.emit_lock = threading.Lock()
 
             self.count = 0
             self.profile = profile
             if self.profile:
                 self.profilingManager = CLProfilingManager()
 
-    def pop_oldest_event(self):
-        if len(self.kernel_events) == self.degree:
-            return self.kernel_events.popleft()
-        return None
+            # latency histograms of the stages, timed on the host through
+            # the event callbacks and reported every latency_interval_s
+            # (with the saturation and the statistics of the host pools and
+            # of the routing)
+            self.latency = None
+            self.report_interval_s = latency_interval_s
+            if latency_interval_s is not None:
+                self.latency = FLatencyRecorder(["decode", "queue", "h2d",
+                                                 "kernel", "d2h", "encode",
+                                                 "end2end"],
+                                                latency_interval_s)
+
+            # micro-batching: tuples are packed back to back into the same
+            # buffer slots and flushed on count, bytes or linger deadline
+            self.batch_size = batch_size
+            self.batch_bytes = batch_bytes
+            if self.batch_bytes is None:
+                self.batch_bytes = sum([bd.size_in_bytes()
+                                        for bd in self.buffer_descriptors
+                                        if bd.is_IN()])
+            self.batch_linger_us = batch_linger_us
+            self.batch = []
+            self.batch_nbytes = 0
+            self.batch_deadline = None
+            self.batch_cond = threading.Condition()
+            if self.batch_size > 1 and self.batch_linger_us is not None:
+                t = threading.Thread(target=self.linger_loop, daemon=True)
+                t.start()
+
+            # hybrid routing: launches smaller than a threshold (in input
+            # bytes) run on the host through host_kernel, the NumPy
+            # implementation of the kernel called as the kernels of
+            # NPDevice. The threshold is calibrated by initialize() (or by
+            # the first live launches of both paths) and kept current by
+            # the live timings (None), or fixed.
+            self.host_kernel = host_kernel
+            self.router = None
+            if self.host_kernel is not None:
+                if self.chained or self.persistent:
+                    raise RuntimeError("Host routing needs a single kernel without STATE/INOUT buffers!")
+                self.router = FRouter(host_threshold,
+                                      sum([bd.size_in_bytes()
+                                           for bd in self.buffer_descriptors
+                                           if bd.is_IN()]))
 
+            # prepare_compute and prepare_emit run on `workers` threads:
+            # the next tuples are decoded and prepared while the device
+            # works, launches and emits keep the order of the tuples
+            self.compute_pool = None
+            self.emit_pool = None
+            if workers:
+                self.compute_pool = FOrderedPool(workers, self.prepared)
+                self.emit_pool = FOrderedPool(workers, self.emit_prepared)
+
+            # the state is read back and handed to checkpoint() every
+            # snapshot_interval_s
+            self.snapshot_interval_s = snapshot_interval_s
+            if self.persistent and self.snapshot_interval_s is not None:
+                t = threading.Thread(target=self.snapshot_loop, daemon=True)
+                t.start()
+
+            # emit/ack/fail are written by a dedicated writer thread
+            self.writer_max_msgs = writer_max_msgs
+            self.writer_max_delay_us = writer_max_delay_us
+
+            # binary framing decodes the input arrays in the staging slots
+            if self.staging:
+                storm.setArrayDecoder(self.decode_array)
+
+            # startup times, reported with the first launch: the devices
+            # tell whether their programs came from a cache (warm start)
+            self.startup = {"devices": [getattr(d, "startup", {})
+                                        for d in self.devices],
+                            "bolt_ms": 1e3 * (time.perf_counter() - start)}
+
+    # Least-outstanding-work scheduler: the lane with the fewest input bytes
+    # in flight (ties are broken round robin). The lane is chosen once per
+    # tuple, before decoding, so that staging lands in the right rings.
+    def select_lane(self):
+        if self.next_lane is None:
+            # the depth changes between two tuples, before the next one is
+            # staged: resizing resets the staging slots of the rings
+            if (self.controller is not None
+                    and self.controller.degree != self.degree):
+                self.resize(self.controller.degree)
+            n = len(self.lanes)
+            self.rr = (self.rr + 1) % n
+            self.next_lane = min([self.lanes[(self.rr + i) % n]
+                                  for i in range(n)],
+                                 key=lambda lane: lane.outstanding)
+        return self.next_lane
+
+    # Decodes the index-th array of an incoming message directly in the
+    # staging slot of the index-th IN buffer (binary framing only)
+    def decode_array(self, index, dtype, data):
+        lane = self.select_lane()
+        if index >= len(lane.staging_buffers):
+            return None
+        b, bd = lane.staging_buffers[index]
+        elem_nums = len(data) // dtype.itemsize
+        if dtype != bd.dtype or elem_nums > bd.elem_nums:
+            return None
+        staged = b.next_staging(bd.dtype, elem_nums)
+        staged[:] = np.frombuffer(data, dtype=dtype)
+        return staged
+
+    # Returns the values of the i-th kernel argument (FBufferType.IN) as an
+    # array ready to be written, placing them in the staging slot if needed
+    # (values longer than the buffer are split in chunks, not staged)
+    def stage(self, i, values):
+        bd = self.buffer_descriptors[i]
+        if not self.staging or len(values) > bd.elem_nums:
+            return np.asarray(values, dtype=bd.dtype)
+        b = self.select_lane().buffers[i]
+        if values is b.staged:
+            return values
+        staged = b.next_staging(bd.dtype, len(values))
+        staged[:] = values
+        return staged
+
+    def run(self):
+        if self.writer_max_msgs is not None:
+            storm.startWriter(self.writer_max_msgs, self.writer_max_delay_us)
+        super().run()
+
+    # after the handshake, before the first tuple is read
+    def initialize(self, stormconf, context):
+        if self.router is not None and not self.router.calibrated:
+            self.calibrate()
+
+    # the parent does not reply with the task ids: only the main thread
+    # reads stdin, so the emitting threads could not wait for them
     def emit(self, tup, anchors=[]):
-        m = {"command": "emit"}
-        m["anchors"] = [a.id for a in anchors]
-        m["tuple"] = tup
-        storm.sendMsgToParent(m)
-        # return storm.readTaskIds()
+        storm.emitBolt(tup, anchors=anchors, need_task_ids=False)
+
+    def emit_and_ack(self, tup, results):
+        output = self.prepare_emit(tup, results)
+        self.emit_output(tup, output)
+
+    def emit_output(self, tup, output):
+        try:
+            self.emit(output, anchors=[tup])
+            storm.ack(tup)
+        except Exception:
+            self.fail(tup)
 
-    def reading_callback(self, status, event, count, data, bd):
+    # reports the exception being handled and fails the tuple
+    def fail(self, tup):
+        storm.reportError(storm.traceback.format_exc())
+        storm.fail(tup)
+
+    def reading_callback(self, launch, i, status):
         if status == cs.COMPLETE:
-            self.read_buffers[bd.name].append(data)
-
-            once = True
-            for v in self.read_buffers.values():
-                if len(v) == 0:
-                    once = False
-                    break
-
-            if once:
-                if self.profile:
-                    self.profilingManager.end(count, event)
-
-                results = []
-                for v in self.read_buffers.values():
-                    results.append(v.popleft())
-
-                tup = self.tuples.popleft()
-                output = self.prepare_emit(tup, results)
-                try:
-                    self.emit(output, anchors=[tup])
-                    storm.ack(tup)
-                except Exception:
-                    storm.reportError(storm.traceback.format_exc())
-                    storm.fail(tup)
+            # results are bound to their launch, not to the callback order
+            if not launch.complete():
+                return
+
+            if self.profile:
+                self.profilingManager.end(launch.count, launch.read_events[i])
+
+            if self.controller is not None:
+                self.controller.update(launch.write_events,
+                                       launch.kernel_event,
+                                       launch.read_events)
+
+            if self.router is not None:
+                self.router.record(FRouter.DEVICE, launch.nbytes,
+                                   launch.lane.service_ns(launch),
+                                   len(launch.tups))
+
+            launch.lane.add_outstanding(-launch.nbytes)
+            for b, allocation in launch.allocations:
+                b.release(allocation)
+
+            self.complete_launch(launch)
+
+    # the results of the launch are available, on the device or the host
+    def complete_launch(self, launch):
+        if self.latency is not None and launch.tups:
+            self.record_stages(launch)
+
+        if not self.ordered:
+            self.emit_launch(launch)
+            return
+
+        # reorder buffer: launches are emitted in submission order
+        with self.emit_lock:
+            self.completed[launch.count] = launch
+            while self.next_emit in self.completed:
+                self.emit_launch(self.completed.pop(self.next_emit))
+                self.next_emit += 1
+
+    def record_stages(self, launch):
+        # callbacks may be delivered late or out of order: the stamps are
+        # clamped to the order of the stages
+        now = time.perf_counter_ns()
+        computed = min(launch.computed_ns or now, now)
+        written = min(max(launch.written_ns, launch.submit_ns), computed)
+        self.latency.record("h2d", written - launch.submit_ns)
+        self.latency.record("kernel", computed - written)
+        self.latency.record("d2h", now - computed)
+
+    def emit_launch(self, launch):
+        if launch.chunk is not None:
+            self.emit_chunk(launch)
+            return
+        for j, results in enumerate(self.split_results(launch)):
+            if self.emit_pool is None:
+                self.emit_timed(launch, j, self.emit_and_ack, results)
+            else:
+                self.emit_pool.submit((launch, j), self.prepare_emit,
+                                      launch.tups[j], results)
+        if self.emit_pool is None or not launch.tups:
+            self.release_launch(launch)
+
+    # the results of each tuple of the launch
+    def split_results(self, launch):
+        if launch.offsets is None:
+            return [launch.results]
+        # split the packed results back into per-tuple views
+        offsets = launch.offsets
+        split = []
+        for j in range(len(launch.tups)):
+            off = offsets[1 + 2 * j]
+            size = offsets[2 + 2 * j]
+            split.append([r[off:off + size] for r in launch.results])
+        return split
+
+    # prepare_emit of the j-th tuple of the launch ran on the workers
+    def emit_prepared(self, context, future):
+        launch, j = context
+        try:
+            output = future.result()
+        except Exception:
+            self.fail(launch.tups[j])
+        else:
+            self.emit_timed(launch, j, self.emit_output, output)
+        if j == len(launch.tups) - 1:
+            self.release_launch(launch)
+
+    # the tuple of a chunk is emitted (and acked) with its last chunk
+    def emit_chunk(self, launch):
+        chunked, k = launch.chunk
+        if not chunked.add(k, launch.results, self.persistent_results):
+            self.release_launch(launch, 0)
+            return
+        if self.emit_pool is None:
+            self.emit_timed(launch, 0, self.emit_and_ack, chunked.results)
+            self.release_launch(launch)
+        else:
+            self.emit_pool.submit((launch, 0), self.prepare_emit,
+                                  launch.tups[0], chunked.results)
+
+    def release_launch(self, launch, tuples=None):
+        # emits are already serialized: the host arrays can be reused
+        for pool, array in zip(self.pools, launch.arrays):
+            pool.release(array)
+        self.free_launches.append(launch)
+
+        if tuples is None:
+            tuples = len(launch.tups)
+        with self.credit_cond:
+            self.in_flight -= tuples
+            if self.in_flight <= self.low_watermark:
+                self.credit_cond.notify()
+
+    def emit_timed(self, launch, j, emit, values):
+        if self.latency is None:
+            emit(launch.tups[j], values)
+            return
+        start = time.perf_counter_ns()
+        emit(launch.tups[j], values)
+        end = time.perf_counter_ns()
+        self.latency.record("encode", end - start)
+        self.latency.record("end2end", end - launch.arrivals[j])
+
+    def report_loop(self):
+        while True:
+            time.sleep(self.report_interval_s)
+            if self.latency is not None:
+                storm.rpcMetrics("fbolt-latency", self.latency.snapshot())
+            if self.router is not None:
+                storm.rpcMetrics("fbolt-routing", self.router.snapshot())
+            storm.rpcMetrics("fbolt-saturation", self.saturation())
+            storm.rpcMetrics("fbolt-pool", {name: pool.stats()
+                                            for name, pool in zip(self.pool_names,
+                                                                  self.pools)})
 
     def process(self, tup):
-        self.tuples.append(tup)
-        kernel_args = self.prepare_compute(tup)
+        start = time.perf_counter_ns()
+        # the tuple arrived when its message started to be decoded
+        arrival = start - storm.DECODE_NS
+        with self.credit_cond:
+            self.in_flight += 1
+        if self.compute_pool is not None:
+            if self.latency is not None:
+                self.latency.record("decode", start - arrival)
+            self.compute_pool.submit((tup, arrival), self.prepare_compute, tup)
+        else:
+            kernel_args = self.prepare_compute(tup)
+            if self.latency is not None:
+                self.latency.record("decode", time.perf_counter_ns() - arrival)
+            self.dispatch(tup, kernel_args, arrival)
 
-        oldest_kernel_event = self.pop_oldest_event()
+        if self.in_flight >= self.high_watermark:
+            self.wait_credits()
 
-        wait_events = []
-        for i, b, bd, arg in zip(range(len(kernel_args)),
-                                 self.buffers,
-                                 self.buffer_descriptors,
-                                 kernel_args):
+    def dispatch(self, tup, kernel_args, arrival):
+        if self.oversized(kernel_args):
+            with self.batch_cond:
+                self.flush()
+                self.launch_chunks(tup, kernel_args, arrival)
+            return
+        if self.batch_size > 1:
+            with self.batch_cond:
+                self.batch_append(tup, kernel_args, arrival)
+        else:
+            self.launch([tup], kernel_args, arrivals=[arrival])
+
+    # prepare_compute of a tuple ran on the workers
+    def prepared(self, context, future):
+        tup, arrival = context
+        try:
+            kernel_args = future.result()
+        except Exception:
+            self.fail(tup)
+            with self.credit_cond:
+                self.in_flight -= 1
+                self.credit_cond.notify()
+            return
+        self.dispatch(tup, kernel_args, arrival)
+
+    # Blocks until the tuples in flight drop to the low watermark, the
+    # episodes and the time blocked are reported by report_loop
+    def wait_credits(self):
+        # the pending batch may be needed to release the credits
+        if self.compute_pool is not None:
+            self.compute_pool.drain()
+        with self.batch_cond:
+            self.flush()
+        start = time.perf_counter_ns()
+        with self.credit_cond:
+            while self.in_flight > self.low_watermark:
+                self.credit_cond.wait()
+            self.saturated += 1
+            self.blocked_ns += time.perf_counter_ns() - start
+
+    # the saturation since the last report
+    def saturation(self):
+        with self.credit_cond:
+            report = {"saturated": self.saturated,
+                      "blocked_us": 1e-3 * self.blocked_ns,
+                      "in_flight": self.in_flight}
+            self.saturated = 0
+            self.blocked_ns = 0
+        return report
+
+    def batch_append(self, tup, kernel_args, arrival):
+        nbytes = sum([arg.nbytes
+                      for bd, arg in zip(self.buffer_descriptors, kernel_args)
+                      if bd.is_IN()])
+        # flush first if this tuple does not fit in the current batch
+        if self.batch and not self.batch_fits(kernel_args, nbytes):
+            self.flush()
+
+        self.batch.append((tup, kernel_args, arrival))
+        self.batch_nbytes += nbytes
+        if len(self.batch) == 1 and self.batch_linger_us is not None:
+            self.batch_deadline = (time.perf_counter()
+                                   + 1e-6 * self.batch_linger_us)
+            self.batch_cond.notify()
+
+        if (len(self.batch) >= self.batch_size
+                or self.batch_nbytes >= self.batch_bytes):
+            self.flush()
+
+    def batch_fits(self, kernel_args, nbytes):
+        if self.batch_nbytes + nbytes > self.batch_bytes:
+            return False
+        # the other SCALARs are passed once for the whole batch
+        _, first, _ = self.batch[0]
+        for i, bd in enumerate(self.buffer_descriptors):
+            if (bd.is_SCALAR() and not bd.is_count()
+                    and kernel_args[i] != first[i]):
+                return False
+        for i, bd in enumerate(self.buffer_descriptors):
             if bd.is_IN():
-                b.next()
-                wait_events.append(b.write(arg, oldest_kernel_event))
-                self.kernel.set_arg(i, b.current())
-            elif bd.is_OUT():
-                b.next()
-                self.kernel.set_arg(i, b.current())
-                oldest_event = b.pop_oldest_event()
-                if oldest_event:
-                    wait_events.append(oldest_event)
+                elems = sum([len(args[i]) for _, args, _ in self.batch])
+                if elems + len(kernel_args[i]) > bd.elem_nums:
+                    return False
+        return True
+
+    def linger_loop(self):
+        with self.batch_cond:
+            while True:
+                if not self.batch:
+                    self.batch_cond.wait()
+                    continue
+                remaining = self.batch_deadline - time.perf_counter()
+                if remaining > 0:
+                    self.batch_cond.wait(remaining)
+                    continue
+                self.flush()
+
+    def oversized(self, kernel_args):
+        args = kernel_args[0] if self.chained else kernel_args
+        for bd, arg in zip(self.buffer_descriptors, args):
+            if bd.is_IN() and not bd.is_chained() and len(arg) > bd.elem_nums:
+                if self.chained:
+                    raise RuntimeError("A chain of kernels cannot split a tuple in chunks!")
+                return True
+        return False
+
+    # Splits a tuple longer than the buffers into consecutive launches, as
+    # the batches the kernel is expected to be element-wise: the longest IN
+    # arguments are sliced in chunks that fit all their buffers, the other
+    # IN arguments and the SCALARs are passed to every chunk as they are,
+    # but the element counts (count=True) equal to the length of the tuple
+    # become the chunk length.
+    def launch_chunks(self, tup, kernel_args, arrival):
+        total = max([len(arg)
+                     for bd, arg in zip(self.buffer_descriptors, kernel_args)
+                     if bd.is_IN()])
+        chunk_elems = None
+        for bd, arg in zip(self.buffer_descriptors, kernel_args):
+            if bd.is_IN() and len(arg) == total:
+                chunk_elems = min(chunk_elems or bd.elem_nums, bd.elem_nums)
+            elif bd.is_IN() and len(arg) > bd.elem_nums:
+                raise RuntimeError("IN arguments longer than their buffers must have the same length!")
+
+        chunks = []
+        for start in range(0, total, chunk_elems):
+            size = min(chunk_elems, total - start)
+            args = []
+            for bd, arg in zip(self.buffer_descriptors, kernel_args):
+                if bd.is_IN() and len(arg) == total:
+                    args.append(arg[start:start + size])
+                elif bd.is_count() and arg == total:
+                    args.append(bd.dtype(size))
+                else:
+                    args.append(arg)
+            chunks.append(args)
+
+        outs = [bd for bd in self.out_descriptors
+                if bd.is_OUT() or bd.is_INOUT()]
+        sizes = [[0 if bd.is_INOUT()
+                  else bd.live_elems(args, self.out_descriptors)
+                  for args in chunks] for bd in outs]
+        chunked = FChunkedTuple(sizes, [bd.dtype for bd in outs])
+        for k, args in enumerate(chunks):
+            self.launch([tup], args, arrivals=[arrival], chunk=(chunked, k))
+
+    # Packs the pending batch into a single kernel launch.
+    # IN arguments are concatenated, the SCALAR element counts (count=True)
+    # are summed, the other SCALARs must be equal in the whole batch, and
+    # the OFFSETS argument receives [n, offset_0, length_0, ...,
+    # offset_n-1, length_n-1] computed on the first IN argument.
+    def flush(self):
+        if not self.batch:
+            return
+
+        tups = [tup for tup, _, _ in self.batch]
+        args_list = [args for _, args, _ in self.batch]
+        arrivals = [arrival for _, _, arrival in self.batch]
+        self.batch = []
+        self.batch_nbytes = 0
+        self.batch_deadline = None
+
+        if len(tups) == 1:
+            self.launch(tups, args_list[0], arrivals=arrivals)
+            return
+
+        kernel_args = []
+        for i, bd in enumerate(self.buffer_descriptors):
+            if bd.is_IN():
+                kernel_args.append(np.concatenate([args[i]
+                                                   for args in args_list]))
+            elif bd.is_count():
+                kernel_args.append(bd.dtype(sum([args[i]
+                                                 for args in args_list])))
             elif bd.is_SCALAR():
-                self.kernel.set_arg(i, arg)
+                if any([args[i] != args_list[0][i] for args in args_list]):
+                    raise RuntimeError("SCALAR `{}` differs within a batch, is it an element count (count=True)?".format(bd.name))
+                kernel_args.append(args_list[0][i])
             else:
-                raise RuntimeError("bd.btype is unknown or not implemented!")
+                kernel_args.append(None)
 
-        if self.profile:
-            self.profilingManager.start(self.count, wait_events)
+        first = self.first_in_index()
+        lengths = [len(args[first]) for args in args_list]
+        self.launch(tups, kernel_args, self.make_offsets(lengths), arrivals)
 
-        gws = lws = (1, 1, 1)
-        event = cl.enqueue_nd_range_kernel(self.kernel_queue,
-                                           self.kernel,
-                                           gws, lws,
-                                           wait_for=wait_events)
-        self.kernel_events.append(event)
+    def make_offsets(self, lengths):
+        offsets = np.empty(1 + 2 * len(lengths), dtype=np.int32)
+        offsets[0] = len(lengths)
+        offsets[2::2] = lengths
+        offsets[1::2] = np.cumsum(lengths) - lengths
+        return offsets
 
-        for b, bd in zip(self.buffers, self.buffer_descriptors):
-            if bd.is_OUT():
-                data = np.empty(bd.elem_nums, dtype=bd.dtype)
+    def first_in_index(self, buffer_descriptors=None):
+        if buffer_descriptors is None:
+            buffer_descriptors = self.buffer_descriptors
+        for i, bd in enumerate(buffer_descriptors):
+            if bd.is_IN():
+                return i
+        raise RuntimeError("at least one FBufferType.IN buffer is required!")
+
+    # The STATE/INOUT buffers after the launches submitted so far
+    def snapshot(self):
+        with self.state_lock:
+            return snapshot_states(self.device, self.states, self.persistent)
+
+    def restore(self, arrays):
+        with self.state_lock:
+            restore_states(self.device, self.states, self.persistent, arrays)
+
+    def snapshot_loop(self):
+        while True:
+            time.sleep(self.snapshot_interval_s)
+            self.checkpoint(self.snapshot())
+
+    # Applies the depth chosen by the controller to every lane
+    def resize(self, degree):
+        for lane in self.lanes:
+            lane.resize(degree)
+        self.degree = degree
+        storm.rpcMetrics("fbolt-depth", self.degree)
+
+    def launch(self, tups, kernel_args, offsets=None, arrivals=None,
+               chunk=None):
+        if self.count == 0:
+            storm.rpcMetrics("fbolt-startup", self.startup)
+        if self.report_interval_s is not None and self.count == 0:
+            t = threading.Thread(target=self.report_loop, daemon=True)
+            t.start()
+        if self.controller is not None and self.count == 0:
+            storm.rpcMetrics("fbolt-depth", self.degree)
+
+        nbytes = sum([arg.nbytes
+                      for bd, arg in zip(self.buffer_descriptors,
+                                         kernel_args[0] if self.chained else kernel_args)
+                      if bd.is_IN()])
+        if self.router is not None and tups:
+            if self.router.route(nbytes) == FRouter.HOST:
+                self.launch_host(tups, kernel_args, offsets, arrivals, nbytes,
+                                 chunk)
+                return
+
+        lane = self.select_lane()
+        self.next_lane = None
+        lane.add_outstanding(nbytes)
+        launch = self.new_launch(tups, offsets, lane, nbytes, arrivals, chunk)
+
+        # the commands on the STATE/INOUT buffers are chained in launch
+        # order, snapshot and restore cannot slip in between
+        with self.state_lock:
+            stage_args = kernel_args if self.chained else [kernel_args]
+            oldest_kernel_event = lane.pop_oldest_event()
+
+            gws = lws = (1, 1, 1)
+            event = None
+            for k, stage, args in zip(range(len(lane.stages)), lane.stages, stage_args):
+                wait_events = []
+                if event is not None:
+                    # the previous kernel of the chain
+                    wait_events.append(event)
+                write_events = []
+                states = []
+                for i, b, bd, arg in zip(range(len(args)),
+                                         stage.buffers,
+                                         stage.buffer_descriptors,
+                                         args):
+                    if bd.is_persistent():
+                        stage.kernel.set_arg(i, b.current())
+                        wait_events.extend(b.depend())
+                        states.append(b)
+                    elif bd.is_chained():
+                        stage.kernel.set_arg(i, b.current())
+                    elif bd.is_IN():
+                        b.next(arg.nbytes)
+                        write_events.append(b.write(arg, oldest_kernel_event))
+                        stage.kernel.set_arg(i, b.current())
+                    elif bd.is_OFFSETS():
+                        if offsets is None:
+                            first = args[self.first_in_index(stage.buffer_descriptors)]
+                            arg = self.make_offsets([len(first)])
+                        else:
+                            arg = offsets
+                        b.next()
+                        write_events.append(b.write(arg, oldest_kernel_event))
+                        stage.kernel.set_arg(i, b.current())
+                    elif bd.is_OUT():
+                        b.next(bd.live_elems(args, stage.buffer_descriptors)
+                               * bd.elem_size)
+                        stage.kernel.set_arg(i, b.current())
+                        oldest_event = b.pop_oldest_event()
+                        if oldest_event:
+                            wait_events.append(oldest_event)
+                    elif bd.is_SCALAR():
+                        stage.kernel.set_arg(i, arg)
+                    else:
+                        raise RuntimeError("bd.btype is unknown or not implemented!")
+                wait_events.extend(write_events)
+                launch.write_events.extend(write_events)
+
+                if self.profile and k == 0:
+                    self.profilingManager.start(self.count, wait_events)
+
+                event = lane.device.enqueue_kernel(stage.kernel_queues.next(),
+                                                   stage.kernel,
+                                                   gws, lws,
+                                                   wait_for=wait_events)
+                for b in states:
+                    b.touched(event)
+
+            if self.latency is not None:
+                for evt in launch.write_events:
+                    evt.set_callback(cs.COMPLETE, launch.written)
+
+            lane.kernel_events.append(event)
+            launch.kernel_event = event
+            if self.latency is not None:
+                event.set_callback(cs.COMPLETE, launch.computed)
+
+            # the outputs fed to the next kernels are free again once the
+            # whole chain is completed
+            for stage in lane.stages:
+                for b in stage.chained_buffers:
+                    b.events.append(event)
+
+            for b in lane.owned:
+                if b.slab is not None:
+                    launch.allocations.append((b, b.allocation))
+
+            # only the live prefix of the outputs is read back,
+            # into host arrays taken from the pools
+            for i, (b, bd) in enumerate(lane.read_buffers):
+                array = self.pools[i].acquire()
+                data = array[0:bd.live_elems(stage_args[-1], self.out_descriptors)]
+                launch.arrays.append(array)
+                launch.results[i] = data
                 evt = b.read(data, [event])
-                evt.set_callback(cs.COMPLETE,
-                                 lambda _status, _event=evt, _count=self.count, _data=data, _bd=bd:
-                                 self.reading_callback(_status, _event, _count, _data, _bd))
+                launch.read_events.append(evt)
+                evt.set_callback(cs.COMPLETE, launch.callbacks[i])
+        self.count += 1
+
+    def new_launch(self, tups, offsets, lane, nbytes, arrivals, chunk=None):
+        if self.free_launches:
+            launch = self.free_launches.popleft()
+        else:
+            launch = FLaunch(self.reading_callback, len(self.pools))
+        launch.reset(self.count, tups, offsets, lane, nbytes, arrivals, chunk)
+        launch.submit_ns = time.perf_counter_ns()
+        if self.latency is not None:
+            if arrivals is None:
+                launch.arrivals = arrivals = [launch.submit_ns] * len(tups)
+            for arrival in arrivals:
+                self.latency.record("queue", launch.submit_ns - arrival)
+        return launch
+
+    # Runs the launch on the host: its results take the same way (pools,
+    # reorder buffer, emits and acks) as the results read back
+    def launch_host(self, tups, kernel_args, offsets, arrivals, nbytes,
+                    chunk=None):
+        # the lane chosen for staging is released as by a device launch
+        self.next_lane = None
+        launch = self.new_launch(tups, offsets, None, nbytes, arrivals, chunk)
+        launch.arrays = [pool.acquire() for pool in self.pools]
+        launch.results = self.compute_host(kernel_args, offsets, launch.arrays)
+        launch.written_ns = launch.submit_ns
+        launch.computed_ns = time.perf_counter_ns()
+        self.router.record(FRouter.HOST, nbytes,
+                           launch.computed_ns - launch.submit_ns, len(tups))
         self.count += 1
+        self.complete_launch(launch)
+
+    # Calls host_kernel with the OUT buffers backed by arrays, returns the
+    # live prefix of each output
+    def compute_host(self, kernel_args, offsets, arrays):
+        args = []
+        outs = iter(arrays)
+        for bd, arg in zip(self.buffer_descriptors, kernel_args):
+            if bd.is_OUT():
+                args.append(next(outs))
+            elif bd.is_OFFSETS():
+                if offsets is None:
+                    first = kernel_args[self.first_in_index()]
+                    offsets = self.make_offsets([len(first)])
+                args.append(offsets)
+            else:
+                args.append(arg)
+        self.host_kernel(*args)
+        return [array[0:bd.live_elems(kernel_args, self.buffer_descriptors)]
+                for array, bd in zip(arrays, [bd for bd in self.buffer_descriptors
+                                              if bd.is_OUT()])]
+
+    # Times both paths on zeroed inputs from the full buffers down to a few
+    # elements (the element counts follow, the other SCALARs are zero),
+    # then sets the first threshold. The device probes are launches
+    # without tuples, one at a time, so they measure a launch end to end.
+    def calibrate(self, repeats=3, min_elems=16):
+        first = self.buffer_descriptors[self.first_in_index()]
+        elems = first.elem_nums
+        sizes = []
+        while elems >= min_elems:
+            sizes.append(elems)
+            elems //= 4
+        arrays = [pool.acquire() for pool in self.pools]
+        probes = 0
+        for elems in sizes:
+            kernel_args = []
+            for bd in self.buffer_descriptors:
+                if bd.is_IN():
+                    kernel_args.append(np.zeros(elems, dtype=bd.dtype))
+                elif bd.is_count():
+                    kernel_args.append(bd.dtype(elems))
+                elif bd.is_SCALAR():
+                    kernel_args.append(bd.dtype(0))
+                else:
+                    kernel_args.append(None)
+            nbytes = sum([arg.nbytes
+                          for bd, arg in zip(self.buffer_descriptors, kernel_args)
+                          if bd.is_IN()])
+            for _ in range(repeats):
+                start = time.perf_counter_ns()
+                self.compute_host(kernel_args, None, arrays)
+                self.router.record(FRouter.HOST, nbytes,
+                                   time.perf_counter_ns() - start, 0)
+                self.launch([], kernel_args, self.make_offsets([elems]))
+                probes += 1
+                for lane in self.lanes:
+                    lane.finish()
+                self.router.wait_samples(FRouter.DEVICE, probes)
+        for pool, array in zip(self.pools, arrays):
+            pool.release(array)
+        self.router.calibrate()
 
     def dump_profiling(self, filename):
         if self.profile:
             self.profilingManager.dump_to_file(filename)
 
     # This function must return a list of the kernel's arguments
-    # Put None if a kernel argument is FBufferType.OUT
+    # Put None if a kernel argument is FBufferType.OUT, FBufferType.OFFSETS,
+    # FBufferType.STATE or FBufferType.INOUT
     def prepare_compute(self, tup):
         pass
 
-    # This function must return a list containing the output tuple
+    # This function must return a list containing the output tuple,
+    # results holds the OUT and INOUT buffers in the descriptors order
     def prepare_emit(self, tup, results):
         pass
 
+    # This function receives the snapshot of the STATE/INOUT buffers
+    # (name -> array) taken every snapshot_interval_s
+    def checkpoint(self, arrays):
+        pass
+
     def finish(self):
-        for b, bd in zip(self.buffers, self.buffer_descriptors):
-            if bd.is_OUT():
-                b.finish()
-        self.kernel_queue.finish()
+        if self.compute_pool is not None:
+            self.compute_pool.drain()
+        with self.batch_cond:
+            self.flush()
+        for lane in self.lanes:
+            lane.finish()
+        if self.emit_pool is not None:
+            self.emit_pool.drain()
 
 
 class FBoltSync(storm.Bolt):
@@ -178,28 +1236,46 @@ class FBoltSync(storm.Bolt):
                  kernel_name=None,
                  buffer_descriptors=None,
                  emulator=False,
-                 profile=False):
+                 profile=False,
+                 device=None,
+                 need_task_ids=False):
 
         self.emulator = emulator
+        self.need_task_ids = need_task_ids
         if self.emulator:
             os.environ['XCL_EMULATION_MODE'] = 'sw_emu'
 
         with pipes() as (out, err):
-            self.xilinx = CLXilinxDevice(xclbin_filepath)
-            self.kernel = cl.Kernel(self.xilinx.program, kernel_name)
-            self.kernel_queue = cl.CommandQueue(self.xilinx.context)
+            # defaults to the Xilinx OpenCL backend, of a list of devices
+            # (e.g., CLXilinxDevice.all) only the first one is used: the
+            # tuples are processed one at a time
+            self.device = device
+            if self.device is None:
+                self.device = CLXilinxDevice(xclbin_filepath)
+            if isinstance(self.device, list):
+                self.device = self.device[0]
+            self.kernel = self.device.create_kernel(kernel_name,
+                                                    buffer_descriptors)
+            self.kernel_queue = self.device.create_queue()
 
             self.buffer_descriptors = buffer_descriptors
             self.buffers = []
+            self.states = {}
             for bd in buffer_descriptors:
-                if bd.is_IN():
-                    b = FWriteBuffers(self.xilinx.context,
+                if bd.is_persistent():
+                    b = FStateBuffer(self.device,
+                                     bd.size_in_bytes(),
+                                     profile)
+                    self.states[bd.name] = b
+                    self.buffers.append(b)
+                elif bd.is_IN():
+                    b = FWriteBuffers(self.device,
                                       bd.size_in_bytes(),
                                       1,
                                       profile)
                     self.buffers.append(b)
                 elif bd.is_OUT():
-                    b = FReadBuffers(self.xilinx.context,
+                    b = FReadBuffers(self.device,
                                      bd.size_in_bytes(),
                                      1,
                                      profile)
@@ -207,19 +1283,30 @@ class FBoltSync(storm.Bolt):
                 else:
                     self.buffers.append(None)
 
-            scalar_dtypes = []
-            for bd in self.buffer_descriptors:
-                if bd.is_SCALAR():
-                    scalar_dtypes.append(bd.dtype)
-                else:
-                    scalar_dtypes.append(None)
-            self.kernel.set_scalar_arg_dtypes(scalar_dtypes)
+            # the results live until the emit, a single host array per OUT
+            # buffer is reused by every tuple
+            self.pools = [FHostPool(bd.dtype, bd.elem_nums, 1)
+                          for bd in buffer_descriptors
+                          if bd.is_OUT() or bd.is_INOUT()]
 
             self.profile = profile
             if self.profile:
                 self.profilingManager = CLProfilingManager()
                 self.count = 0
 
+    # Returns the values of the i-th kernel argument (FBufferType.IN) as an
+    # array ready to be written
+    def stage(self, i, values):
+        return np.asarray(values, dtype=self.buffer_descriptors[i].dtype)
+
+    # the task ids cost a round trip on the pipe, they are read only when
+    # asked for (need_task_ids, or an override of prepare_emit that emits
+    # by itself)
+    def emit(self, tup, anchors=[], need_task_ids=None):
+        if need_task_ids is None:
+            need_task_ids = self.need_task_ids
+        return storm.emit(tup, anchors=anchors, need_task_ids=need_task_ids)
+
     def process(self, tup):
         kernel_args = self.prepare_compute(tup)
 
@@ -235,6 +1322,9 @@ class FBoltSync(storm.Bolt):
             elif bd.is_OUT():
                 b.next()
                 self.kernel.set_arg(i, b.current())
+            elif bd.is_persistent():
+                self.kernel.set_arg(i, b.current())
+                write_wait_events.extend(b.depend())
             elif bd.is_SCALAR():
                 self.kernel.set_arg(i, arg)
             else:
@@ -245,21 +1335,24 @@ class FBoltSync(storm.Bolt):
             self.profilingManager.start(self.count, write_wait_events)
 
         gws = lws = (1, 1, 1)
-        event = cl.enqueue_nd_range_kernel(self.kernel_queue,
+        event = self.device.enqueue_kernel(self.kernel_queue,
                                            self.kernel,
                                            gws, lws,
                                            wait_for=write_wait_events)
+        for b in self.states.values():
+            b.touched(event)
 
         read_buffers = []
         read_wait_events = []
+        pools = iter(self.pools)
         for b, bd in zip(self.buffers, self.buffer_descriptors):
-            if bd.is_OUT():
-                data = np.empty(bd.elem_nums, dtype=bd.dtype)
+            if bd.is_OUT() or bd.is_INOUT():
+                data = next(pools).acquire()
                 read_buffers.append(data)
                 evt = b.read(data, [event])
                 read_wait_events.append(evt)
 
-        cl.wait_for_events(read_wait_events)
+        self.device.wait_for_events(read_wait_events)
 
         if self.profile:
             max_evt = None
@@ -273,18 +1366,31 @@ class FBoltSync(storm.Bolt):
 
         output = self.prepare_emit(tup, read_buffers)
         try:
-            storm.emit(output, anchors=[tup])
+            self.emit(output, anchors=[tup])
             storm.ack(tup)
         except Exception:
             storm.reportError(storm.traceback.format_exc())
             storm.fail(tup)
+        for pool, data in zip(self.pools, read_buffers):
+            pool.release(data)
 
     def dump_profiling(self, filename):
         if self.profile:
             self.profilingManager.dump_to_file(filename)
 
+    # The STATE/INOUT buffers after the last tuple
+    def snapshot(self):
+        return snapshot_states(self.device, self.states,
+                               [bd for bd in self.buffer_descriptors
+                                if bd.is_persistent()])
+
+    def restore(self, arrays):
+        restore_states(self.device, self.states, self.buffer_descriptors,
+                       arrays)
+
     # This function must return a list of the kernel's arguments
-    # Put None if a kernel argument is FBufferType.OUT
+    # Put None if a kernel argument is FBufferType.OUT, FBufferType.STATE
+    # or FBufferType.INOUT
     def prepare_compute(self, tup):
         pass
 
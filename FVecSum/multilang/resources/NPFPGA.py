@@ -0,0 +1,196 @@
+import sys
+import time
+import threading
+import traceback
+import numpy as np
+from pyopencl import command_execution_status as cs
+from collections import deque
+
+
+# NumPy reference engine: it mimics the subset of the OpenCL API used by
+# FBuffers/FBoltAsync/FBoltSync. Each queue is an in-order worker thread
+# (or a few of them for out-of-order queues), so transfers and kernels on
+# different queues overlap as they do on a real device, and events carry
+# the same profiling information.
+
+
+class NPEventProfile:
+    def __init__(self):
+        self.queued = time.perf_counter_ns()
+        self.submit = self.queued
+        self.start = 0
+        self.end = 0
+
+
+class NPEvent:
+
+    def __init__(self):
+        self.profile = NPEventProfile()
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.command_execution_status = cs.QUEUED
+
+    def set_callback(self, status, callback):
+        with self.lock:
+            if not self.done.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self.command_execution_status)
+
+    def wait(self):
+        self.done.wait()
+
+    # status is COMPLETE or a negative error code, as in OpenCL
+    def complete(self, status=cs.COMPLETE):
+        with self.lock:
+            self.command_execution_status = status
+            self.done.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        for callback in callbacks:
+            callback(status)
+
+
+# With more than one worker the commands may run out of order, they only
+# wait for their events (which always belong to earlier commands)
+class NPCommandQueue:
+
+    def __init__(self, workers=1):
+        self.commands = deque()
+        self.pending = threading.Semaphore(0)
+        self.idle = threading.Condition()
+        self.in_flight = 0
+        self.workers = [threading.Thread(target=self.run, daemon=True)
+                        for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def enqueue(self, command, wait_for=None):
+        event = NPEvent()
+        with self.idle:
+            self.in_flight += 1
+        self.commands.append((command, list(wait_for or []), event))
+        self.pending.release()
+        return event
+
+    def run(self):
+        while True:
+            self.pending.acquire()
+            command, wait_for, event = self.commands.popleft()
+            for e in wait_for:
+                e.wait()
+            event.profile.submit = event.profile.start = time.perf_counter_ns()
+            status = cs.COMPLETE
+            try:
+                command()
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+                status = -1
+            event.profile.end = time.perf_counter_ns()
+            event.complete(status)
+            with self.idle:
+                self.in_flight -= 1
+                if self.in_flight == 0:
+                    self.idle.notify_all()
+
+    def finish(self):
+        with self.idle:
+            while self.in_flight > 0:
+                self.idle.wait()
+
+
+class NPBuffer:
+
+    def __init__(self, size, data=None):
+        self.size = size
+        self.data = data
+        if self.data is None:
+            self.data = np.empty(size, dtype=np.uint8)
+
+    def view(self, dtype):
+        return self.data.view(dtype)
+
+
+class NPKernel:
+
+    def __init__(self, function, buffer_descriptors):
+        self.function = function
+        self.buffer_descriptors = buffer_descriptors
+        self.args = [None] * len(buffer_descriptors)
+
+    def set_arg(self, i, arg):
+        self.args[i] = arg
+
+    # Buffers are passed to the function as typed views over their whole
+    # capacity, scalars are passed as they are
+    def bind(self):
+        args = []
+        for bd, arg in zip(self.buffer_descriptors, self.args):
+            if isinstance(arg, NPBuffer):
+                args.append(arg.view(bd.dtype))
+            else:
+                args.append(arg)
+        return args
+
+
+class NPDevice:
+
+    def __init__(self, kernels=None, out_of_order_workers=4):
+        self.startup = {"source": "numpy"}
+        self.out_of_order_workers = out_of_order_workers
+        self.kernels = {}
+        for name, function in (kernels or {}).items():
+            self.register(name, function)
+
+    # Registers a vectorized function that replaces the kernel `name`.
+    # It receives the kernel's arguments in the FBufferDescriptor order.
+    def register(self, name, function):
+        self.kernels[name] = function
+
+    def compute_units(self, kernel_name):
+        return [kernel_name]
+
+    def create_queue(self, profile=False, out_of_order=False):
+        if out_of_order:
+            return NPCommandQueue(self.out_of_order_workers)
+        return NPCommandQueue()
+
+    def create_buffer(self, flags, size):
+        return NPBuffer(size)
+
+    def create_sub_buffer(self, buffer, origin, size):
+        return NPBuffer(size, buffer.data[origin:origin + size])
+
+    def base_align(self):
+        return 64
+
+    def create_host_buffer(self, queue, size):
+        return np.empty(size, dtype=np.uint8)
+
+    def create_kernel(self, kernel_name, buffer_descriptors):
+        if kernel_name not in self.kernels:
+            raise RuntimeError("Kernel `{}` is not registered!".format(kernel_name))
+        return NPKernel(self.kernels[kernel_name], buffer_descriptors)
+
+    def enqueue_copy(self, queue, dest, src, wait_for=None,
+                     is_blocking=False):
+        if isinstance(dest, NPBuffer):
+            src = np.ascontiguousarray(src).view(np.uint8).reshape(-1)
+            command = lambda: np.copyto(dest.data[0:src.nbytes], src)
+        else:
+            out = dest.view(np.uint8).reshape(-1)
+            command = lambda: np.copyto(out, src.data[0:out.nbytes])
+
+        event = queue.enqueue(command, wait_for)
+        if is_blocking:
+            event.wait()
+        return event
+
+    def enqueue_kernel(self, queue, kernel, gws, lws, wait_for=None):
+        args = kernel.bind()
+        return queue.enqueue(lambda: kernel.function(*args), wait_for)
+
+    def wait_for_events(self, events):
+        for e in events:
+            e.wait()
@@ -0,0 +1,378 @@
+import os
+import sys
+import json
+import time
+import struct
+import argparse
+import itertools
+import threading
+import subprocess
+import tempfile
+import numpy as np
+import storm
+from CLFPGA import FHistogram
+
+
+# Local benchmark of the FBolts of fbolt.py, without a Storm cluster.
+# Every combination of the swept parameters is a run; each run prints a
+# JSON line with throughput and latency percentiles, e.g.:
+#
+#   FBOLT_BACKEND=numpy python3 bench.py --sizes 1024,8192 --degrees 1,2,4
+#   python3 bench.py --backend opencl --mode subprocess --output bench.jsonl
+#
+# inproc drives the bolt class directly, subprocess runs fbolt.py as Storm
+# would and speaks the multilang protocol over its pipes. The latency is
+# measured from the scheduled arrival of a tuple to the receipt of its emit.
+
+
+# packed tuples as in RandomVecSpout: `vectors` vectors back to back, each
+# sums to [i, 1, 1, ...], and offsets is [n, offset_0, length_0, ...]
+def make_tuple(i, size, rng, vectors=1):
+    lengths = rng.integers(1, max(size // vectors, 2), vectors)
+    offsets = np.empty(1 + 2 * vectors, dtype=np.int32)
+    offsets[0] = vectors
+    offsets[2::2] = lengths
+    offsets[1::2] = np.cumsum(lengths) - lengths
+    total = int(lengths.sum())
+    values = rng.integers(0, size, total, dtype=np.int32)
+    A = values + 1
+    B = -values
+    A[offsets[1::2]] = i
+    B[offsets[1::2]] = 0
+    return A, B, offsets
+
+
+def check(result, offsets, i):
+    result = np.asarray(result)
+    offsets = np.asarray(offsets)
+    if len(result) == 0:
+        return False
+    for j in range(offsets[0]):
+        off = offsets[1 + 2 * j]
+        size = offsets[2 + 2 * j]
+        if result[off] != i or not np.all(result[off + 1:off + size] == 1):
+            return False
+    return True
+
+
+# Tuples are sent open loop at `rate` tuples/s (0: as fast as possible)
+def schedule(n, rate):
+    start = time.perf_counter_ns()
+    for i in range(n):
+        if rate > 0:
+            arrival = start + int(i * 1e9 / rate)
+            delay = arrival - time.perf_counter_ns()
+            if delay > 0:
+                time.sleep(1e-9 * delay)
+        else:
+            arrival = time.perf_counter_ns()
+        yield i, arrival
+
+
+class Results:
+
+    def __init__(self, n):
+        self.n = n
+        self.latency = FHistogram()
+        self.acks = 0
+        self.errors = 0
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    def emitted(self, values, arrivals):
+        now = time.perf_counter_ns()
+        i = int(values[2])
+        with self.lock:
+            self.latency.record(now - arrivals[i])
+            if not check(values[0], values[1], i):
+                self.errors += 1
+
+    def acked(self):
+        with self.lock:
+            self.acks += 1
+            if self.acks == self.n:
+                self.done.set()
+
+
+def run_inproc(args, options, rate, inputs):
+    import fbolt
+
+    results = Results(len(inputs))
+    arrivals = [0] * len(inputs)
+
+    # the benchmark plays the parent: messages are encoded and consumed
+    def send(msg, urgent=False):
+        storm.encodeMsg(msg)
+        if msg["command"] == "emit":
+            results.emitted(msg["tuple"], arrivals)
+        elif msg["command"] == "ack":
+            results.acked()
+    storm.sendMsgToParent = send
+    storm.MODE = storm.Bolt
+
+    bolt = fbolt.make_bolt(**options)
+    bolt.initialize({}, {})
+    start = time.perf_counter_ns()
+    for i, arrival in schedule(len(inputs), rate):
+        arrivals[i] = arrival
+        A, B, offsets = inputs[i]
+        bolt.process(storm.Tuple(str(i), "spout", "default", 1, [A, B, offsets, i]))
+    # a broker batches the tuples of all its clients itself
+    if not options["sync"] and options.get("broker") is None:
+        with bolt.batch_cond:
+            bolt.flush()
+    results.done.wait(args.timeout)
+    return results, time.perf_counter_ns() - start
+
+
+class Child:
+
+    def __init__(self, options, binary, shm_slots=0, shm_slot_bytes=0):
+        code = "import json, sys, fbolt; fbolt.make_bolt(**json.loads(sys.argv[1])).run()"
+        self.process = subprocess.Popen([sys.executable, "-c", code, json.dumps(options)],
+                                        cwd=os.path.dirname(os.path.abspath(__file__)),
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+        self.lock = threading.Lock()
+        # the handshake is always JSON, then the child picks the framing
+        setup = {"pidDir": tempfile.mkdtemp(), "conf": {}, "context": {}}
+        if binary:
+            setup["serializer"] = "msgpack"
+        # shared memory rings, as MsgpackSerializer creates them
+        self.rings = None
+        self.slots = {}
+        if binary and shm_slots > 0:
+            # created atomically (mode 0600), as File.createTempFile
+            paths = []
+            for _ in range(2):
+                fd, p = tempfile.mkstemp(prefix="fbolt-bench-", dir="/dev/shm")
+                os.close(fd)
+                paths.append(p)
+            self.rings = [storm.ShmRing.create(p, shm_slots, shm_slot_bytes)
+                          for p in paths]
+            setup["shm"] = {"in": paths[0], "out": paths[1]}
+        self.binary = False
+        self.send(setup)
+        reply = self.recv()
+        self.binary = reply.get("serializer") == "msgpack"
+        if self.rings is not None:
+            for p in paths:
+                os.unlink(p)
+            if not reply.get("shm"):
+                self.rings = None
+
+    # as ext_default, placing the arrays in the input ring when possible
+    def pack(self, obj, slots):
+        return storm.ext_pack(obj, self.rings[0] if self.rings else None, slots)
+
+    def release(self, id):
+        for slot in self.slots.pop(id, []):
+            self.rings[0].release(slot)
+
+    def ext_hook(self):
+        hook = storm.makeExtHook()
+        def ext_hook(code, data):
+            if code == storm.EXT_SHM and self.rings is not None:
+                slot, nbytes, code = struct.unpack('<iiB', data)
+                array = np.frombuffer(self.rings[1].view(slot, nbytes),
+                                      dtype=storm.EXT_DTYPES[code]).copy()
+                self.rings[1].release(slot)
+                return array
+            return hook(code, data)
+        return ext_hook
+
+    def send(self, msg):
+        if self.binary:
+            slots = []
+            body = storm.msgpack.packb(msg, default=lambda o: self.pack(o, slots),
+                                       use_bin_type=True)
+            if slots:
+                self.slots[msg["id"]] = slots
+            data = struct.pack(">I", len(body)) + body
+        else:
+            data = storm.orjson.dumps(msg, option=storm.orjson.OPT_SERIALIZE_NUMPY) + b"\nend\n"
+        with self.lock:
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+
+    # as MsgpackSerializer.writeTaskIds (or the JsonSerializer): a plain
+    # array of ints
+    def send_task_ids(self, task_ids):
+        if not self.binary:
+            self.send(task_ids)
+            return
+        body = storm.msgpack.Packer().pack_array_header(len(task_ids))
+        body += b"".join([storm.msgpack.packb(int(t)) for t in task_ids])
+        with self.lock:
+            self.process.stdin.write(struct.pack(">I", len(body)) + body)
+            self.process.stdin.flush()
+
+    def recv(self):
+        out = self.process.stdout
+        if self.binary:
+            header = out.read(4)
+            if len(header) < 4:
+                return None
+            size, = struct.unpack(">I", header)
+            return storm.msgpack.unpackb(out.read(size), ext_hook=self.ext_hook(), raw=False)
+        lines = []
+        while True:
+            line = out.readline()
+            if not line:
+                return None
+            if line == b"end\n":
+                return storm.json_decode(b"".join(lines))
+            lines.append(line)
+
+    def close(self):
+        self.process.kill()
+        self.process.wait()
+
+
+def run_subprocess(args, options, rate, inputs):
+    results = Results(len(inputs))
+    arrivals = [0] * len(inputs)
+    child = Child(options, args.serializer == "msgpack",
+                  args.shm_slots, 4 * options["vec_size"])
+
+    def reader():
+        while True:
+            msg = child.recv()
+            if msg is None:
+                results.done.set()
+                return
+            command = msg.get("command")
+            if command == "emit":
+                results.emitted(msg["tuple"], arrivals)
+                # the ShellBolt answers with the target tasks unless told not to
+                if msg.get("need_task_ids", True):
+                    child.send_task_ids([1])
+            elif command == "ack" or command == "fail":
+                child.release(msg["id"])
+                results.acked()
+            elif command == "sync":
+                pass
+    t = threading.Thread(target=reader, daemon=True)
+    t.start()
+
+    start = time.perf_counter_ns()
+    for i, arrival in schedule(len(inputs), rate):
+        arrivals[i] = arrival
+        A, B, offsets = inputs[i]
+        if not child.binary:
+            A, B, offsets = A.tolist(), B.tolist(), offsets.tolist()
+        child.send({"id": str(i), "comp": "spout", "stream": "default",
+                    "task": 1, "tuple": [A, B, offsets, i]})
+    results.done.wait(args.timeout)
+    elapsed = time.perf_counter_ns() - start
+    child.close()
+    return results, elapsed
+
+
+def run(args, config):
+    rng = np.random.default_rng(0)
+    inputs = [make_tuple(i, config["vec_size"], rng, args.vectors)
+              for i in range(args.tuples)]
+    options = dict(config)
+    rate = options.pop("rate")
+    if args.broker is not None:
+        options["broker"] = args.broker
+    if args.mode == "inproc":
+        results, elapsed = run_inproc(args, options, rate, inputs)
+    else:
+        results, elapsed = run_subprocess(args, options, rate, inputs)
+
+    seconds = 1e-9 * elapsed
+    nbytes = sum([A.nbytes + B.nbytes for A, B, _ in inputs])
+    h = results.latency
+    report = dict(config)
+    report.update({"mode": args.mode,
+                   "serializer": args.serializer,
+                   "shm_slots": args.shm_slots,
+                   "broker": args.broker,
+                   "vectors": args.vectors,
+                   "tuples": args.tuples,
+                   "acked": results.acks,
+                   "errors": results.errors,
+                   "seconds": seconds,
+                   "tuples_per_s": results.acks / seconds,
+                   "mb_per_s": 1e-6 * nbytes * results.acks / args.tuples / seconds,
+                   "latency_us": {"p50": 1e-3 * h.percentile(0.5),
+                                  "p99": 1e-3 * h.percentile(0.99),
+                                  "p999": 1e-3 * h.percentile(0.999)}})
+    return report
+
+
+def csv(cast):
+    return lambda s: [cast(x) for x in s.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FBolt local benchmark")
+    parser.add_argument("--mode", choices=["inproc", "subprocess"], default="inproc")
+    parser.add_argument("--backend", type=csv(str),
+                        default=[os.environ.get("FBOLT_BACKEND", "numpy")])
+    parser.add_argument("--bolts", type=csv(str), default=["async", "sync"])
+    parser.add_argument("--sizes", type=csv(int), default=[8 * 1024])
+    parser.add_argument("--rates", type=csv(float), default=[0])
+    parser.add_argument("--degrees", type=csv(int), default=[2])
+    parser.add_argument("--batch-sizes", type=csv(int), default=[1])
+    parser.add_argument("--queues", type=csv(int), default=[0],
+                        help="command queues per direction (0: one per buffer)")
+    parser.add_argument("--out-of-order", type=csv(int), default=[0],
+                        help="out-of-order command queues (0/1)")
+    parser.add_argument("--workers", type=csv(int), default=[0],
+                        help="threads running the hooks (0: inline)")
+    parser.add_argument("--routing", type=csv(int), default=[1],
+                        help="1: small launches run on the host (async)")
+    parser.add_argument("--host-threshold", type=int, default=None,
+                        help="input bytes below which they do (default: calibrated)")
+    parser.add_argument("--need-task-ids", action="store_true",
+                        help="the sync bolt waits for the task ids of its emits (subprocess)")
+    parser.add_argument("--unordered", action="store_true",
+                        help="emit in completion order")
+    parser.add_argument("--broker", default=None,
+                        help="socket of a running broker.py the bolt forwards to")
+    parser.add_argument("--serializer", choices=["json", "msgpack"], default="json")
+    parser.add_argument("--shm-slots", type=int, default=0,
+                        help="slots of the shared memory rings (subprocess, msgpack)")
+    parser.add_argument("--tuples", type=int, default=2000)
+    parser.add_argument("--vectors", type=int, default=1,
+                        help="vectors packed in each tuple")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", default=None,
+                        help="appends the JSON lines to this file")
+    args = parser.parse_args()
+
+    runs = []
+    for backend, bolt, size, rate in itertools.product(args.backend, args.bolts,
+                                                       args.sizes, args.rates):
+        if bolt == "sync":
+            runs.append({"backend": backend, "sync": True, "vec_size": size,
+                         "rate": rate})
+            # only a subprocess can be answered with the task ids
+            if args.need_task_ids and args.mode == "subprocess":
+                runs[-1]["need_task_ids"] = True
+            continue
+        for degree, batch_size, queues, out_of_order, workers, routing in itertools.product(
+                args.degrees, args.batch_sizes, args.queues, args.out_of_order,
+                args.workers, args.routing):
+            runs.append({"backend": backend, "sync": False, "vec_size": size,
+                         "rate": rate, "degree": degree, "batch_size": batch_size,
+                         "queues": queues or None,
+                         "out_of_order": bool(out_of_order),
+                         "workers": workers or None,
+                         "ordered": not args.unordered,
+                         "routing": bool(routing),
+                         "host_threshold": args.host_threshold})
+
+    for config in runs:
+        report = json.dumps(run(args, config))
+        print(report, flush=True)
+        if args.output is not None:
+            with open(args.output, "a") as f:
+                f.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
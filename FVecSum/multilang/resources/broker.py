@@ -0,0 +1,402 @@
+import os
+import sys
+import time
+import struct
+import socket
+import argparse
+import tempfile
+import threading
+import traceback
+import numpy as np
+import storm
+from storm import msgpack
+from CLFPGA import FHistogram
+from collections import deque
+
+
+# Host-local broker: a daemon that owns the device and serves the FBolt
+# executors of the host, so they share one context, one set of buffer rings
+# and one scheduler instead of fighting over the card, e.g.:
+#
+#   FBOLT_BACKEND=xilinx python3 broker.py --socket /tmp/fbolt-broker.sock
+#   FBOLT_BROKER=/tmp/fbolt-broker.sock  (in the environment of fbolt.py)
+#
+# The executors run FBrokerBolt, which forwards the tuple values to the
+# broker over a Unix socket; the broker runs them through the FBoltAsync of
+# fbolt.py (prepare_compute, batching, lanes, prepare_emit) and sends the
+# output tuples back. Messages are framed as the binary multilang protocol
+# ([4 bytes big-endian length][msgpack body]) and the arrays travel through
+# two shared memory rings created by the client (see storm.ShmRing).
+
+
+# A framed msgpack connection. Arrays sent are packed in out_ring when they
+# fit, arrays received are views of in_ring (or of the message)
+class FConnection:
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = storm.Reader(sock.makefile('rb'))
+        self.lock = threading.Lock()
+        self.in_ring = None
+        self.out_ring = None
+
+    def send(self, msg, slots=None):
+        body = msgpack.packb(msg,
+                             default=lambda o: storm.ext_pack(o, self.out_ring, slots),
+                             use_bin_type=True)
+        with self.lock:
+            self.sock.sendall(struct.pack('>I', len(body)) + body)
+
+    # returns the message and the in_ring slots of its arrays, None at EOF
+    def recv(self):
+        slots = []
+        def ext_hook(code, data):
+            if code == storm.EXT_SHM and self.in_ring is not None:
+                slot, nbytes, code = struct.unpack('<iiB', data)
+                slots.append(slot)
+                data = self.in_ring.view(slot, nbytes)
+            if code not in storm.EXT_DTYPES:
+                return msgpack.ExtType(code, data)
+            return np.frombuffer(data, dtype=storm.EXT_DTYPES[code])
+        try:
+            start, end = self.reader.exact(4)
+            size, = struct.unpack_from('>I', self.reader.buffer, start)
+            start, end = self.reader.exact(size)
+        except Exception:
+            return None, slots
+        # the arrays may be views of the message: it is decoded from a copy
+        body = bytes(self.reader.buffer[start:end])
+        return msgpack.unpackb(body, ext_hook=ext_hook, raw=False), slots
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+# A tuple submitted by a client of the broker
+class FBrokerTuple(storm.Tuple):
+    __slots__ = ['client', 'received', 'nbytes']
+
+    def __init__(self, client, id, values):
+        super().__init__(id, client.name, "default", 0, values)
+        self.client = client
+        self.received = time.perf_counter_ns()
+        self.nbytes = sum([v.nbytes for v in values
+                           if isinstance(v, np.ndarray)])
+
+
+# An executor connected to the broker, with its queue and statistics
+class FBrokerClient:
+
+    def __init__(self, broker, conn, name):
+        self.broker = broker
+        self.conn = conn
+        self.name = name
+        self.queue = deque()
+        self.deficit = 0
+        self.closed = False
+        self.in_flight = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait = FHistogram()
+        self.lock = threading.Lock()
+
+    def done(self, tup, failed=False):
+        with self.lock:
+            self.in_flight -= 1
+            if failed:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+    def send(self, msg):
+        if self.closed:
+            return
+        try:
+            self.conn.send(msg)
+        except OSError:
+            self.closed = True
+
+    def metrics(self):
+        with self.lock:
+            return {"queued": len(self.queue),
+                    "in_flight": self.in_flight,
+                    "submitted": self.submitted,
+                    "completed": self.completed,
+                    "failed": self.failed,
+                    "wait_us": {"p50": 1e-3 * self.wait.percentile(0.5),
+                                "p99": 1e-3 * self.wait.percentile(0.99)}}
+
+
+# Mixed in the bolt run by the broker: the outputs go back to the client
+# of the tuple instead of the Storm parent
+class FBrokered:
+
+    def emit_output(self, tup, output):
+        tup.client.send({"command": "result", "id": tup.id, "tuple": output})
+        tup.client.done(tup)
+
+    def fail(self, tup):
+        tup.client.send({"command": "error", "id": tup.id,
+                         "msg": traceback.format_exc()})
+        tup.client.done(tup, failed=True)
+
+
+def brokered(bolt_class):
+    return type("Brokered" + bolt_class.__name__, (FBrokered, bolt_class), {})
+
+
+class FBroker:
+
+    def __init__(self, bolt, path):
+        self.bolt = bolt
+        self.path = path
+        self.clients = []
+        self.cond = threading.Condition()
+        # deficit round robin on the input bytes: every turn a client may
+        # submit up to a full tuple more than it did
+        self.quantum = sum([bd.size_in_bytes()
+                            for bd in self.bolt.buffer_descriptors
+                            if bd.is_IN()])
+        # metrics sent by the bolt through storm.rpcMetrics
+        self.bolt_metrics = {}
+        storm.sendMsgToParent = self.parent_message
+        # as run() would, before the first tuple
+        self.bolt.initialize({}, {})
+
+    # the messages of the bolt for the (absent) Storm parent
+    def parent_message(self, msg, urgent=False):
+        if msg["command"] == "metrics":
+            self.bolt_metrics[msg["name"]] = msg["params"]
+        elif msg["command"] in ("error", "log"):
+            print(msg["msg"], file=sys.stderr, flush=True)
+
+    def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen()
+        t = threading.Thread(target=self.schedule_loop, daemon=True)
+        t.start()
+        while True:
+            sock, _ = server.accept()
+            t = threading.Thread(target=self.client_loop, args=(sock,),
+                                 daemon=True)
+            t.start()
+
+    def client_loop(self, sock):
+        conn = FConnection(sock)
+        msg, _ = conn.recv()
+        if msg is None or msg.get("command") != "hello":
+            conn.close()
+            return
+        # the rings of the client: it writes the inputs in "in" and
+        # releases them at the result, the outputs go in "out"
+        shm = msg.get("shm")
+        if shm:
+            try:
+                conn.in_ring = storm.ShmRing(shm["in"])
+                conn.out_ring = storm.ShmRing(shm["out"])
+            except Exception:
+                conn.in_ring = conn.out_ring = None
+        client = FBrokerClient(self, conn, msg.get("name", str(len(self.clients))))
+        conn.send({"command": "hello", "shm": conn.in_ring is not None})
+        with self.cond:
+            self.clients.append(client)
+
+        while True:
+            msg, _ = conn.recv()
+            if msg is None:
+                break
+            command = msg.get("command")
+            if command == "submit":
+                tup = FBrokerTuple(client, msg["id"], msg["tuple"])
+                with self.cond:
+                    client.queue.append(tup)
+                    client.submitted += 1
+                    self.cond.notify()
+            elif command == "metrics":
+                client.send({"command": "metrics", "metrics": self.metrics()})
+
+        # the tuples in flight complete anyway, their outputs are dropped
+        with self.cond:
+            client.closed = True
+            client.queue.clear()
+            self.clients.remove(client)
+        conn.close()
+
+    # the next tuple to run, in deficit round robin order among the clients
+    def next_tuple(self):
+        with self.cond:
+            while True:
+                ready = [c for c in self.clients if c.queue]
+                if not ready:
+                    self.cond.wait()
+                    continue
+                for client in ready:
+                    if client.queue[0].nbytes <= client.deficit:
+                        tup = client.queue.popleft()
+                        client.deficit -= tup.nbytes
+                        if not client.queue:
+                            client.deficit = 0
+                        return tup
+                for client in ready:
+                    client.deficit += self.quantum
+                # the first clients go last at the next turn
+                self.clients.append(self.clients.pop(0))
+
+    def schedule_loop(self):
+        while True:
+            tup = self.next_tuple()
+            client = tup.client
+            now = time.perf_counter_ns()
+            with client.lock:
+                client.in_flight += 1
+                client.wait.record(now - tup.received)
+            # the tuple arrived when the broker received it
+            storm.DECODE_NS = now - tup.received
+            # process blocks while the bolt is saturated, the clients queue
+            # up in the meantime (each within its window)
+            self.bolt.process(tup)
+
+    def metrics(self):
+        with self.cond:
+            clients = list(self.clients)
+        return {"clients": {c.name: c.metrics() for c in clients},
+                "queued": sum([len(c.queue) for c in clients]),
+                "in_flight": self.bolt.in_flight,
+                "bolt": self.bolt_metrics}
+
+
+# The bolt run by the executors when a broker is available: it forwards the
+# tuples to the broker and emits the outputs it sends back. At most window
+# tuples are in flight, then process() blocks (as FBoltAsync does).
+class FBrokerBolt(storm.Bolt):
+
+    def __init__(self,
+                 path,
+                 window=256,
+                 shm_slots=256,
+                 shm_slot_bytes=1 << 16,
+                 metrics_interval_s=10,
+                 writer_max_msgs=64,
+                 writer_max_delay_us=1000,
+                 name=None):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        self.conn = FConnection(sock)
+
+        hello = {"command": "hello", "name": name or str(os.getpid())}
+        paths = []
+        if shm_slots > 0 and os.path.isdir("/dev/shm"):
+            # created atomically (mode 0600), as File.createTempFile
+            for _ in range(2):
+                fd, p = tempfile.mkstemp(prefix="fbolt-broker-", dir="/dev/shm")
+                os.close(fd)
+                paths.append(p)
+            self.conn.out_ring = storm.ShmRing.create(paths[0], shm_slots,
+                                                      shm_slot_bytes)
+            self.conn.in_ring = storm.ShmRing.create(paths[1], shm_slots,
+                                                     shm_slot_bytes)
+            hello["shm"] = {"in": paths[0], "out": paths[1]}
+        self.conn.send(hello)
+        reply, _ = self.conn.recv()
+        # both sides have mapped the rings
+        for p in paths:
+            os.unlink(p)
+        if reply is None or not reply.get("shm"):
+            self.conn.in_ring = self.conn.out_ring = None
+
+        self.window = window
+        self.pending = {}
+        self.next_id = 0
+        self.cond = threading.Condition()
+        self.metrics_interval_s = metrics_interval_s
+        self.writer_max_msgs = writer_max_msgs
+        self.writer_max_delay_us = writer_max_delay_us
+        t = threading.Thread(target=self.receive_loop, daemon=True)
+        t.start()
+        if self.metrics_interval_s is not None:
+            t = threading.Thread(target=self.metrics_loop, daemon=True)
+            t.start()
+
+    def run(self):
+        if self.writer_max_msgs is not None:
+            storm.startWriter(self.writer_max_msgs, self.writer_max_delay_us)
+        super().run()
+
+    def process(self, tup):
+        with self.cond:
+            while len(self.pending) >= self.window:
+                self.cond.wait()
+            id = self.next_id
+            self.next_id += 1
+            slots = []
+            self.pending[id] = (tup, slots)
+        self.conn.send({"command": "submit", "id": id, "tuple": tup.values},
+                       slots)
+
+    def receive_loop(self):
+        while True:
+            msg, slots = self.conn.recv()
+            if msg is None:
+                break
+            command = msg.get("command")
+            if command == "metrics":
+                storm.rpcMetrics("fbolt-broker", msg["metrics"])
+                continue
+            with self.cond:
+                tup, sent = self.pending.pop(msg["id"])
+                self.cond.notify()
+            if command == "result":
+                storm.emitBolt(msg["tuple"], anchors=[tup], need_task_ids=False)
+                storm.ack(tup)
+            else:
+                storm.reportError(msg["msg"])
+                storm.fail(tup)
+            # the emit is already serialized, the slots of the inputs (sent)
+            # and of the outputs (received) can be reused
+            for slot in sent:
+                self.conn.out_ring.release(slot)
+            for slot in slots:
+                self.conn.in_ring.release(slot)
+
+        storm.reportError("The broker closed the connection")
+        with self.cond:
+            pending = list(self.pending.values())
+            self.pending.clear()
+            self.cond.notify_all()
+        for tup, _ in pending:
+            storm.fail(tup)
+
+    def metrics_loop(self):
+        while True:
+            time.sleep(self.metrics_interval_s)
+            self.conn.send({"command": "metrics"})
+
+    def finish(self):
+        with self.cond:
+            while self.pending:
+                self.cond.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FBolt host-local broker")
+    parser.add_argument("--socket", default="/tmp/fbolt-broker.sock")
+    parser.add_argument("--backend", default=None)
+    parser.add_argument("--options", default="{}",
+                        help="JSON options of the bolt (see fbolt.make_bolt)")
+    args = parser.parse_args()
+
+    import fbolt
+    bolt = fbolt.make_bolt(args.backend, brokered=True,
+                           **storm.json_decode(args.options))
+    FBroker(bolt, args.socket).serve()
+
+
+if __name__ == "__main__":
+    main()
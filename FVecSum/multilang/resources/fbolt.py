@@ -1,6 +1,11 @@
+import os
+import sys
 import numpy as np
-from FPGANode import FBoltAsync
-from CLFPGA import FBufferDescriptor, FBufferType
+from wurlitzer import pipes
+from FPGANode import FBoltAsync, FBoltSync
+from CLFPGA import FBufferDescriptor, FBufferType, CLXilinxDevice, CLCPUDevice
+from NPFPGA import NPDevice
+from broker import FBrokerBolt, brokered as make_brokered
 
 
 # import storm
@@ -18,32 +23,122 @@ from CLFPGA import FBufferDescriptor, FBufferType
 # VecSumBolt().run()
 
 
-class VecSumBolt(FBoltAsync):
+class VecSum:
 
     def prepare_compute(self, tup):
         args = []
         args.append(None)
-        args.append(np.asarray(tup.values[0], dtype=np.int32))
-        args.append(np.asarray(tup.values[1], dtype=np.int32))
+        args.append(self.stage(1, tup.values[0]))
+        args.append(self.stage(2, tup.values[1]))
         args.append(np.int32(len(tup.values[0])))
         return args
 
+    # the tuples may pack several vectors in A and B: the sum is computed
+    # on the whole arrays, the offsets column and the timestamp follow
     def prepare_emit(self, tup, results):
         size = len(tup.values[0])
-        return [results[0][0:size], tup.values[2]]
+        return [results[0][0:size]] + tup.values[2:]
 
 
-xclbin_filepath = "vecsum_local.xclbin"
+class VecSumBolt(VecSum, FBoltAsync):
+    pass
+
+
+class VecSumSyncBolt(VecSum, FBoltSync):
+    pass
+
+
+# NumPy implementation of the vecsum kernel
+def vecsum(c, a, b, n_elements):
+    np.add(a[0:n_elements], b[0:n_elements], out=c[0:n_elements])
+
+
+# next to this file, whatever the working directory
+resources = os.path.dirname(os.path.abspath(__file__))
+xclbin_filepath = os.path.join(resources, "vecsum_local.xclbin")
+kernel_filepath = os.path.join(resources, "vecsum.cl")
 kernel_name = "vecsum"
 vec_size = 8 * 1024
 degree = 2
-buff_descr = []
-buff_descr.append(FBufferDescriptor(FBufferType.OUT, np.int32, "C", vec_size))
-buff_descr.append(FBufferDescriptor(FBufferType.IN, np.int32, "A", vec_size))
-buff_descr.append(FBufferDescriptor(FBufferType.IN, np.int32, "B", vec_size))
-buff_descr.append(FBufferDescriptor(FBufferType.SCALAR, np.int32, "size", 1))
-bolt = VecSumBolt(xclbin_filepath,
-                  kernel_name,
-                  buff_descr,
-                  degree)
-bolt.run()
+min_degree = None       # set both bounds to adapt degree at runtime
+max_degree = None
+ordered = True          # emit in tuple order (False: completion order)
+slab_size = None        # slab of max-size buffers shared by small tuples
+batch_size = 1          # tuples coalesced in a single kernel launch
+batch_linger_us = 1000  # max time a tuple waits for its batch to fill
+queues = None           # command queues per direction (None: per buffer)
+out_of_order = False    # out-of-order command queues
+workers = None          # threads running prepare_compute/prepare_emit
+routing = True          # small launches run on the host through vecsum
+host_threshold = None   # input bytes below which they do (None: calibrated)
+
+
+def make_descriptors(vec_size):
+    buff_descr = []
+    buff_descr.append(FBufferDescriptor(FBufferType.OUT, np.int32, "C", vec_size, size_from="size"))
+    buff_descr.append(FBufferDescriptor(FBufferType.IN, np.int32, "A", vec_size))
+    buff_descr.append(FBufferDescriptor(FBufferType.IN, np.int32, "B", vec_size))
+    buff_descr.append(FBufferDescriptor(FBufferType.SCALAR, np.int32, "size", 1, count=True))
+    return buff_descr
+
+
+# compute backend: xilinx (default), opencl (CPU, e.g. POCL) or numpy
+# (the native output of the build goes to stderr, i.e. to the worker log)
+def make_device(backend):
+    with pipes(stdout=sys.stderr, stderr=sys.stderr):
+        if backend == "xilinx":
+            # every card of the host, each with all its compute units
+            return CLXilinxDevice.all(xclbin_filepath)
+        elif backend == "opencl":
+            return CLCPUDevice(kernel_filepath)
+        elif backend == "numpy":
+            return NPDevice({kernel_name: vecsum})
+        raise RuntimeError("Unknown backend `{}`!".format(backend))
+
+
+# Builds the bolt of this file, options override the defaults above
+# (e.g., the benchmark sweeps degree and batch_size). With a broker (the
+# path of its socket, or FBOLT_BROKER) the executor forwards its tuples to
+# it, brokered builds the bolt run by the broker itself.
+def make_bolt(backend=None, sync=False, vec_size=vec_size, broker=None,
+              brokered=False, **options):
+    if broker is None:
+        broker = os.environ.get("FBOLT_BROKER")
+    if broker and not brokered:
+        return FBrokerBolt(broker)
+    if backend is None:
+        backend = os.environ.get("FBOLT_BACKEND", "xilinx")
+    device = make_device(backend)
+    buff_descr = make_descriptors(vec_size)
+    if sync:
+        return VecSumSyncBolt(xclbin_filepath,
+                              kernel_name,
+                              buff_descr,
+                              device=device,
+                              **options)
+
+    config = dict(staging=True,
+                  min_degree=min_degree,
+                  max_degree=max_degree,
+                  ordered=ordered,
+                  slab_size=slab_size,
+                  batch_size=batch_size,
+                  batch_linger_us=batch_linger_us,
+                  queues=queues,
+                  out_of_order=out_of_order,
+                  workers=workers,
+                  routing=routing,
+                  host_threshold=host_threshold)
+    config.update(options)
+    config["host_kernel"] = vecsum if config.pop("routing") else None
+    bolt_class = make_brokered(VecSumBolt) if brokered else VecSumBolt
+    return bolt_class(xclbin_filepath,
+                      kernel_name,
+                      buff_descr,
+                      config.pop("degree", degree),
+                      device=device,
+                      **config)
+
+
+if __name__ == "__main__":
+    make_bolt().run()
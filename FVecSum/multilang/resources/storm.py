@@ -18,6 +18,11 @@
 
 import sys
 import os
+import mmap
+import time
+import atexit
+import struct
+import threading
 import traceback
 from collections import deque
 
@@ -33,17 +38,212 @@ import orjson
 json_encode = lambda x: orjson.dumps(x, option=orjson.OPT_SERIALIZE_NUMPY).decode()
 json_decode = lambda x: orjson.loads(x)
 
-#reads lines and reconstructs newlines appropriately
-def readMsg():
-    msg = ""
-    while True:
-        line = sys.stdin.readline()
-        if not line:
+# optional binary framing: [4 bytes big-endian length][msgpack body]
+# negotiated at initComponent, JSON is the fallback
+try:
+    import msgpack
+    import numpy as np
+except ImportError:
+    msgpack = None
+
+# msgpack extension types carrying raw little-endian arrays
+EXT_DTYPES = {1: '<i4', 2: '<i8', 3: '<f4', 4: '<f8'}
+EXT_CODES = {'int32': 1, 'int64': 2, 'float32': 3, 'float64': 4}
+# reference to an array in a shared memory ring: [slot, nbytes, ext code]
+EXT_SHM = 16
+
+# Ring of fixed-size slots in a memory-mapped file created by the parent
+# (see ShmRing.java). A slot is busy while its flag is not zero: the
+# producer sets it and the consumer clears it once it is done with the data.
+class ShmRing(object):
+    MAGIC = 0x46424f4c
+    FLAGS_OFFSET = 64
+
+    def __init__(self, path):
+        with open(path, 'r+b') as f:
+            self.map = mmap.mmap(f.fileno(), 0)
+        magic, self.slots, self.slot_size, self.data_offset = struct.unpack_from('<4i', self.map, 0)
+        if magic != self.MAGIC:
+            raise Exception('Not a shared memory ring: ' + path)
+        self.flags = np.frombuffer(self.map, dtype=np.uint8, count=self.slots,
+                                   offset=self.FLAGS_OFFSET)
+        self.cursor = 0
+        self.lock = threading.Lock()
+
+    # creates a ring as the parent does (e.g., to benchmark without Storm)
+    @classmethod
+    def create(cls, path, slots, slot_size, page_size=4096):
+        data_offset = -(-(cls.FLAGS_OFFSET + slots) // page_size) * page_size
+        with open(path, 'w+b') as f:
+            f.truncate(data_offset + slots * slot_size)
+            f.write(struct.pack('<4i', cls.MAGIC, slots, slot_size, data_offset))
+        return cls(path)
+
+    def release(self, slot):
+        self.flags[slot] = 0
+
+    def view(self, slot, nbytes):
+        start = self.data_offset + slot * self.slot_size
+        return memoryview(self.map)[start:start + nbytes]
+
+    def alloc(self):
+        with self.lock:
+            for i in range(self.slots):
+                slot = (self.cursor + i) % self.slots
+                if self.flags[slot] == 0:
+                    self.flags[slot] = 1
+                    self.cursor = slot + 1
+                    return slot
+        return None
+
+    # copies the array in a free slot and returns its reference, or None
+    # if it does not fit or the ring is full
+    def pack(self, array):
+        code = EXT_CODES[array.dtype.name]
+        if array.nbytes > self.slot_size:
+            return None
+        slot = self.alloc()
+        if slot is None:
+            return None
+        dest = np.frombuffer(self.view(slot, array.nbytes), dtype=EXT_DTYPES[code])
+        dest[:] = array.reshape(-1)
+        return msgpack.ExtType(EXT_SHM, struct.pack('<iiB', slot, array.nbytes, code))
+
+# rings negotiated at initComponent: the parent writes the input arrays in
+# SHM_IN and releases them when the tuple is acked, the arrays emitted here
+# go in SHM_OUT and the parent releases them once read. The input arrays
+# are views of the ring: they must not be used after the ack/fail.
+SHM_IN = None
+SHM_OUT = None
+
+# optional destination of the decoded arrays: a callable
+# decoder(index, dtype, data) returning an array or None, where index is
+# the position of the array within the message
+ARRAY_DECODER = None
+
+def setArrayDecoder(decoder):
+    global ARRAY_DECODER
+    ARRAY_DECODER = decoder
+
+def makeExtHook():
+    index = [0]
+    def ext_hook(code, data):
+        if code == EXT_SHM and SHM_IN is not None:
+            slot, nbytes, code = struct.unpack('<iiB', data)
+            data = SHM_IN.view(slot, nbytes)
+        if code not in EXT_DTYPES:
+            return msgpack.ExtType(code, data)
+        array = None
+        if ARRAY_DECODER is not None:
+            array = ARRAY_DECODER(index[0], np.dtype(EXT_DTYPES[code]), data)
+        index[0] += 1
+        if array is None:
+            array = np.frombuffer(data, dtype=EXT_DTYPES[code])
+        return array
+    return ext_hook
+
+# packs the arrays in the ring when they fit, inline otherwise; slots, if
+# given, collects the ring slots taken by the message
+def ext_pack(obj, ring=None, slots=None):
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.name in EXT_CODES:
+            if ring is not None:
+                ext = ring.pack(obj)
+                if ext is not None:
+                    if slots is not None:
+                        slots.append(struct.unpack_from('<i', ext.data)[0])
+                    return ext
+            return msgpack.ExtType(EXT_CODES[obj.dtype.name],
+                                   obj.astype(obj.dtype.newbyteorder('<'), copy=False).tobytes())
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError("Cannot serialize %r" % (obj,))
+
+def ext_default(obj):
+    return ext_pack(obj, SHM_OUT)
+
+BINARY = False
+
+# time spent decoding the last message read, in nanoseconds
+DECODE_NS = 0
+
+# Buffered reader over the raw stdin: the messages are found by searching
+# their delimiter in the bytes read so far and decoded from a single slice
+class Reader(object):
+    def __init__(self, stream, chunk_size=1 << 16):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.pos = 0
+
+    def fill(self):
+        data = self.stream.read1(self.chunk_size)
+        if not data:
             raise Exception('Read EOF from stdin')
-        if line[0:-1] == "end":
-            break
-        msg = msg + line
-    return json_decode(msg[0:-1])
+        # drop the consumed bytes before growing the buffer
+        if self.pos > 0:
+            del self.buffer[0:self.pos]
+            self.pos = 0
+        self.buffer += data
+
+    # returns the [start, end) range of the next message ending with the
+    # delimiter, which is skipped
+    def find(self, delimiter):
+        scan = self.pos
+        while True:
+            end = self.buffer.find(delimiter, scan)
+            if end >= 0:
+                start = self.pos
+                self.pos = end + len(delimiter)
+                return start, end
+            scan = max(len(self.buffer) - len(delimiter) + 1, self.pos)
+            offset = self.pos
+            self.fill()
+            scan -= offset - self.pos
+
+    def exact(self, size):
+        while len(self.buffer) - self.pos < size:
+            self.fill()
+        start = self.pos
+        self.pos += size
+        return start, self.pos
+
+    def decode(self, loads, start, end):
+        with memoryview(self.buffer) as view, view[start:end] as body:
+            return loads(body)
+
+READER = None
+
+def reader():
+    global READER
+    if READER is None:
+        READER = Reader(sys.stdin.buffer)
+    return READER
+
+def readBinaryMsg():
+    global DECODE_NS
+    r = reader()
+    start, end = r.exact(4)
+    size, = struct.unpack_from('>I', r.buffer, start)
+    start, end = r.exact(size)
+    begin = time.perf_counter_ns()
+    msg = r.decode(lambda body: msgpack.unpackb(body, ext_hook=makeExtHook(), raw=False),
+                   start, end)
+    DECODE_NS = time.perf_counter_ns() - begin
+    return msg
+
+#reads a message up to the "\nend\n" delimiter
+def readMsg():
+    global DECODE_NS
+    if BINARY:
+        return readBinaryMsg()
+    r = reader()
+    start, end = r.find(b"\nend\n")
+    begin = time.perf_counter_ns()
+    msg = r.decode(json_decode, start, end)
+    DECODE_NS = time.perf_counter_ns() - begin
+    return msg
 
 MODE = None
 ANCHOR_TUPLE = None
@@ -78,21 +278,99 @@ def readTuple():
     cmd = readCommand()
     return Tuple(cmd["id"], cmd["comp"], cmd["stream"], cmd["task"], cmd["tuple"])
 
-def sendMsgToParent(msg):
-    print(json_encode(msg))
-    print("end")
-    sys.stdout.flush()
+def encodeMsg(msg):
+    if BINARY:
+        body = msgpack.packb(msg, default=ext_default, use_bin_type=True)
+        return struct.pack('>I', len(body)) + body
+    return orjson.dumps(msg, option=orjson.OPT_SERIALIZE_NUMPY) + b"\nend\n"
+
+# Dedicated writer owning stdout: messages are serialized by the caller,
+# queued (deque append/popleft are atomic) and written in coalesced chunks
+# with a single flush, after max_msgs messages or max_delay_us since the
+# first pending one. Urgent messages (e.g., replies the parent waits for)
+# are flushed immediately.
+class Writer(threading.Thread):
+    def __init__(self, max_msgs=64, max_delay_us=1000):
+        threading.Thread.__init__(self, daemon=True)
+        self.max_msgs = max_msgs
+        self.max_delay = 1e-6 * max_delay_us
+        self.queue = deque()
+        self.wakeup = threading.Event()
+        self.urgent = False
+        self.lock = threading.Lock()
+
+    # Only the first message after a flush wakes the writer up, no wakeup
+    # can be lost: if the queue holds more than this message, an older one
+    # is still there, and the flush that takes it drains the queue up to
+    # the end, this message included. The event stays set until the writer
+    # waits on it, and it is cleared only before a flush.
+    def put(self, data, urgent=False):
+        self.queue.append(data)
+        if urgent:
+            self.urgent = True
+        if urgent or len(self.queue) == 1 or len(self.queue) >= self.max_msgs:
+            self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            deadline = time.perf_counter() + self.max_delay
+            while not self.urgent and len(self.queue) < self.max_msgs:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.wakeup.wait(remaining)
+                self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            self.urgent = False
+            chunk = []
+            while self.queue:
+                chunk.append(self.queue.popleft())
+            if chunk:
+                sys.stdout.buffer.write(b"".join(chunk))
+                sys.stdout.buffer.flush()
+
+WRITER = None
+
+def startWriter(max_msgs=64, max_delay_us=1000):
+    global WRITER
+    if WRITER is None:
+        WRITER = Writer(max_msgs, max_delay_us)
+        WRITER.start()
+        atexit.register(WRITER.flush)
+
+def sendMsgToParent(msg, urgent=False):
+    data = encodeMsg(msg)
+    if WRITER is not None:
+        WRITER.put(data, urgent)
+        return
+    sys.stdout.buffer.write(data)
+    sys.stdout.buffer.flush()
 
 def sync():
-    sendMsgToParent({'command':'sync'})
+    sendMsgToParent({'command':'sync'}, urgent=True)
 
-def sendpid(heartbeatdir):
+def sendpid(heartbeatdir, serializer=None, shm=False):
     pid = os.getpid()
-    sendMsgToParent({'pid':pid})
+    msg = {'pid':pid}
+    if serializer is not None:
+        msg['serializer'] = serializer
+    if shm:
+        msg['shm'] = True
+    sendMsgToParent(msg, urgent=True)
     open(heartbeatdir + "/" + str(pid), "w").close()
 
-def emit(*args, **kwargs):
-    __emit(*args, **kwargs)
+# The parent replies to an emit with the ids of the target tasks, which
+# costs a round trip on the pipe: need_task_ids=False skips the reply
+def emit(*args, need_task_ids=True, **kwargs):
+    if not need_task_ids:
+        __emit(*args, need_task_ids=False, **kwargs)
+        return None
+    __emit(*args, urgent=True, **kwargs)
     return readTaskIds()
 
 def emitDirect(task, *args, **kwargs):
@@ -106,7 +384,8 @@ def __emit(*args, **kwargs):
     elif MODE == Spout:
         emitSpout(*args, **kwargs)
 
-def emitBolt(tup, stream=None, anchors = [], directTask=None):
+def emitBolt(tup, stream=None, anchors = [], directTask=None, urgent=False,
+             need_task_ids=True):
     global ANCHOR_TUPLE
     if ANCHOR_TUPLE is not None:
         anchors = [ANCHOR_TUPLE]
@@ -116,10 +395,13 @@ def emitBolt(tup, stream=None, anchors = [], directTask=None):
     m["anchors"] = [a.id for a in anchors]
     if directTask is not None:
         m["task"] = directTask
+    if not need_task_ids:
+        m["need_task_ids"] = False
     m["tuple"] = tup
-    sendMsgToParent(m)
+    sendMsgToParent(m, urgent)
 
-def emitSpout(tup, stream=None, id=None, directTask=None):
+def emitSpout(tup, stream=None, id=None, directTask=None, urgent=False,
+              need_task_ids=True):
     m = {"command": "emit"}
     if id is not None:
         m["id"] = id
@@ -127,8 +409,10 @@ def emitSpout(tup, stream=None, id=None, directTask=None):
         m["stream"] = stream
     if directTask is not None:
         m["task"] = directTask
+    if not need_task_ids:
+        m["need_task_ids"] = False
     m["tuple"] = tup
-    sendMsgToParent(m)
+    sendMsgToParent(m, urgent)
 
 def ack(tup):
     sendMsgToParent({"command": "ack", "id": tup.id})
@@ -161,11 +445,29 @@ def rpcMetrics(name, params):
     sendMsgToParent({"command": "metrics", "name": name, "params": params})
 
 def initComponent():
+    global BINARY
     setupInfo = readMsg()
-    sendpid(setupInfo['pidDir'])
+    # the parent offers binary framing in the setup message, accept it
+    # only if msgpack is available; the handshake itself is always JSON
+    global SHM_IN, SHM_OUT
+    serializer = None
+    if setupInfo.get('serializer') == 'msgpack' and msgpack is not None:
+        serializer = 'msgpack'
+    # the shared memory rings are used along with the binary framing only
+    shm = setupInfo.get('shm')
+    if serializer is not None and shm is not None:
+        try:
+            SHM_IN = ShmRing(shm['in'])
+            SHM_OUT = ShmRing(shm['out'])
+        except Exception:
+            SHM_IN = SHM_OUT = None
+    sendpid(setupInfo['pidDir'], serializer, SHM_OUT is not None)
+    BINARY = serializer is not None
     return [setupInfo['conf'], setupInfo['context']]
 
 class Tuple(object):
+    __slots__ = ('id', 'component', 'stream', 'task', 'values')
+
     def __init__(self, id, component, stream, task, values):
         self.id = id
         self.component = component
@@ -176,7 +478,7 @@ class Tuple(object):
     def __repr__(self):
         return '<%s%s>' % (
             self.__class__.__name__,
-            ''.join(' %s=%r' % (k, self.__dict__[k]) for k in sorted(self.__dict__.keys())))
+            ''.join(' %s=%r' % (k, getattr(self, k)) for k in sorted(self.__slots__)))
 
     def is_heartbeat_tuple(self):
         return self.task == -1 and self.stream == "__heartbeat"
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the modules of the bolt are flat files in resources/, as for fbolt.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "resources"))
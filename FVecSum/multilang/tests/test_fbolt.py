@@ -0,0 +1,597 @@
+import io
+import os
+import sys
+import time
+import socket
+import struct
+import threading
+import subprocess
+import msgpack
+import orjson
+import numpy as np
+import pytest
+import storm
+import fbolt
+import broker
+
+
+# Messages sent by the bolt to the (absent) ShellBolt. The emitted arrays
+# are copied: they are backed by the pooled host arrays of the bolt.
+class Parent:
+
+    def __init__(self, monkeypatch):
+        self.emits = []
+        self.acks = []
+        self.fails = []
+        self.metrics = {}
+        self.reports = []
+        monkeypatch.setattr(storm, "sendMsgToParent", self.send)
+        monkeypatch.setattr(storm, "MODE", storm.Bolt)
+
+    def send(self, msg, urgent=False):
+        if msg["command"] == "emit":
+            self.emits.append((msg["anchors"],
+                               [np.array(v) if isinstance(v, np.ndarray) else v
+                                for v in msg["tuple"]]))
+        elif msg["command"] == "ack":
+            self.acks.append(msg["id"])
+        elif msg["command"] == "fail":
+            self.fails.append(msg["id"])
+        elif msg["command"] == "metrics":
+            self.metrics[msg["name"]] = msg["params"]
+            self.reports.append((msg["name"], msg["params"]))
+
+    def wait(self, n, timeout=10):
+        deadline = time.monotonic() + timeout
+        while len(self.acks) + len(self.fails) < n and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+
+def make_tuples(n, max_elems, seed=0):
+    rng = np.random.default_rng(seed)
+    tuples = []
+    for i in range(n):
+        elems = int(rng.integers(1, max_elems + 1))
+        A = rng.integers(-1000, 1000, elems, dtype=np.int32)
+        B = rng.integers(-1000, 1000, elems, dtype=np.int32)
+        offsets = np.array([1, 0, elems], dtype=np.int32)
+        tuples.append(storm.Tuple(str(i), "spout", "default", 1, [A, B, offsets, i]))
+    return tuples
+
+
+def run(bolt, tuples, parent):
+    for tup in tuples:
+        bolt.process(tup)
+    if hasattr(bolt, "batch_cond"):
+        with bolt.batch_cond:
+            bolt.flush()
+    bolt.finish()
+    parent.wait(len(tuples))
+
+
+def check(tuples, parent, ordered=True):
+    ids = [tup.id for tup in tuples]
+    assert parent.fails == []
+    assert sorted(parent.acks) == sorted(ids)
+    assert len(parent.emits) == len(tuples)
+    expected = {tup.id: tup.values[0] + tup.values[1] for tup in tuples}
+    for anchors, (result, offsets, i) in parent.emits:
+        assert anchors == [str(i)]
+        np.testing.assert_array_equal(result, expected[str(i)])
+    if ordered:
+        assert [i for _, (_, _, i) in parent.emits] == list(range(len(tuples)))
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.001)
+    return condition()
+
+
+@pytest.mark.parametrize("options", [
+    dict(),
+    dict(staging=False, degree=4),
+    dict(batch_size=8, batch_linger_us=200),
+    dict(workers=3),
+    dict(queues=2, out_of_order=True),
+    dict(slab_size=2),
+])
+def test_async(monkeypatch, options):
+    parent = Parent(monkeypatch)
+    bolt = fbolt.make_bolt("numpy", vec_size=256, routing=False,
+                           latency_interval_s=None, **options)
+    tuples = make_tuples(300, 256)
+    run(bolt, tuples, parent)
+    check(tuples, parent)
+
+
+def test_completion_order(monkeypatch):
+    parent = Parent(monkeypatch)
+    bolt = fbolt.make_bolt("numpy", vec_size=256, routing=False, ordered=False,
+                           queues=2, out_of_order=True, latency_interval_s=None)
+    tuples = make_tuples(300, 256)
+    run(bolt, tuples, parent)
+    check(tuples, parent, ordered=False)
+
+
+# tuples longer than the buffers run in chunks, alone or between batches
+@pytest.mark.parametrize("options", [dict(), dict(batch_size=4), dict(workers=2)])
+def test_chunks(monkeypatch, options):
+    parent = Parent(monkeypatch)
+    bolt = fbolt.make_bolt("numpy", vec_size=64, routing=False,
+                           latency_interval_s=None, **options)
+    tuples = make_tuples(100, 300)
+    run(bolt, tuples, parent)
+    check(tuples, parent)
+
+
+# the launches below the threshold run on the host, in the same order
+@pytest.mark.parametrize("host_threshold", [None, 0, 512, 1 << 20])
+def test_routing(monkeypatch, host_threshold):
+    parent = Parent(monkeypatch)
+    bolt = fbolt.make_bolt("numpy", vec_size=256, host_threshold=host_threshold,
+                           latency_interval_s=None)
+    bolt.initialize({}, {})
+    tuples = make_tuples(300, 256)
+    run(bolt, tuples, parent)
+    check(tuples, parent)
+    snapshot = bolt.router.snapshot()
+    assert snapshot["host"]["tuples"] + snapshot["device"]["tuples"] == len(tuples)
+    if host_threshold == 0:
+        assert snapshot["host"]["tuples"] == 0
+    elif host_threshold == 1 << 20:
+        assert snapshot["device"]["tuples"] == 0
+
+
+# staged tuples routed to the host leave no lane behind: the next tuple
+# chooses its own lane (and gets the resizes)
+def test_routing_staging(monkeypatch):
+    parent = Parent(monkeypatch)
+    bolt = fbolt.make_bolt("numpy", vec_size=256, host_threshold=1 << 20,
+                           staging=True, latency_interval_s=None)
+    bolt.initialize({}, {})
+    tuples = make_tuples(100, 256)
+    for tup in tuples:
+        bolt.process(tup)
+        assert bolt.next_lane is None
+    bolt.finish()
+    parent.wait(len(tuples))
+    check(tuples, parent)
+    assert bolt.router.snapshot()["device"]["tuples"] == 0
+
+
+def test_sync(monkeypatch):
+    parent = Parent(monkeypatch)
+    bolt = fbolt.make_bolt("numpy", sync=True, vec_size=256)
+    tuples = make_tuples(100, 256)
+    run(bolt, tuples, parent)
+    check(tuples, parent)
+
+
+# several backend instances: every device gets launches, the emits keep
+# the order of the tuples (or follow the completions)
+@pytest.mark.parametrize("options", [dict(), dict(ordered=False),
+                                     dict(batch_size=4), dict(workers=2)])
+def test_devices(monkeypatch, options):
+    parent = Parent(monkeypatch)
+    launches = [0, 0, 0]
+
+    def counting(d):
+        def vecsum(c, a, b, n_elements):
+            launches[d] += 1
+            fbolt.vecsum(c, a, b, n_elements)
+        return vecsum
+
+    devices = [fbolt.NPDevice({fbolt.kernel_name: counting(d)})
+               for d in range(len(launches))]
+    bolt = fbolt.VecSumBolt(None, fbolt.kernel_name, fbolt.make_descriptors(256),
+                            2, device=devices, latency_interval_s=None, **options)
+    tuples = make_tuples(300, 256)
+    run(bolt, tuples, parent)
+    check(tuples, parent, ordered=options.get("ordered", True))
+    assert all(launches)
+
+
+# executors sharing a broker: every client gets its own results back, in
+# the order of its tuples, and the broker reports all of them
+def test_broker(monkeypatch, tmp_path):
+    path = str(tmp_path / "broker.sock")
+    # the broker takes over the messages of its bolt
+    monkeypatch.setattr(storm, "sendMsgToParent", storm.sendMsgToParent)
+    bolt = fbolt.make_bolt("numpy", vec_size=256, brokered=True,
+                           latency_interval_s=None)
+    server = broker.FBroker(bolt, path)
+    t = threading.Thread(target=server.serve, daemon=True)
+    t.start()
+    # the path exists once bound, the connections are accepted once listening
+    while True:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(path)
+            break
+        except (FileNotFoundError, ConnectionRefusedError):
+            time.sleep(0.01)
+
+    parent = Parent(monkeypatch)
+    names = ["a", "b", "c"]
+    clients = [broker.FBrokerBolt(path, window=16, metrics_interval_s=None,
+                                  writer_max_msgs=None, name=name)
+               for name in names]
+    tuples = {}
+    for k, name in enumerate(names):
+        tuples[name] = make_tuples(200, 256, seed=k)
+        for tup in tuples[name]:
+            tup.id = name + tup.id
+    threads = [threading.Thread(target=run, args=(client, tuples[name], parent))
+               for client, name in zip(clients, names)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    parent.wait(sum([len(tups) for tups in tuples.values()]))
+
+    assert parent.fails == []
+    for name in names:
+        ids = [tup.id for tup in tuples[name]]
+        assert sorted([id for id in parent.acks if id[0] == name]) == sorted(ids)
+        emits = [(anchors, values) for anchors, values in parent.emits
+                 if anchors[0][0] == name]
+        assert [anchors for anchors, _ in emits] == [[id] for id in ids]
+        for tup, (_, (result, offsets, i)) in zip(tuples[name], emits):
+            np.testing.assert_array_equal(result, tup.values[0] + tup.values[1])
+
+    clients[0].conn.send({"command": "metrics"})
+    deadline = time.monotonic() + 10
+    while "fbolt-broker" not in parent.metrics and time.monotonic() < deadline:
+        time.sleep(0.01)
+    metrics = parent.metrics["fbolt-broker"]["clients"]
+    for name in names:
+        assert metrics[name]["completed"] == len(tuples[name])
+        assert metrics[name]["failed"] == 0
+
+
+# the depth adapts between two tuples: the staged inputs of a tuple are
+# never in the rings being resized
+def test_adaptive_depth_staging(monkeypatch):
+    parent = Parent(monkeypatch)
+    bolt = fbolt.make_bolt("numpy", vec_size=4096, routing=False, staging=True,
+                           degree=1, min_degree=1, max_degree=6,
+                           adapt_interval=4, latency_interval_s=None)
+    resizes = []
+    resize = bolt.resize
+    monkeypatch.setattr(bolt, "resize", lambda d: (resizes.append(d), resize(d)))
+    tuples = make_tuples(2000, 4096)
+    run(bolt, tuples, parent)
+    check(tuples, parent)
+    assert resizes
+
+
+# e.g. the xilinx backend of make_bolt, CLXilinxDevice.all
+def test_sync_devices(monkeypatch):
+    parent = Parent(monkeypatch)
+    devices = [fbolt.make_device("numpy") for _ in range(2)]
+    monkeypatch.setattr(fbolt, "make_device", lambda backend: devices)
+    bolt = fbolt.make_bolt("xilinx", sync=True, vec_size=256)
+    tuples = make_tuples(100, 256)
+    run(bolt, tuples, parent)
+    check(tuples, parent)
+
+
+# the metrics sent to Storm by report_loop
+def test_metrics(monkeypatch):
+    parent = Parent(monkeypatch)
+    bolt = fbolt.make_bolt("numpy", vec_size=256, routing=False,
+                           latency_interval_s=0.05)
+    tuples = make_tuples(100, 256)
+    run(bolt, tuples, parent)
+    check(tuples, parent)
+    # the reports sent before the last launches count fewer acquires
+    def acquires():
+        pool = parent.metrics.get("fbolt-pool", {}).get("C", {})
+        return pool.get("hits", 0) + pool.get("misses", 0)
+    assert wait_for(lambda: acquires() >= len(tuples), timeout=10)
+    pool = parent.metrics["fbolt-pool"]["C"]
+    assert 0 < pool["high_water"] <= bolt.pools[0].capacity
+    assert "fbolt-latency" in parent.metrics
+    # the reports outlive the test: the last one goes to the test parent
+    bolt.report_interval_s = 3600
+    time.sleep(0.1)
+
+
+def test_saturation(monkeypatch):
+    parent = Parent(monkeypatch)
+    bolt = fbolt.make_bolt("numpy", vec_size=4096, routing=False,
+                           high_watermark=2, low_watermark=0,
+                           latency_interval_s=0.05)
+    tuples = make_tuples(200, 4096)
+    run(bolt, tuples, parent)
+    check(tuples, parent)
+    # the reports are per interval: the episodes add up to the total
+    time.sleep(0.2)
+    reports = [params for name, params in parent.reports
+               if name == "fbolt-saturation"]
+    assert sum(r["saturated"] for r in reports) > 0
+    assert sum(r["blocked_us"] for r in reports) > 0
+    assert reports[-1]["saturated"] == 0
+    bolt.report_interval_s = 3600
+    time.sleep(0.1)
+
+
+# binary framing: [4 bytes big-endian length][msgpack body], the arrays of
+# the supported dtypes travel as ext types, the others as lists
+def test_binary_framing(monkeypatch):
+    monkeypatch.setattr(storm, "BINARY", True)
+    msg = {"command": "emit", "anchors": ["1"],
+           "tuple": [np.arange(5, dtype=np.int32),
+                     np.arange(5, dtype=np.int64),
+                     np.linspace(0, 1, 5, dtype=np.float32),
+                     np.linspace(0, 1, 5, dtype=np.float64),
+                     np.arange(3, dtype=np.uint8),
+                     np.int32(7), "text"]}
+    data = storm.encodeMsg(msg)
+    size, = struct.unpack_from(">I", data)
+    assert size == len(data) - 4
+    monkeypatch.setattr(storm, "READER", storm.Reader(io.BytesIO(data * 2)))
+    for _ in range(2):
+        decoded = storm.readMsg()
+        assert decoded["command"] == "emit"
+        assert decoded["anchors"] == ["1"]
+        for value, expected in zip(decoded["tuple"][0:4], msg["tuple"][0:4]):
+            assert value.dtype == expected.dtype
+            np.testing.assert_array_equal(value, expected)
+        assert decoded["tuple"][4:] == [[0, 1, 2], 7, "text"]
+
+
+# the arrays go in the ring when they fit, and are decoded as views of it
+def test_ext_shm(monkeypatch, tmp_path):
+    ring = storm.ShmRing.create(str(tmp_path / "ring"), 4, 64)
+    small = np.arange(1, 9, dtype=np.float64)
+    large = np.arange(32, dtype=np.int32)
+    slots = []
+    body = msgpack.packb([small, large, small],
+                         default=lambda obj: storm.ext_pack(obj, ring, slots),
+                         use_bin_type=True)
+    assert slots == [0, 1]
+    # an ARRAY_DECODER sees every array with its position in the message
+    indices = []
+    monkeypatch.setattr(storm, "SHM_IN", storm.ShmRing(str(tmp_path / "ring")))
+    monkeypatch.setattr(storm, "ARRAY_DECODER",
+                        lambda index, dtype, data: indices.append(index))
+    decoded = msgpack.unpackb(body, ext_hook=storm.makeExtHook(), raw=False)
+    assert indices == [0, 1, 2]
+    for value, expected in zip(decoded, [small, large, small]):
+        np.testing.assert_array_equal(value, expected)
+    ring.view(0, small.nbytes)[0:8] = bytes(8)
+    assert decoded[0][0] == 0 and decoded[2][0] == 1
+
+
+# the setup message is always JSON, the parent offers msgpack and the rings
+# in it: the reply accepts them and the next messages are binary
+@pytest.mark.parametrize("offer", [None, "msgpack", "shm"])
+def test_negotiation(monkeypatch, tmp_path, offer):
+    setup = {"conf": {"a": 1}, "context": {"taskid": 2}, "pidDir": str(tmp_path)}
+    if offer is not None:
+        setup["serializer"] = "msgpack"
+    if offer == "shm":
+        paths = {"in": str(tmp_path / "in"), "out": str(tmp_path / "out")}
+        for path in paths.values():
+            storm.ShmRing.create(path, 4, 64)
+        setup["shm"] = paths
+    tup = {"id": "1", "comp": "spout", "stream": "default", "task": 3,
+           "tuple": [1]}
+    data = orjson.dumps(setup) + b"\nend\n"
+    if offer is None:
+        data += orjson.dumps(tup) + b"\nend\n"
+    else:
+        body = msgpack.packb(tup)
+        data += struct.pack(">I", len(body)) + body
+    replies = []
+    for name in ["BINARY", "SHM_IN", "SHM_OUT", "WRITER"]:
+        monkeypatch.setattr(storm, name, None if name != "BINARY" else False)
+    monkeypatch.setattr(storm, "READER", storm.Reader(io.BytesIO(data)))
+    monkeypatch.setattr(storm, "sendMsgToParent",
+                        lambda msg, urgent=False: replies.append(storm.encodeMsg(msg)))
+    # (the report loops of the bolts of the other tests are still running)
+    monkeypatch.setattr(storm, "rpcMetrics", lambda name, params: None)
+    conf, context = storm.initComponent()
+    assert conf == setup["conf"] and context == setup["context"]
+    reply = storm.json_decode(replies[0][0:-len(b"\nend\n")])
+    assert reply["pid"] == os.getpid()
+    assert os.path.exists(os.path.join(str(tmp_path), str(os.getpid())))
+    assert reply.get("serializer") == (None if offer is None else "msgpack")
+    assert reply.get("shm", False) == (offer == "shm")
+    assert storm.BINARY == (offer is not None)
+    assert (storm.SHM_OUT is not None) == (offer == "shm")
+    tup = storm.readTuple()
+    assert (tup.id, tup.task, tup.values) == ("1", 3, [1])
+
+
+# stdout of the Writer: a chunk per flush
+class Stdout:
+
+    def __init__(self):
+        self.buffer = self
+        self.pending = []
+        self.chunks = []
+
+    def write(self, data):
+        self.pending.append(bytes(data))
+
+    def flush(self):
+        self.chunks.append(b"".join(self.pending))
+        self.pending = []
+
+    def messages(self):
+        return [orjson.loads(m) for chunk in self.chunks
+                for m in chunk.split(b"\nend\n")[0:-1]]
+
+
+# the report loops of the bolts outlive their tests: their metrics would be
+# written along with the messages of the test
+def capture_stdout(monkeypatch):
+    stdout = Stdout()
+    monkeypatch.setattr(sys, "stdout", stdout)
+    monkeypatch.setattr(storm, "rpcMetrics", lambda name, params: None)
+    return stdout
+
+
+def test_writer_batching(monkeypatch):
+    stdout = capture_stdout(monkeypatch)
+    writer = storm.Writer(max_msgs=4, max_delay_us=10 ** 6)
+    writer.start()
+    for i in range(3):
+        writer.put(storm.encodeMsg({"i": i}))
+    time.sleep(0.1)
+    assert stdout.chunks == []
+    # max_msgs messages are written at once, without waiting the delay
+    writer.put(storm.encodeMsg({"i": 3}))
+    assert wait_for(lambda: len(stdout.chunks) == 1)
+    writer.put(storm.encodeMsg({"i": 4}))
+    writer.put(storm.encodeMsg({"i": 5}), urgent=True)
+    assert wait_for(lambda: len(stdout.chunks) == 2)
+    assert stdout.messages() == [{"i": i} for i in range(6)]
+
+
+# the urgent messages (sync, emits waiting for the task ids) carry the
+# batched ones along, in order
+def test_writer_urgent(monkeypatch):
+    stdout = capture_stdout(monkeypatch)
+    monkeypatch.setattr(storm, "MODE", storm.Bolt)
+    monkeypatch.setattr(storm, "BINARY", False)
+    monkeypatch.setattr(storm, "READER",
+                        storm.Reader(io.BytesIO(b"[4]\nend\n[5]\nend\n")))
+    writer = storm.Writer(max_msgs=64, max_delay_us=10 ** 7)
+    writer.start()
+    monkeypatch.setattr(storm, "WRITER", writer)
+    start = time.monotonic()
+    tup = storm.Tuple("1", "spout", "default", 1, [0])
+    for i in range(3):
+        storm.emit([i], anchors=[tup], need_task_ids=False)
+    assert storm.emit([3], anchors=[tup]) == [4]
+    assert wait_for(lambda: len(stdout.chunks) == 1)
+    storm.ack(tup)
+    storm.sync()
+    assert wait_for(lambda: len(stdout.chunks) == 2)
+    storm.emit([4], anchors=[tup], need_task_ids=False)
+    assert storm.emit([5], anchors=[tup]) == [5]
+    assert wait_for(lambda: len(stdout.chunks) == 3)
+    assert time.monotonic() - start < 5
+    messages = stdout.messages()
+    assert [m["command"] for m in messages] == ["emit"] * 4 + ["ack", "sync"] + ["emit"] * 2
+    assert [m["tuple"] for m in messages if m["command"] == "emit"] == [[i] for i in range(6)]
+    assert [m.get("need_task_ids", True) for m in messages
+            if m["command"] == "emit"] == [False] * 3 + [True, False, True]
+
+
+# producers racing with the flushes: every message is written, none waits
+# for a wakeup that does not come
+def test_writer_wakeup(monkeypatch):
+    stdout = capture_stdout(monkeypatch)
+    writer = storm.Writer(max_msgs=16, max_delay_us=50)
+    writer.start()
+
+    def produce(p):
+        for i in range(1999):
+            # the queue is drained now and then, the last message comes
+            # after a flush
+            if i % 100 == 0 or i == 1998:
+                time.sleep(0.005)
+            writer.put(storm.encodeMsg({"p": p, "i": i}))
+
+    threads = [threading.Thread(target=produce, args=(p,)) for p in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert wait_for(lambda: len(writer.queue) == 0 and not stdout.pending)
+    messages = stdout.messages()
+    for p in range(4):
+        assert [m["i"] for m in messages if m["p"] == p] == list(range(1999))
+
+
+# the messages still queued are written at exit
+def test_writer_exit():
+    resources = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "resources")
+    code = ("import storm\n"
+            "storm.startWriter(max_delay_us=10 ** 7)\n"
+            "for i in range(3):\n"
+            "    storm.sendMsgToParent({'i': i})\n")
+    start = time.monotonic()
+    out = subprocess.run([sys.executable, "-c", code], cwd=resources,
+                         stdout=subprocess.PIPE, check=True, timeout=30).stdout
+    assert time.monotonic() - start < 10
+    assert out == b"".join(storm.encodeMsg({"i": i}) for i in range(3))
+
+
+# messages split across the reads: the delimiters and the length prefixes
+# straddle the chunks, the JSON handshake is followed by binary frames
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 1 << 16])
+def test_reader(monkeypatch, chunk_size):
+    msgs = [{"pidDir": "/tmp", "text": "end\nend"}, [1, 2, 3], {"command": "next"}]
+    frames = [{"id": str(i), "tuple": [np.arange(i, dtype=np.int32), "x" * i]}
+              for i in range(0, 40, 3)]
+    data = b"".join(orjson.dumps(m) + b"\nend\n" for m in msgs)
+    for frame in frames:
+        body = msgpack.packb(frame, default=storm.ext_pack, use_bin_type=True)
+        data += struct.pack(">I", len(body)) + body
+    r, w = os.pipe()
+
+    def write():
+        with os.fdopen(w, "wb", buffering=0) as f:
+            sizes = [1, 5, 2, 11, 3]
+            pos = 0
+            while pos < len(data):
+                size = sizes[pos % len(sizes)]
+                f.write(data[pos:pos + size])
+                pos += size
+                if pos % 13 == 0:
+                    time.sleep(0.0001)
+
+    t = threading.Thread(target=write)
+    t.start()
+    with os.fdopen(r, "rb") as f:
+        monkeypatch.setattr(storm, "READER", storm.Reader(f, chunk_size))
+        monkeypatch.setattr(storm, "BINARY", False)
+        assert [storm.readMsg() for _ in msgs] == msgs
+        storm.BINARY = True
+        for frame in frames:
+            msg = storm.readMsg()
+            assert msg["id"] == frame["id"]
+            np.testing.assert_array_equal(msg["tuple"][0], frame["tuple"][0])
+            assert msg["tuple"][1] == frame["tuple"][1]
+        t.join()
+        with pytest.raises(Exception, match="EOF"):
+            storm.readMsg()
+
+
+# more arrays than the ring holds: the producer wraps around to the slots
+# released by the consumer, and gets None while the ring is full
+def test_shm_ring(tmp_path):
+    path = str(tmp_path / "ring")
+    producer = storm.ShmRing.create(path, 4, 64)
+    consumer = storm.ShmRing(path)
+    assert producer.pack(np.zeros(17, dtype=np.int32)) is None
+    pending = []
+    for i in range(10):
+        array = np.arange(i, i + 16, dtype=np.int32)
+        ext = producer.pack(array)
+        if ext is None:
+            assert len(pending) == 4
+            slot, nbytes, code, expected = pending.pop(0)
+            data = consumer.view(slot, nbytes)
+            np.testing.assert_array_equal(
+                np.frombuffer(data, dtype=storm.EXT_DTYPES[code]), expected)
+            consumer.release(slot)
+            ext = producer.pack(array)
+        assert ext.code == storm.EXT_SHM
+        slot, nbytes, code = struct.unpack("<iiB", ext.data)
+        assert slot == i % 4 and nbytes == array.nbytes
+        pending.append((slot, nbytes, code, array))
+    for slot, nbytes, code, expected in pending:
+        np.testing.assert_array_equal(
+            np.frombuffer(consumer.view(slot, nbytes),
+                          dtype=storm.EXT_DTYPES[code]), expected)
+        consumer.release(slot)
+    assert not producer.flags.any()
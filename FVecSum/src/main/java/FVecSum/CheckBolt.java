@@ -14,7 +14,7 @@ package FVecSum;
 
 import java.io.IOException;
 import java.util.Map;
-import java.util.ArrayList;
+import java.util.List;
 import org.apache.storm.task.TopologyContext;
 import org.apache.storm.topology.BasicOutputCollector;
 import org.apache.storm.topology.OutputFieldsDeclarer;
@@ -33,6 +33,7 @@ public class CheckBolt extends BaseBasicBolt {
 
     private Sampler latency;
     private static final long samplingRate = 0; // adds every element
+    private static final long snapshotSeconds = 10; // dumps of metric_*.json
     private long count;
 
 
@@ -40,20 +41,26 @@ public class CheckBolt extends BaseBasicBolt {
     public void prepare(Map<String,Object> topoConf, TopologyContext context) {
         latency = new Sampler(samplingRate);
         count = 0;
+        MetricGroup.add("latency", latency);
+        MetricGroup.startSnapshots(snapshotSeconds);
     }
 
     @Override
     public void execute(Tuple tuple, BasicOutputCollector collector) {
-        ArrayList<Long> result = (ArrayList<Long>)tuple.getValue(0);
-        long timestamp = (long)tuple.getValue(1);
+        int[] result = ints(tuple.getValue(0));
+        int[] offsets = ints(tuple.getValue(1));
+        long timestamp = (long)tuple.getValue(2);
 
-        boolean first = true;
+        // every vector of the packed result is [count, 1, 1, ...]
         boolean success = true;
-        for (Long r : result) {
-            if (first == true) {
-                first = false;
-            } else {
-                if (r != 1) {
+        for (int j = 0; j < offsets[0] && success; ++j) {
+            int offset = offsets[1 + 2 * j];
+            int length = offsets[2 + 2 * j];
+            if (result[offset] != result[0]) {
+                success = false;
+            }
+            for (int i = offset + 1; i < offset + length; ++i) {
+                if (result[i] != 1) {
                     success = false;
                     break;
                 }
@@ -69,10 +76,23 @@ public class CheckBolt extends BaseBasicBolt {
         this.count += 1;
     }
 
+    // binary multilang framing delivers primitive arrays, JSON framing
+    // (the fallback) delivers lists of numbers
+    private static int[] ints(Object value) {
+        if (value instanceof int[]) {
+            return (int[])value;
+        }
+        List<Number> list = (List<Number>)value;
+        int[] array = new int[list.size()];
+        for (int i = 0; i < array.length; ++i) {
+            array[i] = list.get(i).intValue();
+        }
+        return array;
+    }
+
     @Override
     public void cleanup() {
         try {
-            MetricGroup.add("latency", latency);
             MetricGroup.dumpAll();
         } catch (IOException e) {
             System.out.println("An error occurred.");
@@ -1,21 +1,50 @@
 package FVecSum;
 
+import java.util.Collections;
 import java.util.Map;
+import org.apache.storm.metric.api.rpc.AssignableShellMetric;
+import org.apache.storm.task.OutputCollector;
 import org.apache.storm.task.ShellBolt;
+import org.apache.storm.task.TopologyContext;
 import org.apache.storm.topology.IRichBolt;
 import org.apache.storm.topology.OutputFieldsDeclarer;
 import org.apache.storm.tuple.Fields;
 
 public class FBolt extends ShellBolt implements IRichBolt {
 
+    // seconds between two reports of the metrics sent by fbolt.py
+    final static int metricsBucketSize = 10;
+
     public FBolt() {
         super("/usr/bin/python3", "fbolt.py");
         // this.changeChildCWD(false);
     }
 
+    // the subprocess forwards the tuples to the broker listening on the
+    // socket (python3 broker.py --socket ...), which owns the device of the host
+    public FBolt(String broker) {
+        this();
+        if (broker != null) {
+            setEnv(Collections.singletonMap("FBOLT_BROKER", broker));
+        }
+    }
+
+    @Override
+    public void prepare(Map<String, Object> topoConf, TopologyContext context, OutputCollector collector) {
+        // metrics updated by the subprocess through storm.rpcMetrics
+        context.registerMetric("fbolt-depth", new AssignableShellMetric(0), metricsBucketSize);
+        context.registerMetric("fbolt-latency", new AssignableShellMetric(null), metricsBucketSize);
+        context.registerMetric("fbolt-saturation", new AssignableShellMetric(null), metricsBucketSize);
+        context.registerMetric("fbolt-startup", new AssignableShellMetric(null), metricsBucketSize);
+        context.registerMetric("fbolt-broker", new AssignableShellMetric(null), metricsBucketSize);
+        context.registerMetric("fbolt-routing", new AssignableShellMetric(null), metricsBucketSize);
+        context.registerMetric("fbolt-pool", new AssignableShellMetric(null), metricsBucketSize);
+        super.prepare(topoConf, context, collector);
+    }
+
     @Override
     public void declareOutputFields(OutputFieldsDeclarer declarer) {
-        declarer.declare(new Fields("result", "timestamp"));
+        declarer.declare(new Fields("result", "offsets", "timestamp"));
     }
 
     @Override
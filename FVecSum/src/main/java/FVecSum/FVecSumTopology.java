@@ -1,11 +1,16 @@
 package FVecSum;
 
+import org.apache.storm.Config;
 import org.apache.storm.topology.ConfigurableTopology;
 import org.apache.storm.topology.TopologyBuilder;
 
 public class FVecSumTopology extends ConfigurableTopology {
 
     final static String topologyName = "FVecSum";
+    final static int maxSpoutPending = 1024;
+    // socket of the device broker of the hosts, e.g. -c fvecsum.broker=/tmp/fbolt-broker.sock
+    final static String BROKER = "fvecsum.broker";
+    final static String PARALLELISM = "fvecsum.fbolt.parallelism";
 
     public static void main(String[] args) throws Exception {
         ConfigurableTopology.start(new FVecSumTopology(), args);
@@ -16,15 +21,31 @@ public class FVecSumTopology extends ConfigurableTopology {
 
         TopologyBuilder builder = new TopologyBuilder();
         builder.setSpout("spout", new RandomVecSpout(), 1);
-        builder.setBolt("fbolt", new FBolt(), 1).shuffleGrouping("spout");
+        // with a broker many executors of a host can share its device
+        String broker = (String) conf.get(BROKER);
+        int parallelism = ((Number) conf.getOrDefault(PARALLELISM, 1)).intValue();
+        builder.setBolt("fbolt", new FBolt(broker), parallelism).shuffleGrouping("spout");
         builder.setBolt("check", new CheckBolt(), 1).shuffleGrouping("fbolt");
 
         // conf.setDebug(true);
         conf.setNumWorkers(3);
+        // FBolt stops reading tuples while saturated, the spout must stop too
+        conf.setMaxSpoutPending(maxSpoutPending);
         // conf.setTopologyWorkerMaxHeapSize(2048);
+        // packed tuples as fast as the pending window allows, override with
+        // e.g. -c fvecsum.spout.rate=20000 -c fvecsum.spout.vectors=4
+        conf.putIfAbsent(RandomVecSpout.RATE, 0);
+        conf.putIfAbsent(RandomVecSpout.VECTORS, 1);
 
         conf.registerSerialization(org.apache.storm.shade.org.json.simple.JSONArray.class);
 
+        // binary framing between FBolt and fbolt.py (falls back to JSON)
+        conf.put(Config.TOPOLOGY_MULTILANG_SERIALIZER, MsgpackSerializer.class.getName());
+        // arrays through shared memory rings in /dev/shm, the pipe carries
+        // only their references (one slot holds a whole vector)
+        conf.put(MsgpackSerializer.SHM_SLOTS, 512);
+        conf.put(MsgpackSerializer.SHM_SLOT_BYTES, 4 * RandomVecSpout.max_size);
+
         return submit(topologyName, conf, builder);
     }
 }
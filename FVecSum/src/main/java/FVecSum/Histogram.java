@@ -0,0 +1,86 @@
+package FVecSum;
+
+import java.io.Serializable;
+
+// Log-linear histogram of non-negative values in the style of HdrHistogram
+// (as FHistogram in CLFPGA.py): every power of two is split in 2^subBits
+// buckets, so the relative error of the quantiles is below 2^-subBits and
+// the memory does not grow with the samples. Histograms with the same
+// layout merge exactly by adding their counts.
+public class Histogram implements Serializable {
+    private final int subBits;
+    private final int subCount;
+    private final long maxValue;
+    private final long[] counts;
+    private long total;
+
+    // constructor
+    public Histogram() {
+        this(5, 40);
+    }
+
+    // constructor
+    public Histogram(int subBits, int maxBits) {
+        this.subBits = subBits;
+        this.subCount = 1 << subBits;
+        this.maxValue = (1L << maxBits) - 1;
+        this.counts = new long[(maxBits - subBits + 1) * subCount];
+        this.total = 0;
+    }
+
+    private int index(long value) {
+        if (value < subCount) {
+            return (int) Math.max(value, 0);
+        }
+        int shift = 64 - Long.numberOfLeadingZeros(value) - subBits - 1;
+        return (shift + 1) * subCount + (int) (value >> shift) - subCount;
+    }
+
+    // lowest value of the index-th bucket
+    private long valueAt(int index) {
+        int b = index / subCount;
+        int s = index % subCount;
+        if (b == 0) {
+            return s;
+        }
+        return ((long) (s + subCount)) << (b - 1);
+    }
+
+    // record method
+    public void record(long value) {
+        counts[index(Math.min(value, maxValue))]++;
+        total++;
+    }
+
+    // merge method
+    public void merge(Histogram other) {
+        if (other.counts.length != counts.length || other.subBits != subBits) {
+            throw new IllegalArgumentException("histograms with different layouts");
+        }
+        for (int i = 0; i < counts.length; ++i) {
+            counts[i] += other.counts[i];
+        }
+        total += other.total;
+    }
+
+    // highest value equivalent to the q-quantile (0 < q <= 1)
+    public long percentile(double q) {
+        if (total == 0) {
+            return 0;
+        }
+        long rank = Math.max((long) Math.ceil(q * total), 1);
+        long seen = 0;
+        for (int i = 0; i < counts.length; ++i) {
+            seen += counts[i];
+            if (seen >= rank) {
+                return valueAt(i + 1) - 1;
+            }
+        }
+        return maxValue;
+    }
+
+    // getTotal method
+    public long getTotal() {
+        return total;
+    }
+}
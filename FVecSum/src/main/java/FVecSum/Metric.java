@@ -1,76 +1,111 @@
 package FVecSum;
 
+import java.io.File;
 import java.io.FileWriter;
 import java.io.IOException;
 import java.io.Serializable;
-import java.util.ArrayList;
+import java.util.Arrays;
+import java.util.Comparator;
 
 // Metric class
+// Merge of the samplers of a group: counts, sums, min, max and histograms
+// merge exactly, the window keeps the last Sampler.WINDOW samples of all
+// the samplers by timestamp.
 public class Metric implements Serializable {
     private String name;
     private String fileName;
-    private ArrayList<Double> descriptiveStatistics;
     private long total;
-
-    private Double mean;
-    private Double mean_last_2000;
-    private Double min;
-    private Double max;
+    private long samples;
+    private double sum;
+    private double min;
+    private double max;
+    private double resolution;
+    private Histogram histogram;
+    private double[] windowValues;
+    private long[] windowTimestamps;
+    private int windowSize;
 
     // constructor
     public Metric(String name) {
         this.name = name;
         fileName = String.format("metric_%s.json", name);
-        this.descriptiveStatistics = new ArrayList<Double>();
-        this.mean = Double.MAX_VALUE;
+        this.total = 0;
+        this.samples = 0;
+        this.sum = 0;
         this.min = Double.MAX_VALUE;
-        this.max = Double.MIN_VALUE;
-        this.mean_last_2000 = Double.MAX_VALUE;
+        this.max = -Double.MAX_VALUE;
+        this.resolution = 0;
+        this.histogram = new Histogram();
+        this.windowValues = new double[0];
+        this.windowTimestamps = new long[0];
+        this.windowSize = 0;
     }
 
-    // add method
-    public void add(double value) {
-        descriptiveStatistics.add(value);
-    }
+    // merge method, called under the lock of the sampler
+    void merge(Sampler sampler) {
+        if (resolution == 0) {
+            resolution = sampler.getResolution();
+        } else if (resolution != sampler.getResolution()) {
+            throw new IllegalArgumentException("samplers with different resolutions");
+        }
+        total += sampler.getTotal();
+        samples += sampler.getSamples();
+        sum += sampler.sum;
+        min = Math.min(min, sampler.min);
+        max = Math.max(max, sampler.max);
+        histogram.merge(sampler.histogram);
 
-    // setTotal method
-    public void setTotal(long total) {
-        this.total = total;
+        // the most recent samples of both windows
+        int n = (int) Math.min(sampler.getSamples(), Sampler.WINDOW);
+        double[] values = Arrays.copyOf(windowValues, windowSize + n);
+        long[] timestamps = Arrays.copyOf(windowTimestamps, windowSize + n);
+        System.arraycopy(sampler.windowValues, 0, values, windowSize, n);
+        System.arraycopy(sampler.windowTimestamps, 0, timestamps, windowSize, n);
+        Integer[] order = new Integer[values.length];
+        for (int i = 0; i < order.length; ++i) {
+            order[i] = i;
+        }
+        Arrays.sort(order, Comparator.comparingLong(i -> timestamps[i]));
+        windowSize = Math.min(order.length, Sampler.WINDOW);
+        windowValues = new double[windowSize];
+        windowTimestamps = new long[windowSize];
+        for (int i = 0; i < windowSize; ++i) {
+            int j = order[order.length - windowSize + i];
+            windowValues[i] = values[j];
+            windowTimestamps[i] = timestamps[j];
+        }
     }
 
-    private void update() {
-        Double sum = 0.0;
-        Double sum_last = 0.0;
-        int size = descriptiveStatistics.size();
-        for (int i = 0; i < size; i++) {
-            Double d = descriptiveStatistics.get(i);
-            sum += d;
-            if (this.min > d) this.min = d;
-            if (this.max < d) this.max = d;
-            if (i >= (size - 2000 + 1)) {
-                sum_last += d;
-            }
-        }
-        this.mean =  sum / size;
+    private double quantile(double q) {
+        return histogram.percentile(q) * resolution;
+    }
 
-        if (size >= 2000) {
-            this.mean_last_2000 = sum_last / 2000;
-        } else {
-            this.mean_last_2000 = sum_last / size;
+    private double windowMean() {
+        double sum = 0;
+        for (int i = 0; i < windowSize; ++i) {
+            sum += windowValues[i];
         }
+        return sum / windowSize;
     }
 
-    // dump method
+    // dump method, the file is replaced atomically by every snapshot
     public void dump() throws IOException {
-        this.update();
-        FileWriter writer = new FileWriter(fileName);
+        File tmp = new File(fileName + ".tmp");
+        FileWriter writer = new FileWriter(tmp);
         writer.write("name: " + name + ", \n");
-        writer.write("samples: " + descriptiveStatistics.size() + ", \n");
+        writer.write("samples: " + samples + ", \n");
         writer.write("total: " + total + ", \n");
-        writer.write("mean: " + this.mean + ", \n");
-        writer.write("mean(last 2000): " + this.mean_last_2000 + ", \n");
-        writer.write("min: " + this.min + ", \n");
-        writer.write("max: " + this.max + ", \n");
+        writer.write("mean: " + sum / samples + ", \n");
+        writer.write("mean(last " + Sampler.WINDOW + "): " + windowMean() + ", \n");
+        writer.write("min: " + min + ", \n");
+        writer.write("max: " + max + ", \n");
+        writer.write("p50: " + quantile(0.5) + ", \n");
+        writer.write("p90: " + quantile(0.9) + ", \n");
+        writer.write("p99: " + quantile(0.99) + ", \n");
+        writer.write("p999: " + quantile(0.999) + ", \n");
         writer.close();
+        if (!tmp.renameTo(new File(fileName))) {
+            throw new IOException("cannot replace " + fileName);
+        }
     }
 }
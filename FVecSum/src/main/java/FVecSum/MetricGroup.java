@@ -1,24 +1,49 @@
 package FVecSum;
 
-import java.util.Stack;
+import java.util.ArrayList;
+import java.util.List;
 import java.util.HashMap;
 import java.io.IOException;
 
 // MetricGroup class
+// Samplers are registered when the executors start, the metrics merge
+// all the samplers of a name and are dumped periodically and at cleanup.
 public class MetricGroup {
-    private static HashMap<String, Stack<Sampler>> map;
+    private static HashMap<String, List<Sampler>> map;
+    private static Thread snapshots;
     static {
         map = new HashMap<>();
     }
 
     // this is not time critical, making the whole method synchronized is good enough
     public static synchronized void add(String name, Sampler sampler) {
-        Stack<Sampler> samplers = map.computeIfAbsent(name, key -> new Stack<>());
+        List<Sampler> samplers = map.computeIfAbsent(name, key -> new ArrayList<>());
         samplers.add(sampler);
     }
 
-    // this consumes the groups
-    public static void dumpAll() throws IOException {
+    // dumps all the metrics every periodSeconds (once per worker)
+    public static synchronized void startSnapshots(long periodSeconds) {
+        if (snapshots != null || periodSeconds <= 0) {
+            return;
+        }
+        snapshots = new Thread(() -> {
+            while (true) {
+                try {
+                    Thread.sleep(periodSeconds * 1000);
+                    dumpAll();
+                } catch (InterruptedException e) {
+                    return;
+                } catch (IOException e) {
+                    e.printStackTrace();
+                }
+            }
+        }, "metric-snapshots");
+        snapshots.setDaemon(true);
+        snapshots.start();
+    }
+
+    // the samplers keep recording, every dump is a fresh merge
+    public static synchronized void dumpAll() throws IOException {
         for (String name : map.keySet()) {
             Metric metric = getMetric(name);
             metric.dump();
@@ -28,15 +53,8 @@ public class MetricGroup {
     // getMetric method
     private static Metric getMetric(String name) {
         Metric metric = new Metric(name);
-        // consume all the groups
-        Stack<Sampler> samplers = map.get(name);
-        while (!samplers.empty()) {
-            Sampler sampler = samplers.pop();
-            metric.setTotal(sampler.getTotal());
-            // add all the values from the sampler
-            for (double value : sampler.getValues()) {
-                metric.add(value);
-            }
+        for (Sampler sampler : map.get(name)) {
+            sampler.snapshot(metric);
         }
         return metric;
     }
@@ -0,0 +1,454 @@
+package FVecSum;
+
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.EOFException;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.OutputStream;
+import java.nio.ByteBuffer;
+import java.nio.ByteOrder;
+import java.nio.charset.StandardCharsets;
+import java.util.ArrayList;
+import java.util.HashMap;
+import java.util.List;
+import java.util.Map;
+import java.util.concurrent.ConcurrentHashMap;
+import org.apache.storm.multilang.BoltMsg;
+import org.apache.storm.multilang.ISerializer;
+import org.apache.storm.multilang.JsonSerializer;
+import org.apache.storm.multilang.NoOutputException;
+import org.apache.storm.multilang.ShellMsg;
+import org.apache.storm.multilang.SpoutMsg;
+import org.apache.storm.shade.org.json.simple.JSONObject;
+import org.apache.storm.shade.org.json.simple.JSONValue;
+import org.apache.storm.task.TopologyContext;
+import org.apache.storm.utils.Utils;
+import org.msgpack.core.MessageBufferPacker;
+import org.msgpack.core.MessagePack;
+import org.msgpack.core.MessageUnpacker;
+import org.msgpack.value.ExtensionValue;
+import org.msgpack.value.Value;
+
+// Multilang serializer with length-prefixed MessagePack framing.
+// The handshake is plain JSON: the setup message offers "msgpack" and the
+// subprocess accepts it in its pid reply, otherwise JSON is used.
+// Numeric arrays travel as raw little-endian extension types (see storm.py).
+// With fbolt.shm.slots > 0 the arrays are placed in two ShmRings instead
+// (one per direction) and the messages carry only an EXT_SHM reference:
+// [slot, length in bytes, element type]. Input slots are released when
+// the subprocess acks or fails the tuple, output slots once decoded.
+// Arrays that do not fit, or find no free slot, are sent inline.
+public class MsgpackSerializer implements ISerializer {
+
+    public static final byte EXT_INT32 = 1;
+    public static final byte EXT_INT64 = 2;
+    public static final byte EXT_FLOAT32 = 3;
+    public static final byte EXT_FLOAT64 = 4;
+    public static final byte EXT_SHM = 16;
+
+    public static final String SHM_SLOTS = "fbolt.shm.slots";
+    public static final String SHM_SLOT_BYTES = "fbolt.shm.slot.bytes";
+
+    private OutputStream rawIn;
+    private InputStream rawOut;
+    private DataOutputStream processIn;
+    private DataInputStream processOut;
+    private JsonSerializer json;
+    private boolean binary;
+    private ShmRing inRing;
+    private ShmRing outRing;
+    // input slots of the tuples not yet acked or failed
+    private final Map<Object, List<Integer>> inSlots = new ConcurrentHashMap<>();
+    private List<Integer> packedSlots;
+
+    @Override
+    public void initialize(OutputStream processIn, InputStream processOut) {
+        this.rawIn = processIn;
+        this.rawOut = processOut;
+        // fallback, used when the subprocess does not accept msgpack
+        this.json = new JsonSerializer();
+        this.json.initialize(processIn, processOut);
+        this.binary = false;
+    }
+
+    @Override
+    public Number connect(Map<String, Object> conf, TopologyContext context) throws IOException, NoOutputException {
+        JSONObject setupInfo = new JSONObject();
+        setupInfo.put("pidDir", context.getPIDDir());
+        setupInfo.put("conf", conf);
+        setupInfo.put("context", context);
+        setupInfo.put("serializer", "msgpack");
+        Object slots = conf.get(SHM_SLOTS);
+        Object slotBytes = conf.get(SHM_SLOT_BYTES);
+        if (slots instanceof Number && slotBytes instanceof Number) {
+            inRing = ShmRing.create("fbolt-in-", ((Number) slots).intValue(), ((Number) slotBytes).intValue());
+            outRing = ShmRing.create("fbolt-out-", ((Number) slots).intValue(), ((Number) slotBytes).intValue());
+        }
+        if (inRing != null && outRing != null) {
+            Map<String, String> shm = new HashMap<>();
+            shm.put("in", inRing.path());
+            shm.put("out", outRing.path());
+            setupInfo.put("shm", shm);
+        }
+        writeJson(setupInfo);
+
+        JSONObject reply = (JSONObject) readJson();
+        binary = "msgpack".equals(reply.get("serializer"));
+        if (binary) {
+            processIn = new DataOutputStream(new BufferedOutputStream(rawIn));
+            processOut = new DataInputStream(new BufferedInputStream(rawOut));
+        }
+        // the subprocess has mapped the rings (or refused them)
+        if (inRing != null) {
+            inRing.unlink();
+            outRing.unlink();
+        }
+        if (!binary || !Boolean.TRUE.equals(reply.get("shm"))) {
+            inRing = null;
+            outRing = null;
+        }
+        return (Number) reply.get("pid");
+    }
+
+    @Override
+    public ShellMsg readShellMsg() throws IOException, NoOutputException {
+        if (!binary) {
+            return json.readShellMsg();
+        }
+
+        Map<String, Object> msg = (Map<String, Object>) readMessage();
+        ShellMsg shellMsg = new ShellMsg();
+
+        String command = (String) msg.get("command");
+        shellMsg.setCommand(command);
+        shellMsg.setId(msg.get("id"));
+
+        if (("ack".equals(command) || "fail".equals(command)) && msg.get("id") != null) {
+            List<Integer> slots = inSlots.remove(msg.get("id"));
+            if (slots != null) {
+                for (int slot : slots) {
+                    inRing.release(slot);
+                }
+            }
+        }
+        shellMsg.setMsg((String) msg.get("msg"));
+
+        String stream = (String) msg.get("stream");
+        if (stream == null) {
+            stream = Utils.DEFAULT_STREAM_ID;
+        }
+        shellMsg.setStream(stream);
+
+        Object task = msg.get("task");
+        shellMsg.setTask(task != null ? ((Number) task).longValue() : 0);
+
+        Object needTaskIds = msg.get("need_task_ids");
+        shellMsg.setNeedTaskIds(needTaskIds == null || (Boolean) needTaskIds);
+
+        shellMsg.setTuple((List<Object>) msg.get("tuple"));
+
+        Object anchors = msg.get("anchors");
+        if (anchors instanceof String) {
+            shellMsg.addAnchor((String) anchors);
+        } else if (anchors != null) {
+            for (Object o : (List<Object>) anchors) {
+                shellMsg.addAnchor((String) o);
+            }
+        }
+
+        Object name = msg.get("name");
+        shellMsg.setMetricName(name instanceof String ? (String) name : null);
+        shellMsg.setMetricParams(msg.get("params"));
+
+        if ("log".equals(command)) {
+            Object level = msg.get("level");
+            if (level instanceof Number) {
+                shellMsg.setLogLevel(((Number) level).intValue());
+            }
+        }
+        return shellMsg;
+    }
+
+    @Override
+    public void writeBoltMsg(BoltMsg boltMsg) throws IOException {
+        if (!binary) {
+            json.writeBoltMsg(boltMsg);
+            return;
+        }
+
+        Map<String, Object> msg = new HashMap<>();
+        msg.put("id", boltMsg.getId());
+        msg.put("comp", boltMsg.getComp());
+        msg.put("stream", boltMsg.getStream());
+        msg.put("task", boltMsg.getTask());
+        msg.put("tuple", boltMsg.getTuple());
+
+        // the slots must be known before the subprocess can ack the tuple
+        MessageBufferPacker packer = MessagePack.newDefaultBufferPacker();
+        packedSlots = new ArrayList<>();
+        pack(packer, msg);
+        if (!packedSlots.isEmpty() && boltMsg.getId() != null) {
+            inSlots.put(boltMsg.getId(), packedSlots);
+        }
+        packedSlots = null;
+        writeBody(packer.toByteArray());
+    }
+
+    @Override
+    public void writeSpoutMsg(SpoutMsg spoutMsg) throws IOException {
+        if (!binary) {
+            json.writeSpoutMsg(spoutMsg);
+            return;
+        }
+
+        Map<String, Object> msg = new HashMap<>();
+        msg.put("command", spoutMsg.getCommand());
+        msg.put("id", spoutMsg.getId());
+        writeMessage(msg);
+    }
+
+    @Override
+    public void writeTaskIds(List<Integer> taskIds) throws IOException {
+        if (!binary) {
+            json.writeTaskIds(taskIds);
+            return;
+        }
+        // a plain array: storm.readTaskIds waits for a list
+        MessageBufferPacker packer = MessagePack.newDefaultBufferPacker();
+        packer.packArrayHeader(taskIds.size());
+        for (Integer id : taskIds) {
+            packer.packInt(id);
+        }
+        writeBody(packer.toByteArray());
+    }
+
+    // JSON handshake, same wire format as the multilang JsonSerializer.
+    // It is unbuffered so that nothing is consumed past the pid reply.
+    private void writeJson(Object msg) throws IOException {
+        rawIn.write(JSONValue.toJSONString(msg).getBytes(StandardCharsets.UTF_8));
+        rawIn.write("\nend\n".getBytes(StandardCharsets.UTF_8));
+        rawIn.flush();
+    }
+
+    private Object readJson() throws IOException, NoOutputException {
+        ByteArrayOutputStream line = new ByteArrayOutputStream();
+        StringBuilder msg = new StringBuilder();
+        while (true) {
+            int c = rawOut.read();
+            if (c == -1) {
+                throw new NoOutputException("Pipe to subprocess seems to be broken!");
+            }
+            if (c != '\n') {
+                line.write(c);
+                continue;
+            }
+            String l = new String(line.toByteArray(), StandardCharsets.UTF_8);
+            line.reset();
+            if (l.equals("end")) {
+                break;
+            }
+            msg.append(l).append("\n");
+        }
+        return JSONValue.parse(msg.toString());
+    }
+
+    private void writeMessage(Object msg) throws IOException {
+        MessageBufferPacker packer = MessagePack.newDefaultBufferPacker();
+        pack(packer, msg);
+        writeBody(packer.toByteArray());
+    }
+
+    private void writeBody(byte[] body) throws IOException {
+        processIn.writeInt(body.length);
+        processIn.write(body);
+        processIn.flush();
+    }
+
+    private Object readMessage() throws IOException, NoOutputException {
+        byte[] body;
+        try {
+            body = new byte[processOut.readInt()];
+            processOut.readFully(body);
+        } catch (EOFException e) {
+            throw new NoOutputException("Pipe to subprocess seems to be broken!");
+        }
+        MessageUnpacker unpacker = MessagePack.newDefaultUnpacker(body);
+        return unpack(unpacker.unpackValue());
+    }
+
+    private void pack(MessageBufferPacker packer, Object o) throws IOException {
+        if (o == null) {
+            packer.packNil();
+        } else if (o instanceof Boolean) {
+            packer.packBoolean((Boolean) o);
+        } else if (o instanceof Float || o instanceof Double) {
+            packer.packDouble(((Number) o).doubleValue());
+        } else if (o instanceof Number) {
+            packer.packLong(((Number) o).longValue());
+        } else if (o instanceof String) {
+            packer.packString((String) o);
+        } else if (o instanceof byte[]) {
+            byte[] b = (byte[]) o;
+            packer.packBinaryHeader(b.length);
+            packer.writePayload(b);
+        } else if (o instanceof int[]) {
+            int[] a = (int[]) o;
+            ArrayTarget t = target(4 * a.length);
+            t.bb.asIntBuffer().put(a);
+            t.pack(packer, EXT_INT32);
+        } else if (o instanceof long[]) {
+            long[] a = (long[]) o;
+            ArrayTarget t = target(8 * a.length);
+            t.bb.asLongBuffer().put(a);
+            t.pack(packer, EXT_INT64);
+        } else if (o instanceof float[]) {
+            float[] a = (float[]) o;
+            ArrayTarget t = target(4 * a.length);
+            t.bb.asFloatBuffer().put(a);
+            t.pack(packer, EXT_FLOAT32);
+        } else if (o instanceof double[]) {
+            double[] a = (double[]) o;
+            ArrayTarget t = target(8 * a.length);
+            t.bb.asDoubleBuffer().put(a);
+            t.pack(packer, EXT_FLOAT64);
+        } else if (o instanceof List) {
+            // lists stay msgpack arrays (e.g., the tuple fields and the task
+            // ids), only primitive arrays travel as raw arrays
+            List<Object> l = (List<Object>) o;
+            packer.packArrayHeader(l.size());
+            for (Object v : l) {
+                pack(packer, v);
+            }
+        } else if (o instanceof Map) {
+            Map<Object, Object> m = (Map<Object, Object>) o;
+            packer.packMapHeader(m.size());
+            for (Map.Entry<Object, Object> e : m.entrySet()) {
+                pack(packer, e.getKey().toString());
+                pack(packer, e.getValue());
+            }
+        } else {
+            packer.packString(o.toString());
+        }
+    }
+
+    private static void packExt(MessageBufferPacker packer, byte type, byte[] payload) throws IOException {
+        packer.packExtensionTypeHeader(type, payload.length);
+        packer.writePayload(payload);
+    }
+
+    // Destination of an array being packed: a free slot of the input ring
+    // (tuples only) or a heap buffer sent inline
+    private class ArrayTarget {
+        final ByteBuffer bb;
+        final int slot;
+        final int length;
+
+        ArrayTarget(ByteBuffer bb, int slot, int length) {
+            this.bb = bb;
+            this.slot = slot;
+            this.length = length;
+        }
+
+        void pack(MessageBufferPacker packer, byte type) throws IOException {
+            if (slot < 0) {
+                packExt(packer, type, bb.array());
+                return;
+            }
+            ByteBuffer ref = ByteBuffer.allocate(9).order(ByteOrder.LITTLE_ENDIAN);
+            ref.putInt(slot).putInt(length).put(type);
+            packExt(packer, EXT_SHM, ref.array());
+        }
+    }
+
+    private ArrayTarget target(int length) {
+        if (inRing != null && packedSlots != null && length <= inRing.slotSize()) {
+            int slot = inRing.alloc();
+            if (slot >= 0) {
+                packedSlots.add(slot);
+                return new ArrayTarget(inRing.slice(slot, length), slot, length);
+            }
+        }
+        return new ArrayTarget(ByteBuffer.allocate(length).order(ByteOrder.LITTLE_ENDIAN), -1, length);
+    }
+
+    private Object unpack(Value v) {
+        switch (v.getValueType()) {
+            case NIL:
+                return null;
+            case BOOLEAN:
+                return v.asBooleanValue().getBoolean();
+            case INTEGER:
+                return v.asIntegerValue().toLong();
+            case FLOAT:
+                return v.asFloatValue().toDouble();
+            case STRING:
+                return v.asStringValue().asString();
+            case BINARY:
+                return v.asBinaryValue().asByteArray();
+            case ARRAY: {
+                List<Object> l = new ArrayList<>();
+                for (Value e : v.asArrayValue()) {
+                    l.add(unpack(e));
+                }
+                return l;
+            }
+            case MAP: {
+                Map<String, Object> m = new HashMap<>();
+                for (Map.Entry<Value, Value> e : v.asMapValue().entrySet()) {
+                    m.put(unpack(e.getKey()).toString(), unpack(e.getValue()));
+                }
+                return m;
+            }
+            case EXTENSION:
+                return unpackExt(v.asExtensionValue());
+            default:
+                throw new IllegalArgumentException("Unsupported msgpack type " + v.getValueType());
+        }
+    }
+
+    private Object unpackExt(ExtensionValue ext) {
+        ByteBuffer bb = ByteBuffer.wrap(ext.getData()).order(ByteOrder.LITTLE_ENDIAN);
+        if (ext.getType() == EXT_SHM && outRing != null) {
+            // copied out of the output ring, then the slot is given back
+            int slot = bb.getInt();
+            int length = bb.getInt();
+            byte type = bb.get();
+            Object array = toArray(type, outRing.slice(slot, length));
+            outRing.release(slot);
+            return array != null ? array : ext.getData();
+        }
+        Object array = toArray(ext.getType(), bb);
+        return array != null ? array : ext.getData();
+    }
+
+    private static Object toArray(byte type, ByteBuffer bb) {
+        switch (type) {
+            case EXT_INT32: {
+                int[] a = new int[bb.remaining() / 4];
+                bb.asIntBuffer().get(a);
+                return a;
+            }
+            case EXT_INT64: {
+                long[] a = new long[bb.remaining() / 8];
+                bb.asLongBuffer().get(a);
+                return a;
+            }
+            case EXT_FLOAT32: {
+                float[] a = new float[bb.remaining() / 4];
+                bb.asFloatBuffer().get(a);
+                return a;
+            }
+            case EXT_FLOAT64: {
+                double[] a = new double[bb.remaining() / 8];
+                bb.asDoubleBuffer().get(a);
+                return a;
+            }
+            default:
+                return null;
+        }
+    }
+}
@@ -1,7 +1,6 @@
 package FVecSum;
 
 import java.util.Map;
-import java.util.ArrayList;
 import java.util.Random;
 import org.apache.storm.spout.SpoutOutputCollector;
 import org.apache.storm.task.TopologyContext;
@@ -9,43 +8,74 @@ import org.apache.storm.topology.OutputFieldsDeclarer;
 import org.apache.storm.topology.base.BaseRichSpout;
 import org.apache.storm.tuple.Fields;
 import org.apache.storm.tuple.Values;
-import org.apache.storm.utils.Utils;
 
+// Emits packed tuples: A and B hold `vectors` vectors back to back as
+// primitive int[], offsets is [n, offset_0, length_0, ...] (the layout of
+// the FBolt batches). Every vector sums to [count, 1, 1, ...].
 public class RandomVecSpout extends BaseRichSpout {
 
     final static int max_size = 8 * 1024;
 
+    // tuples per second, 0 (default) emits as fast as max spout pending allows
+    public static final String RATE = "fvecsum.spout.rate";
+    // vectors packed in each tuple, they fit in max_size elements together
+    public static final String VECTORS = "fvecsum.spout.vectors";
+
     SpoutOutputCollector collector;
     Random rand;
-    Integer count;
+    int count;
+    double rate;
+    int vectors;
+    long start;
 
     @Override
     public void open(Map<String, Object> conf, TopologyContext context, SpoutOutputCollector collector) {
         this.collector = collector;
         rand = new Random();
         this.count = 0;
+        Object rate = conf.get(RATE);
+        this.rate = rate instanceof Number ? ((Number) rate).doubleValue() : 0;
+        Object vectors = conf.get(VECTORS);
+        this.vectors = vectors instanceof Number ? ((Number) vectors).intValue() : 1;
+        this.vectors = Math.min(Math.max(this.vectors, 1), max_size / 2);
+        this.start = System.nanoTime();
     }
 
     @Override
     public void nextTuple() {
-        Utils.sleep(1);
-
-        Integer size = rand.nextInt(max_size - 1) + 1;
-        ArrayList<Integer> A = new ArrayList<Integer>(size);
-        ArrayList<Integer> B = new ArrayList<Integer>(size);
+        // open loop at the configured rate: returning without emitting lets
+        // the spout wait strategy idle until the next tuple is due
+        if (rate > 0 && System.nanoTime() < start + (long) (count * 1e9 / rate)) {
+            return;
+        }
 
-        A.add(this.count);
-        B.add(0);
-        this.count++;
+        int[] offsets = new int[1 + 2 * vectors];
+        offsets[0] = vectors;
+        int total = 0;
+        for (int j = 0; j < vectors; ++j) {
+            int size = rand.nextInt(max_size / vectors - 1) + 1;
+            offsets[1 + 2 * j] = total;
+            offsets[2 + 2 * j] = size;
+            total += size;
+        }
 
-        for (int i = 1; i < size; ++i) {
-            Integer value = rand.nextInt(max_size);
-            A.add(value + 1);
-            B.add(-value);
+        int[] A = new int[total];
+        int[] B = new int[total];
+        for (int j = 0; j < vectors; ++j) {
+            int offset = offsets[1 + 2 * j];
+            A[offset] = count;
+            B[offset] = 0;
+            for (int i = offset + 1; i < offset + offsets[2 + 2 * j]; ++i) {
+                int value = rand.nextInt(max_size);
+                A[i] = value + 1;
+                B[i] = -value;
+            }
         }
+        this.count++;
 
         long timestamp = System.nanoTime();
-        collector.emit(new Values(A, B, timestamp));
+        // anchored, so that max spout pending bounds the tuples in flight
+        collector.emit(new Values(A, B, offsets, timestamp), timestamp);
     }
 
     @Override
@@ -58,6 +88,6 @@ public class RandomVecSpout extends BaseRichSpout {
 
     @Override
     public void declareOutputFields(OutputFieldsDeclarer declarer) {
-        declarer.declare(new Fields("A", "B", "timestamp"));
+        declarer.declare(new Fields("A", "B", "offsets", "timestamp"));
     }
 }
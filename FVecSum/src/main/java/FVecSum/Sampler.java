@@ -1,16 +1,26 @@
 package FVecSum;
 
-import java.util.List;
-import java.util.ArrayList;
-
 // Sampler class
+// Constant-memory statistics of a stream of values: running count, sum,
+// min and max, a histogram for the quantiles (values are recorded in units
+// of `resolution`) and a sliding window of the last WINDOW samples.
+// add is called by the executor, snapshots are taken by MetricGroup.
 public class Sampler {
+    public static final int WINDOW = 2000;
+
     private final long samplesPerSeconds;
-    private List<Double> samples;
+    private final double resolution;
     private long epoch;
     private long counter;
     private long total;
 
+    double sum;
+    double min;
+    double max;
+    Histogram histogram;
+    final double[] windowValues;
+    final long[] windowTimestamps;
+
     // constructor
     public Sampler() {
         this(0);
@@ -18,11 +28,22 @@ public class Sampler {
 
     // constructor
     public Sampler(long samplesPerSeconds) {
+        this(samplesPerSeconds, 1e-3);
+    }
+
+    // constructor
+    public Sampler(long samplesPerSeconds, double resolution) {
         this.samplesPerSeconds = samplesPerSeconds;
+        this.resolution = resolution;
         epoch = System.nanoTime();
         counter = 0;
         total = 0;
-        samples = new ArrayList<>();
+        sum = 0;
+        min = Double.MAX_VALUE;
+        max = -Double.MAX_VALUE;
+        histogram = new Histogram();
+        windowValues = new double[WINDOW];
+        windowTimestamps = new long[WINDOW];
     }
 
     // add method
@@ -31,23 +52,38 @@ public class Sampler {
     }
 
     // add method
-    public void add(double value, long timestamp) {
+    public synchronized void add(double value, long timestamp) {
         total++;
         // add samples according to the sample rate
         double seconds = (timestamp - epoch) / 1e9;
         if (samplesPerSeconds == 0 || counter <= samplesPerSeconds * seconds) {
-            samples.add(value);
+            sum += value;
+            min = Math.min(min, value);
+            max = Math.max(max, value);
+            histogram.record(Math.round(value / resolution));
+            windowValues[(int) (counter % WINDOW)] = value;
+            windowTimestamps[(int) (counter % WINDOW)] = timestamp;
             counter++;
         }
     }
 
-    // getValues method
-    public List<Double> getValues() {
-        return samples;
+    // merges the current state into the metric
+    public synchronized void snapshot(Metric metric) {
+        metric.merge(this);
+    }
+
+    // getSamples method
+    public long getSamples() {
+        return counter;
     }
 
     // getTotal method
     public long getTotal() {
         return total;
     }
+
+    // getResolution method
+    public double getResolution() {
+        return resolution;
+    }
 }
@@ -0,0 +1,101 @@
+package FVecSum;
+
+import java.io.File;
+import java.io.IOException;
+import java.io.RandomAccessFile;
+import java.nio.ByteBuffer;
+import java.nio.ByteOrder;
+import java.nio.MappedByteBuffer;
+import java.nio.channels.FileChannel;
+
+// Ring of fixed-size slots in a memory-mapped file (e.g., in /dev/shm)
+// shared with the multilang subprocess (see ShmRing in storm.py).
+// Layout (little-endian): [magic, slots, slotSize, dataOffset] at 0,
+// one flag byte per slot at FLAGS_OFFSET, slots from dataOffset.
+// A slot is busy while its flag is not zero: the producer sets it and the
+// consumer clears it once it is done with the data.
+public class ShmRing {
+
+    public static final int MAGIC = 0x46424f4c;
+    public static final int FLAGS_OFFSET = 64;
+    public static final int PAGE_SIZE = 4096;
+
+    private final File file;
+    private final MappedByteBuffer buffer;
+    private final int slots;
+    private final int slotSize;
+    private final int dataOffset;
+    private int cursor;
+
+    public ShmRing(File file, int slots, int slotSize) throws IOException {
+        this.file = file;
+        this.slots = slots;
+        this.slotSize = slotSize;
+        this.dataOffset = ((FLAGS_OFFSET + slots + PAGE_SIZE - 1) / PAGE_SIZE) * PAGE_SIZE;
+        this.cursor = 0;
+
+        long size = dataOffset + (long) slots * slotSize;
+        try (RandomAccessFile raf = new RandomAccessFile(file, "rw")) {
+            raf.setLength(size);
+            buffer = raf.getChannel().map(FileChannel.MapMode.READ_WRITE, 0, size);
+        }
+        buffer.order(ByteOrder.LITTLE_ENDIAN);
+        buffer.putInt(0, MAGIC);
+        buffer.putInt(4, slots);
+        buffer.putInt(8, slotSize);
+        buffer.putInt(12, dataOffset);
+    }
+
+    // creates the ring in /dev/shm, or returns null if it is not available
+    public static ShmRing create(String prefix, int slots, int slotSize) {
+        File dir = new File("/dev/shm");
+        if (slots <= 0 || !dir.isDirectory()) {
+            return null;
+        }
+        try {
+            File file = File.createTempFile(prefix, ".ring", dir);
+            file.deleteOnExit();
+            return new ShmRing(file, slots, slotSize);
+        } catch (IOException e) {
+            return null;
+        }
+    }
+
+    public String path() {
+        return file.getAbsolutePath();
+    }
+
+    public int slotSize() {
+        return slotSize;
+    }
+
+    // the first free slot from the cursor, -1 if they are all busy
+    public int alloc() {
+        for (int i = 0; i < slots; ++i) {
+            int slot = (cursor + i) % slots;
+            if (buffer.get(FLAGS_OFFSET + slot) == 0) {
+                buffer.put(FLAGS_OFFSET + slot, (byte) 1);
+                cursor = slot + 1;
+                return slot;
+            }
+        }
+        return -1;
+    }
+
+    public void release(int slot) {
+        buffer.put(FLAGS_OFFSET + slot, (byte) 0);
+    }
+
+    // little-endian view of the first length bytes of a slot
+    public ByteBuffer slice(int slot, int length) {
+        ByteBuffer bb = buffer.duplicate();
+        bb.position(dataOffset + slot * slotSize);
+        bb.limit(dataOffset + slot * slotSize + length);
+        return bb.slice().order(ByteOrder.LITTLE_ENDIAN);
+    }
+
+    // the mapping stays valid for both processes once they have opened it
+    public void unlink() {
+        file.delete();
+    }
+}